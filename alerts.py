@@ -0,0 +1,516 @@
+# alerts.py
+"""
+高危发现的低延迟告警通知。
+
+发现写入报告后通常要等到有人打开 report.html 才会被看到。这里提供异步告警子系统:
+
+- 通知渠道 (sink): Webhook (HTTP POST JSON)、syslog / journald (/dev/log 或 UDP)、本地 SMTP 邮件、通用命令钩子；
+- submit() 只把发现放入有界队列后立即返回，不阻塞扫描循环；
+- 合并窗口: 第一个发现到达后等待 coalesce_seconds，窗口内的发现按指纹合并计数后生成一条聚合告警；
+- 每个渠道有独立的发送线程、待发送队列、令牌桶限速与指数退避重试，限速或重试期间新到的告警与积压告警合并发送，
+  因此一次发现洪峰只会产生少量聚合告警，单个渠道变慢或不可用也不会影响其他渠道。
+"""
+import json
+import os
+import queue
+import random
+import smtplib
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime
+from email.message import EmailMessage
+
+SEVERITY_RANK = {"info": 0, "low": 1, "medium": 2, "high": 3, "critical": 4}
+
+# syslog 优先级 (RFC 5424): crit / err / warning / notice / info
+_SYSLOG_SEVERITY = {"critical": 2, "high": 3, "medium": 4, "low": 5, "info": 6}
+_SYSLOG_FACILITIES = {"kern": 0, "user": 1, "mail": 2, "daemon": 3, "auth": 4, "syslog": 5, "authpriv": 10,
+                      **{f"local{i}": 16 + i for i in range(8)}}
+
+
+def severity_rank(finding):
+    return SEVERITY_RANK.get(str(finding.get("severity", "info")).lower(), 0)
+
+
+def _finding_key(log_type, finding):
+    """合并用的键: 优先使用指纹存储附加的 fingerprint"""
+    return finding.get("fingerprint") or f"{log_type}|{finding.get('severity')}|{finding.get('description')}"
+
+
+# ---------- 告警内容 ----------
+
+def merge_alerts(alerts):
+    """把多条告警合并为一条 (相同发现的计数相加)"""
+    entries = OrderedDict()
+    for alert in alerts:
+        for entry in alert["entries"]:
+            merged = entries.get(entry["key"])
+            if merged is None:
+                entries[entry["key"]] = dict(entry)
+            else:
+                merged["count"] += entry["count"]
+                merged["last_seen"] = max(merged["last_seen"], entry["last_seen"])
+    return {
+        "entries": list(entries.values()),
+        "window_start": min(alert["window_start"] for alert in alerts),
+        "window_end": max(alert["window_end"] for alert in alerts),
+    }
+
+
+def format_alert(alert, max_findings=20):
+    """
+    生成告警的标题、正文与结构化内容。
+    :return: (标题, 正文, JSON 负载)
+    """
+    entries = sorted(alert["entries"], key=lambda entry: (-severity_rank(entry["finding"]), -entry["count"]))
+    total = sum(entry["count"] for entry in entries)
+    by_severity = OrderedDict()
+    for entry in entries:
+        severity = str(entry["finding"].get("severity", "info")).lower()
+        by_severity[severity] = by_severity.get(severity, 0) + entry["count"]
+    counts = ", ".join(f"{count} {severity}" for severity, count in by_severity.items())
+    host = socket.gethostname()
+    subject = f"[NginxPhpAIScanner] {host}: {len(entries)} 个安全发现 ({counts})"
+    window = (f"{datetime.fromtimestamp(alert['window_start']).strftime('%Y-%m-%d %H:%M:%S')} ~ "
+              f"{datetime.fromtimestamp(alert['window_end']).strftime('%H:%M:%S')}")
+    lines = [subject, f"时间窗口: {window}，共 {total} 次"]
+    for entry in entries[:max_findings]:
+        finding = entry["finding"]
+        repeat = f" (x{entry['count']})" if entry["count"] > 1 else ""
+        lines.append(f"- [{str(finding.get('severity', 'info')).upper()}] {entry['log_type']}: {finding.get('description', '')}{repeat}")
+        if finding.get("recommendation"):
+            lines.append(f"  建议: {finding['recommendation']}")
+    if len(entries) > max_findings:
+        lines.append(f"... 另有 {len(entries) - max_findings} 个发现，详见报告。")
+    payload = {
+        "text": "\n".join(lines),  # 兼容 Slack / 企业微信等只读取 text 字段的接收端
+        "subject": subject,
+        "host": host,
+        "window_start": alert["window_start"],
+        "window_end": alert["window_end"],
+        "total": total,
+        "severity_counts": by_severity,
+        "findings": [
+            {"log_type": entry["log_type"], "count": entry["count"], "severity": entry["finding"].get("severity"),
+             "description": entry["finding"].get("description"), "recommendation": entry["finding"].get("recommendation"),
+             "log_lines": (entry["finding"].get("log_lines") or [])[:3]}
+            for entry in entries[:max_findings]
+        ],
+        "omitted": max(0, len(entries) - max_findings),
+    }
+    return subject, payload["text"], payload
+
+
+# ---------- 通知渠道 ----------
+
+class AlertSink:
+    """通知渠道基类；send() 失败时抛出异常，由发送线程负责重试"""
+
+    kind = "base"
+
+    def __init__(self, name=None, min_severity=None, rate_per_minute=6, burst=3, max_findings=20):
+        self.name = name or self.kind
+        self.min_severity = min_severity
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.max_findings = max_findings
+
+    def accepts(self, finding):
+        return self.min_severity is None or severity_rank(finding) >= SEVERITY_RANK.get(self.min_severity, 0)
+
+    def send(self, alert):
+        raise NotImplementedError
+
+
+class WebhookSink(AlertSink):
+    """HTTP POST JSON"""
+
+    kind = "webhook"
+
+    def __init__(self, url, headers=None, timeout=5, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+
+    def send(self, alert):
+        _, _, payload = format_alert(alert, self.max_findings)
+        request = urllib.request.Request(
+            self.url, data=json.dumps(payload, ensure_ascii=False).encode('utf-8'), method="POST",
+            headers=dict({"Content-Type": "application/json; charset=utf-8"}, **self.headers))
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:  # 非 2xx 响应抛出 HTTPError
+            response.read()
+
+
+class SyslogSink(AlertSink):
+    """syslog / journald: 写入 /dev/log (Unix 数据报) 或远程 UDP 地址，每条告警一条摘要 + 每个发现一条消息"""
+
+    kind = "syslog"
+
+    def __init__(self, address="/dev/log", facility="daemon", tag="nginx-php-ai-scanner", **kwargs):
+        super().__init__(**kwargs)
+        self.address = tuple(address) if isinstance(address, (list, tuple)) else address
+        self.facility = _SYSLOG_FACILITIES.get(facility, 3) if isinstance(facility, str) else int(facility)
+        self.tag = tag
+
+    def send(self, alert):
+        subject, _, payload = format_alert(alert, self.max_findings)
+        top = max((entry["finding"] for entry in alert["entries"]), key=severity_rank)
+        messages = [(top.get("severity"), subject)] + [
+            (finding["severity"], f"[{str(finding['severity']).upper()}] {finding['log_type']}: {finding['description']}"
+                                  + (f" (x{finding['count']})" if finding["count"] > 1 else ""))
+            for finding in payload["findings"]
+        ]
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            for severity, text in messages:
+                priority = self.facility * 8 + _SYSLOG_SEVERITY.get(str(severity).lower(), 6)
+                sock.sendto(f"<{priority}>{self.tag}[{os.getpid()}]: {text}".encode('utf-8')[:2048], self.address)
+
+
+class SmtpSink(AlertSink):
+    """通过本地 (或指定的) SMTP 服务器发送邮件"""
+
+    kind = "smtp"
+
+    def __init__(self, recipients, sender="nginx-php-ai-scanner@localhost", host="localhost", port=25,
+                 timeout=10, starttls=False, username=None, password=None, **kwargs):
+        super().__init__(**kwargs)
+        self.recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+        self.sender = sender
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+
+    def send(self, alert):
+        subject, text, _ = format_alert(alert, self.max_findings)
+        message = EmailMessage()
+        message["Subject"] = subject
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(text)
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password or "")
+            smtp.send_message(message)
+
+
+class CommandSink(AlertSink):
+    """通用命令钩子: 告警 JSON 写入命令的标准输入，标题放在环境变量 ALERT_SUBJECT 中；退出码非 0 视为失败"""
+
+    kind = "command"
+
+    def __init__(self, command, timeout=10, **kwargs):
+        super().__init__(**kwargs)
+        self.command = command
+        self.timeout = timeout
+
+    def send(self, alert):
+        subject, _, payload = format_alert(alert, self.max_findings)
+        completed = subprocess.run(
+            self.command, input=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+            shell=isinstance(self.command, str), timeout=self.timeout,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=dict(os.environ, ALERT_SUBJECT=subject))
+        if completed.returncode != 0:
+            raise RuntimeError(f"command exited with {completed.returncode}: {completed.stderr.decode('utf-8', 'replace')[:200]}")
+
+
+SINK_TYPES = {sink.kind: sink for sink in (WebhookSink, SyslogSink, SmtpSink, CommandSink)}
+
+
+def build_sink(spec):
+    """根据配置字典创建通知渠道: {"type": "webhook", "url": ..., "rate_per_minute": ..., ...}"""
+    spec = dict(spec)
+    kind = spec.pop("type", None)
+    if kind not in SINK_TYPES:
+        raise ValueError(f"unknown alert sink type {kind!r}, expected one of {sorted(SINK_TYPES)}")
+    return SINK_TYPES[kind](**spec)
+
+
+# ---------- 发送 ----------
+
+class TokenBucket:
+    """令牌桶限速: 每分钟 rate_per_minute 个令牌，最多积累 burst 个"""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = max(rate_per_minute, 0.001) / 60.0
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_seconds(self, now):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _SinkWorker:
+    """单个渠道的发送线程: 待发送队列 + 限速 + 指数退避重试"""
+
+    def __init__(self, sink, retry_base_seconds, retry_max_seconds, max_retries, max_pending):
+        self.sink = sink
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self.bucket = TokenBucket(sink.rate_per_minute, sink.burst)
+        self._pending = []
+        self._attempts = 0
+        self._next_attempt = 0.0
+        self._sending = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sent = 0
+        self.failed = 0  # 超过最大重试次数而放弃的告警数
+        self.retries = 0
+        self.rate_limited = 0
+        self.last_error = None
+
+    def offer(self, alert):
+        with self._lock:
+            self._pending.append(alert)
+            if len(self._pending) > self.max_pending:
+                # 长时间不可用时把最旧的积压告警合并，保持内存有界
+                self._pending[:2] = [merge_alerts(self._pending[:2])]
+        self._wake.set()
+
+    def idle(self):
+        with self._lock:
+            return not self._pending and not self._sending
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"alert-{self.sink.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                has_pending = bool(self._pending)
+            delay = None
+            if has_pending:
+                delay = max(self._next_attempt - now, 0.0)
+                if delay == 0.0:
+                    delay = self.bucket.wait_seconds(now)
+                    if delay > 0:
+                        self.rate_limited += 1
+            if has_pending and delay == 0.0 and self.bucket.try_acquire(now):
+                self._send_pending()
+                continue
+            self._wake.wait(timeout=delay)
+            self._wake.clear()
+
+    def _send_pending(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = []
+            self._sending = True
+        alert = merge_alerts(batch)  # 限速 / 重试期间积压的告警合并为一条
+        try:
+            self.sink.send(alert)
+        except Exception as e:
+            self._attempts += 1
+            self.last_error = str(e)
+            with self._lock:
+                if self._attempts > self.max_retries:
+                    self.failed += 1
+                    self._attempts = 0
+                    print(f"告警渠道 {self.sink.name} 连续 {self.max_retries + 1} 次发送失败，放弃该告警: {e}")
+                else:
+                    self.retries += 1
+                    self._pending.insert(0, alert)
+                    backoff = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (self._attempts - 1))
+                    self._next_attempt = time.monotonic() + backoff * random.uniform(0.8, 1.2)
+                    print(f"告警渠道 {self.sink.name} 发送失败 (第 {self._attempts} 次)，{backoff:.1f} 秒后重试: {e}")
+                self._sending = False
+            return
+        self._attempts = 0
+        self._next_attempt = 0.0
+        with self._lock:
+            self.sent += 1
+            self._sending = False
+
+    def stats(self):
+        with self._lock:
+            return {"sent": self.sent, "failed": self.failed, "retries": self.retries,
+                    "rate_limited": self.rate_limited, "pending": len(self._pending), "last_error": self.last_error}
+
+
+class AlertDispatcher:
+    """接收发现 (非阻塞)，按合并窗口聚合后分发到各通知渠道"""
+
+    def __init__(self, sinks, min_severity="high", coalesce_seconds=10.0, max_queue=1000, retry_base_seconds=5.0,
+                 retry_max_seconds=300.0, max_retries=8, max_pending_alerts=20, dedup_seconds=0.0):
+        """
+        :param dedup_seconds: 带 dedup_key 的发现 (本地检测器、运行状态监控) 在该时间内只通知一次；0 表示不去重。
+                              不依赖指纹存储的 seen_count，指纹存储未启用时同样生效。
+        """
+        self.min_severity = min_severity
+        self.coalesce_seconds = coalesce_seconds
+        self.dedup_seconds = dedup_seconds
+        self._recent = OrderedDict()  # dedup_key -> 上次通知时间
+        self._recent_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._workers = [_SinkWorker(sink, retry_base_seconds, retry_max_seconds, max_retries, max_pending_alerts)
+                         for sink in sinks]
+        self._window = OrderedDict()
+        self._window_start = None
+        self._window_opened = None
+        self._flush_requested = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.submitted = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.alerts = 0
+
+    def submit(self, log_type, findings):
+        """
+        提交发现，立即返回 (不做任何网络 I/O)。队列已满时丢弃并计数。
+        :return: 进入队列的发现数。
+        """
+        threshold = SEVERITY_RANK.get(self.min_severity, 0)
+        accepted = 0
+        now = time.time()
+        for finding in findings or []:
+            if not isinstance(finding, dict) or severity_rank(finding) < threshold:
+                continue
+            if self._is_duplicate(finding, now):
+                self.suppressed += 1
+                continue
+            entry = {"key": _finding_key(log_type, finding), "log_type": log_type, "finding": finding,
+                     "count": 1, "first_seen": now, "last_seen": now}
+            try:
+                self._queue.put_nowait(entry)
+            except queue.Full:
+                self.dropped += 1
+                continue
+            accepted += 1
+        self.submitted += accepted
+        return accepted
+
+    def _is_duplicate(self, finding, now):
+        """同一 dedup_key 在 dedup_seconds 内已经通知过时返回 True，否则记录本次通知时间"""
+        key = finding.get("dedup_key")
+        if not key or self.dedup_seconds <= 0:
+            return False
+        with self._recent_lock:
+            last = self._recent.get(key)
+            if last is not None and now - last < self.dedup_seconds:
+                return True
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            while self._recent and now - next(iter(self._recent.values())) >= self.dedup_seconds:
+                self._recent.popitem(last=False)
+        return False
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        for worker in self._workers:
+            worker.start()
+        self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            timeout = 0.5
+            if self._window_opened is not None:
+                timeout = max(0.0, min(timeout, self._window_opened + self.coalesce_seconds - time.monotonic()))
+            try:
+                entry = self._queue.get(timeout=timeout)
+                self._add(entry)
+                while True:  # 一次取完已到达的发现
+                    self._add(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if self._window_opened is not None and (self._flush_requested.is_set() or
+                                                    time.monotonic() - self._window_opened >= self.coalesce_seconds):
+                self._close_window()
+            if self._flush_requested.is_set() and self._queue.empty() and self._window_opened is None:
+                self._flush_requested.clear()
+
+    def _add(self, entry):
+        merged = self._window.get(entry["key"])
+        if merged is None:
+            self._window[entry["key"]] = entry
+        else:
+            merged["count"] += 1
+            merged["last_seen"] = entry["last_seen"]
+        if self._window_opened is None:
+            self._window_opened = time.monotonic()
+            self._window_start = entry["first_seen"]
+
+    def _close_window(self):
+        entries = list(self._window.values())
+        alert = {"entries": entries, "window_start": self._window_start,
+                 "window_end": max(entry["last_seen"] for entry in entries)}
+        self._window = OrderedDict()
+        self._window_opened = None
+        self.alerts += 1
+        for worker in self._workers:
+            selected = [entry for entry in entries if worker.sink.accepts(entry["finding"])]
+            if selected:
+                worker.offer(dict(alert, entries=selected))
+
+    def flush(self, timeout=15.0):
+        """立即结束当前合并窗口，并等待各渠道发送完毕 (或超时)。:return: 是否全部发送完毕"""
+        deadline = time.monotonic() + timeout
+        self._flush_requested.set()
+        while time.monotonic() < deadline:
+            if (not self._flush_requested.is_set() and self._queue.empty()
+                    and all(worker.idle() for worker in self._workers)):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def stop(self, flush_timeout=5.0):
+        if self._thread is None:
+            return
+        if not self.flush(flush_timeout):
+            pending = sum(worker.stats()["pending"] for worker in self._workers)
+            print(f"告警: 退出时仍有 {pending} 条告警未能发送。")
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        for worker in self._workers:
+            worker.stop()
+
+    def stats(self):
+        return {
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "suppressed": self.suppressed,
+            "alerts": self.alerts,
+            "sinks": {worker.sink.name: worker.stats() for worker in self._workers},
+        }
+
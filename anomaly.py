@@ -0,0 +1,276 @@
+# anomaly.py
+"""
+调用 AI 之前的轻量级流式异常评分。
+
+每种日志类型维护一个 AnomalyDetector:
+- 全局指标 (请求速率、4xx/5xx 比例、路径熵) 使用 EWMA 均值/方差作为基线，计算 z 分数；请求速率按窗口首尾行的
+  时间戳计算 (每秒行数)，窗口行数固定 (只读取末尾 LOG_LINES_TO_READ 行) 时也能反映流量突增；
+- 按 IP、URI 前缀、User-Agent (错误日志按消息签名) 维度，用带衰减的 Count-Min Sketch 记录
+  每个键的历史 EWMA 频次，用 Space-Saving 在当前窗口中找出 Top-K 高频键，计算其相对基线的突增程度；
+- 命中攻击特征的行直接给出高分。
+
+窗口得分超过阈值时才调用 AI，并优先发送得分最高的日志记录 (records.select_top_records)。
+"""
+import math
+import re
+import zlib
+from array import array
+
+import log_parser
+
+_NUMBER_RE = re.compile(r'\d+')
+
+
+class CountMinSketch:
+    """固定大小的 Count-Min Sketch，计数为浮点数以支持指数衰减"""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = [array('d', bytes(8 * width)) for _ in range(depth)]
+
+    def _indexes(self, key):
+        data = key.encode('utf-8', 'replace')
+        # crc32 的起始值作为每行的种子，结果在进程间稳定，便于持久化
+        return [zlib.crc32(data, seed * 0x9E3779B1 & 0xFFFFFFFF) % self.width for seed in range(self.depth)]
+
+    def add(self, key, count=1.0):
+        for row, index in zip(self.table, self._indexes(key)):
+            row[index] += count
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.table, self._indexes(key)))
+
+    def decay(self, factor):
+        """所有计数乘以 factor，使历史计数呈指数衰减"""
+        for row in self.table:
+            for index in range(self.width):
+                if row[index]:
+                    row[index] *= factor
+
+    def to_dict(self):
+        return {"width": self.width, "depth": self.depth, "table": [row.tobytes().hex() for row in self.table]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["width"], data["depth"])
+        sketch.table = [array('d', bytes.fromhex(row)) for row in data["table"]]
+        return sketch
+
+
+class SpaceSaving:
+    """Space-Saving 算法: 在固定 k 个计数器内近似统计流中的 Top-K 高频键"""
+
+    def __init__(self, k=32):
+        self.k = k
+        self.counts = {}
+
+    def add(self, key):
+        if key in self.counts:
+            self.counts[key] += 1
+        elif len(self.counts) < self.k:
+            self.counts[key] = 1
+        else:
+            # 替换当前计数最小的键，新键继承其计数 (高估上界)
+            victim = min(self.counts, key=self.counts.get)
+            self.counts[key] = self.counts.pop(victim) + 1
+
+    def top(self, n=None):
+        items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return items[:n] if n else items
+
+
+class Ewma:
+    """指数加权移动平均及方差"""
+
+    def __init__(self, alpha=0.2, mean=0.0, var=0.0, n=0):
+        self.alpha = alpha
+        self.mean = mean
+        self.var = var
+        self.n = n
+
+    def zscore(self, value):
+        if self.n == 0:
+            return 0.0
+        return (value - self.mean) / math.sqrt(self.var + 1e-6 + 0.01 * self.mean * self.mean)
+
+    def update(self, value):
+        if self.n == 0:
+            self.mean = value
+        else:
+            diff = value - self.mean
+            incr = self.alpha * diff
+            self.mean += incr
+            self.var = (1 - self.alpha) * (self.var + diff * incr)
+        self.n += 1
+
+    def to_dict(self):
+        return {"mean": self.mean, "var": self.var, "n": self.n}
+
+    @classmethod
+    def from_dict(cls, data, alpha=0.2):
+        return cls(alpha, data.get("mean", 0.0), data.get("var", 0.0), data.get("n", 0))
+
+
+def _entropy(counter):
+    total = sum(counter.values())
+    if total == 0:
+        return 0.0
+    return -sum((c / total) * math.log2(c / total) for c in counter.values())
+
+
+def _uri_prefix(path, depth=2):
+    path = path.split('?', 1)[0]
+    parts = [part for part in path.split('/') if part][:depth]
+    return '/' + '/'.join(parts)
+
+
+def extract_features(line, log_type):
+    """
+    提取单行日志的维度键和标志。
+    :return: (keys 字典, flags 字典, path) ；无法解析时 keys 为空。
+    """
+    if log_type == "nginx_access":
+        record = log_parser.parse_access_line(line)
+        if record is None:
+            return {}, {}, ""
+        keys = {"ip": record["ip"], "prefix": _uri_prefix(record["path"]), "ua": record["ua"][:200]}
+        status = record["status"]
+        flags = {"4xx": 400 <= status < 500, "5xx": status >= 500}
+        return keys, flags, record["path"].split('?', 1)[0]
+    # 错误日志 / php-fpm: 以去掉数字和时间戳后的消息作为签名
+    message = line.split(']', 1)[-1] if line.startswith('[') else line[20:]
+    signature = _NUMBER_RE.sub('#', message.strip())[:160]
+    flags = {"error": log_parser.is_suspicious(line, log_type)}
+    return {"sig": signature}, flags, ""
+
+
+def window_rate(lines, log_type):
+    """按窗口首尾可解析的时间戳计算每秒行数 (时间戳精度为秒，跨度至少按 1 秒计)；没有时间戳时返回 None"""
+    first = next((ts for ts in (log_parser.parse_line_timestamp(line, log_type) for line in lines) if ts is not None), None)
+    if first is None:
+        return None
+    last = next(ts for ts in (log_parser.parse_line_timestamp(line, log_type) for line in reversed(lines)) if ts is not None)
+    return len(lines) / (abs(last - first) + 1)
+
+
+class AnomalyDetector:
+    """单个日志类型的异常评分器"""
+
+    GLOBAL_METRICS = ("rate", "ratio_4xx", "ratio_5xx", "ratio_error", "path_entropy")
+
+    def __init__(self, log_type, alpha=0.2, decay=0.9, top_k=32, sketch_width=2048, sketch_depth=4,
+                 signature_score=5.0):
+        self.log_type = log_type
+        self.decay = decay
+        self.top_k = top_k
+        self.signature_score = signature_score
+        self.windows_seen = 0
+        self.metrics = {name: Ewma(alpha) for name in self.GLOBAL_METRICS}
+        self.sketches = {}
+        self._sketch_args = (sketch_width, sketch_depth)
+
+    def _sketch(self, dimension):
+        sketch = self.sketches.get(dimension)
+        if sketch is None:
+            sketch = self.sketches[dimension] = CountMinSketch(*self._sketch_args)
+        return sketch
+
+    def score_window(self, lines, update=True):
+        """
+        为一个日志窗口打分。
+        :param update: 打分后是否把本窗口计入基线。
+        :return: {"score", "components", "line_scores"}，line_scores 与 lines 一一对应。
+        """
+        parsed = [extract_features(line, self.log_type) for line in lines]
+        heavy = {}
+        paths = {}
+        flag_counts = {"4xx": 0, "5xx": 0, "error": 0}
+        for keys, flags, path in parsed:
+            for dimension, key in keys.items():
+                heavy.setdefault(dimension, SpaceSaving(self.top_k)).add(key)
+            for flag, value in flags.items():
+                if value:
+                    flag_counts[flag] += 1
+            if path:
+                paths[path] = paths.get(path, 0) + 1
+
+        total = len(lines) or 1
+        observed = {
+            "ratio_4xx": flag_counts["4xx"] / total,
+            "ratio_5xx": flag_counts["5xx"] / total,
+            "ratio_error": flag_counts["error"] / total,
+            "path_entropy": _entropy(paths),
+        }
+        rate = window_rate(lines, self.log_type)
+        if rate is not None:
+            observed["rate"] = rate  # 没有可解析时间戳的窗口不参与请求速率的评分与基线
+        components = {}
+        for name, value in observed.items():
+            z = self.metrics[name].zscore(value)
+            # 路径熵在两个方向上的偏离都可疑: 升高对应目录枚举，降低对应针对单一路径的爆破
+            components[name] = round(abs(z) if name == "path_entropy" else max(z, 0.0), 3)
+
+        # Top-K 键相对历史基线的突增: (窗口计数 - 期望) / sqrt(期望 + 1)
+        key_surprise = {}
+        for dimension, counter in heavy.items():
+            sketch = self._sketch(dimension)
+            for key, count in counter.top():
+                expected = sketch.estimate(key)
+                surprise = (count - expected) / math.sqrt(expected + 1.0)
+                if surprise > 0:
+                    key_surprise[(dimension, key)] = surprise
+        if key_surprise:
+            (dimension, key), value = max(key_surprise.items(), key=lambda item: item[1])
+            components[f"top_{dimension}"] = round(value, 3)
+
+        line_scores = []
+        signature_hits = 0
+        for line, (keys, flags, path) in zip(lines, parsed):
+            score = sum(key_surprise.get((dimension, key), 0.0) for dimension, key in keys.items())
+            score += 1.0 if flags.get("5xx") or flags.get("error") else 0.5 if flags.get("4xx") else 0.0
+            if self.log_type == "nginx_access" and log_parser.SUSPICIOUS_REQUEST_RE.search(line):
+                score += self.signature_score
+                signature_hits += 1
+            line_scores.append(score)
+        if signature_hits:
+            components["signature_hits"] = signature_hits
+
+        window_score = max(
+            [value for name, value in components.items() if name != "signature_hits"] +
+            [self.signature_score if signature_hits else 0.0]
+        )
+
+        if update:
+            self.update(observed, parsed)
+        return {"score": round(window_score, 3), "components": components, "line_scores": line_scores}
+
+    def update(self, observed, parsed):
+        """把窗口计入基线: 全局指标更新 EWMA，各维度 sketch 先衰减再累加"""
+        for name, value in observed.items():
+            self.metrics[name].update(value)
+        for sketch in self.sketches.values():
+            sketch.decay(self.decay)
+        for keys, _, _ in parsed:
+            for dimension, key in keys.items():
+                self._sketch(dimension).add(key, 1.0 - self.decay)
+        self.windows_seen += 1
+
+    def to_dict(self):
+        """导出基线状态 (EWMA 指标与各维度 sketch)，用于跨进程持久化"""
+        return {
+            "windows_seen": self.windows_seen,
+            "metrics": {name: ewma.to_dict() for name, ewma in self.metrics.items()},
+            "sketches": {dimension: sketch.to_dict() for dimension, sketch in self.sketches.items()},
+        }
+
+    def load_dict(self, data):
+        """恢复 to_dict() 导出的基线状态；sketch 尺寸与当前配置不一致时丢弃该 sketch"""
+        self.windows_seen = data.get("windows_seen", 0)
+        for name, values in (data.get("metrics") or {}).items():
+            if name in self.metrics:
+                self.metrics[name] = Ewma.from_dict(values, self.metrics[name].alpha)
+        for dimension, values in (data.get("sketches") or {}).items():
+            if (values.get("width"), values.get("depth")) == self._sketch_args:
+                self.sketches[dimension] = CountMinSketch.from_dict(values)
+        return self
@@ -0,0 +1,328 @@
+# backfill.py
+"""
+历史日志回填分析 (批处理入口)。
+
+用法示例:
+    python backfill.py --since 2024-05-01T00:00 --until 2024-05-08T00:00
+    python backfill.py --log-type nginx_access /var/log/nginx/access.log.2.gz
+
+流程: 流式解压读取 (plain / .gz / .zst) -> 进程池并行解析与预过滤 -> 按时间段分区
+-> 切分可疑日志块 -> 以受限并发调用 AI 提供商 -> 更新报告并写入断点文件，中断后可续跑。
+"""
+import argparse
+import base64
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+import config
+import log_parser
+
+try:
+    import zstandard  # 可选依赖: pip install zstandard
+except ImportError:
+    zstandard = None
+
+LOG_TYPE_PATHS = {
+    "nginx_access": "NGINX_ACCESS_LOG_PATH",
+    "nginx_error": "NGINX_ERROR_LOG_PATH",
+    "php_fpm": "PHP_FPM_LOG_PATH",
+}
+
+_ROTATED_SUFFIX_RE = re.compile(r'\.(\d+)(?:\.(?:gz|zst))?$')
+
+
+def open_log_stream(path):
+    """以文本流方式打开日志文件，按扩展名透明地进行流式解压"""
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"读取 {path} 需要 zstandard 库 (pip install zstandard)")
+        raw = open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+def discover_log_files(base_path):
+    """
+    查找日志文件及其轮转副本 (access.log, access.log.1, access.log.2.gz ...)。
+    :return: 按时间从旧到新排序的文件路径列表。
+    """
+    candidates = []
+    for path in glob.glob(glob.escape(base_path) + ".*"):
+        match = _ROTATED_SUFFIX_RE.search(path[len(base_path):])
+        if match and path[len(base_path):] == match.group(0):
+            candidates.append((int(match.group(1)), path))
+    candidates.sort(reverse=True)  # 编号越大越旧
+    files = [path for _, path in candidates]
+    if os.path.exists(base_path):
+        files.append(base_path)
+    return files
+
+
+def _add_line(partitions, key, line, log_type, max_lines):
+    bucket = partitions.get(key)
+    if bucket is None:
+        bucket = partitions[key] = {"lines": [], "total": 0, "suspicious": 0}
+    bucket["total"] += 1
+    if log_parser.is_suspicious(line, log_type):
+        bucket["suspicious"] += 1
+        if len(bucket["lines"]) < max_lines:
+            bucket["lines"].append(line if line.endswith('\n') else line + '\n')
+
+
+def _merge_bucket(partitions, key, bucket, max_lines):
+    target = partitions.get(key)
+    if target is None:
+        target = partitions[key] = {"lines": [], "total": 0, "suspicious": 0}
+    target["total"] += bucket["total"]
+    target["suspicious"] += bucket["suspicious"]
+    target["lines"].extend(bucket["lines"][:max_lines - len(target["lines"])])
+
+
+def scan_file(task):
+    """
+    进程池工作函数: 流式读取单个日志文件，解析时间戳、按时间段分区并预过滤。
+    没有时间戳的行 (如堆栈续行) 沿用上一条记录的时间戳，同样按 --since/--until 过滤；文件开头第一个时间戳之前的行
+    是上一个文件中记录的续行，沿用第一个时间戳。这些行与分区一样只统计行数并保留最多 max_lines 个可疑行，
+    整个文件都没有时间戳时 (如 log_type 或日志格式不匹配)，它们在不限定时间范围时归入分区 -1，否则跳过。
+    :param task: (path, log_type, since_ts, until_ts, partition_seconds, max_lines_per_partition)
+    :return: {"path", "log_type", "total_lines", "partitions": {起始时间戳: {"lines", "total", "suspicious"}}}
+    """
+    path, log_type, since_ts, until_ts, partition_seconds, max_lines = task
+    partitions = {}
+    total_lines = 0
+    last_ts = None
+    leading = {}  # 第一个时间戳之前的行 (暂存在分区 -1 中)
+
+    def in_range(ts):
+        return (since_ts is None or ts >= since_ts) and (until_ts is None or ts < until_ts)
+
+    with open_log_stream(path) as stream:
+        for line in stream:
+            total_lines += 1
+            ts = log_parser.parse_line_timestamp(line, log_type)
+            if ts is None:
+                if last_ts is None:
+                    _add_line(leading, -1, line, log_type, max_lines)
+                    continue
+                ts = last_ts  # 续行 (如堆栈) 归属到上一条记录
+            elif last_ts is None and leading:
+                if in_range(ts):
+                    _merge_bucket(partitions, ts - ts % partition_seconds, leading.pop(-1), max_lines)
+                leading = {}
+            last_ts = ts
+            if in_range(ts):
+                _add_line(partitions, ts - ts % partition_seconds, line, log_type, max_lines)
+    if leading and since_ts is None and until_ts is None:
+        partitions[-1] = leading[-1]
+    return {"path": path, "log_type": log_type, "total_lines": total_lines, "partitions": partitions}
+
+
+def build_chunks(scan_results, chunk_lines):
+    """将各文件的分区结果合并，并按时间顺序切分为待分析的日志块"""
+    merged = {}
+    for result in scan_results:
+        for key, bucket in result["partitions"].items():
+            slot = merged.setdefault((result["log_type"], key), {"lines": [], "total": 0, "suspicious": 0})
+            slot["lines"].extend(bucket["lines"])
+            slot["total"] += bucket["total"]
+            slot["suspicious"] += bucket["suspicious"]
+
+    chunks = []
+    for (log_type, key) in sorted(merged, key=lambda k: (k[1], k[0])):
+        slot = merged[(log_type, key)]
+        lines = slot["lines"]
+        for index in range(0, len(lines), chunk_lines):
+            chunk = lines[index:index + chunk_lines]
+            digest = hashlib.sha1("".join(chunk).encode('utf-8', 'replace')).hexdigest()[:16]
+            chunks.append({
+                "id": f"{log_type}|{key}|{index // chunk_lines}|{digest}",
+                "log_type": log_type,
+                "partition_start": key,
+                "lines": chunk,
+                "partition_total": slot["total"],
+                "partition_suspicious": slot["suspicious"],
+            })
+    return chunks
+
+
+def load_checkpoint(path):
+    """读取断点文件，返回已完成块 ID 的集合"""
+    if not path or not os.path.exists(path):
+        return set()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return set(json.load(f).get("done_chunks", []))
+    except Exception as e:
+        print(f"读取断点文件 {path} 失败，将从头开始: {e}")
+        return set()
+
+
+def save_checkpoint(path, done_chunks):
+    """原子地写入断点文件 (先写临时文件再替换)"""
+    if not path:
+        return
+    checkpoint_dir = os.path.dirname(path)
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"updated_at": datetime.now().isoformat(), "done_chunks": sorted(done_chunks)}, f)
+    os.replace(tmp_path, path)
+
+
+def _analyze_chunk(chunk, proxies):
+    """在线程池中调用 AI 提供商分析单个日志块"""
+    from main import call_ai_api
+    log_data_str_b64 = base64.b64encode("".join(chunk["lines"]).encode('utf-8')).decode('utf-8')
+    return call_ai_api(log_data_str_b64, proxies=proxies)
+
+
+def _format_partition(key):
+    if key < 0:
+        return "未知时间"
+    return datetime.fromtimestamp(key).strftime("%Y-%m-%d %H:%M")
+
+
+def run_backfill(files_by_type, since_ts=None, until_ts=None, partition_seconds=3600, workers=None,
+                 concurrency=2, chunk_lines=None, checkpoint_path=None, dry_run=False, proxies=None):
+    """
+    执行一次回填分析。
+    :param files_by_type: {log_type: [文件路径, ...]}
+    :return: 本次新分析的块数。
+    """
+    chunk_lines = chunk_lines or config.LOG_LINES_TO_READ
+    max_lines = getattr(config, "BACKFILL_MAX_LINES_PER_PARTITION", 2000)
+    tasks = [(path, log_type, since_ts, until_ts, partition_seconds, max_lines)
+             for log_type, paths in files_by_type.items() for path in paths]
+    if not tasks:
+        print("没有找到需要回填的日志文件。")
+        return 0
+
+    print(f"开始并行解析 {len(tasks)} 个日志文件 (进程数: {workers or os.cpu_count()})...")
+    started = time.time()
+    scan_results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for task, result in zip(tasks, pool.map(scan_file, tasks)):
+            partitions = result["partitions"]
+            suspicious = sum(bucket["suspicious"] for bucket in partitions.values())
+            print(f"  {task[0]}: {result['total_lines']} 行, {len(partitions)} 个时间段, {suspicious} 行可疑")
+            scan_results.append(result)
+    print(f"解析完成，耗时 {time.time() - started:.1f} 秒。")
+
+    chunks = build_chunks(scan_results, chunk_lines)
+    done_chunks = load_checkpoint(checkpoint_path)
+    pending = [chunk for chunk in chunks if chunk["id"] not in done_chunks]
+    print(f"共 {len(chunks)} 个可疑日志块，其中 {len(chunks) - len(pending)} 个已在之前完成，待分析 {len(pending)} 个。")
+    if dry_run or not pending:
+        return 0
+
+    from main import update_report_html
+
+    analyzed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+        queue = iter(pending)
+        while True:
+            # 只保持有限数量的请求在途，避免一次性提交全部任务
+            while len(in_flight) < concurrency * 2:
+                chunk = next(queue, None)
+                if chunk is None:
+                    break
+                in_flight[executor.submit(_analyze_chunk, chunk, proxies)] = chunk
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"error": f"Unknown error during backfill analysis: {e}"}
+                if not result or result.get("error"):
+                    # 失败的块不写入断点，续跑时会重新分析
+                    print(f"日志块 {chunk['id']} 分析失败: {(result or {}).get('error', 'no result')}")
+                    continue
+                result.setdefault("log_type", chunk["log_type"])
+                result.setdefault("timestamp", datetime.now().isoformat())
+                result["log_type"] = f"{chunk['log_type']} backfill {_format_partition(chunk['partition_start'])}"
+                result.setdefault("summary", "")
+                result["summary"] += (f" (时间段内共 {chunk['partition_total']} 行，"
+                                      f"{chunk['partition_suspicious']} 行可疑，本块 {len(chunk['lines'])} 行)")
+                update_report_html([result])
+                done_chunks.add(chunk["id"])
+                save_checkpoint(checkpoint_path, done_chunks)
+                analyzed += 1
+                print(f"回填进度: {len(done_chunks)}/{len(chunks)}")
+    return analyzed
+
+
+def _parse_time_arg(value):
+    if value is None:
+        return None
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NginxPhpAIScanner 历史日志回填分析")
+    parser.add_argument("files", nargs="*", help="要分析的日志文件 (默认自动查找配置路径及其轮转文件)")
+    parser.add_argument("--log-type", choices=sorted(LOG_TYPE_PATHS), action="append",
+                        help="日志类型，可重复指定 (指定 files 时只能给出一个)")
+    parser.add_argument("--since", help="起始时间 (ISO 格式，例如 2024-05-01T00:00)")
+    parser.add_argument("--until", help="结束时间 (ISO 格式，不含)")
+    parser.add_argument("--partition-minutes", type=int,
+                        default=getattr(config, "BACKFILL_PARTITION_MINUTES", 60), help="时间分区长度 (分钟)")
+    parser.add_argument("--workers", type=int, default=getattr(config, "BACKFILL_WORKERS", None),
+                        help="解析进程数 (默认 CPU 核数)")
+    parser.add_argument("--concurrency", type=int, default=getattr(config, "BACKFILL_CONCURRENCY", 2),
+                        help="AI API 最大并发请求数")
+    parser.add_argument("--checkpoint", default=getattr(config, "BACKFILL_CHECKPOINT_PATH", None),
+                        help="断点文件路径")
+    parser.add_argument("--reset", action="store_true", help="忽略并清除已有断点")
+    parser.add_argument("--dry-run", action="store_true", help="只解析和统计，不调用 AI API")
+    args = parser.parse_args(argv)
+
+    log_types = args.log_type or sorted(LOG_TYPE_PATHS)
+    if args.files:
+        if len(log_types) != 1:
+            parser.error("指定日志文件时必须通过 --log-type 给出唯一的日志类型")
+        files_by_type = {log_types[0]: args.files}
+    else:
+        files_by_type = {}
+        for log_type in log_types:
+            base_path = getattr(config, LOG_TYPE_PATHS[log_type], None)
+            if base_path:
+                files_by_type[log_type] = discover_log_files(base_path)
+
+    if args.reset and args.checkpoint and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    analyzed = run_backfill(
+        files_by_type,
+        since_ts=_parse_time_arg(args.since),
+        until_ts=_parse_time_arg(args.until),
+        partition_seconds=max(1, args.partition_minutes) * 60,
+        workers=args.workers,
+        concurrency=max(1, args.concurrency),
+        checkpoint_path=args.checkpoint,
+        dry_run=args.dry_run,
+        proxies=getattr(config, "PROXIES", None),
+    )
+    print(f"回填完成，本次分析了 {analyzed} 个日志块。")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n回填已中断，已完成的部分保存在断点文件中，重新运行即可续跑。")
@@ -0,0 +1,74 @@
+# batching.py
+"""
+把多个日志来源 (或多个小日志块) 打包为一次多分段请求，并把响应按分段拆回。
+
+请求中的每个分段形如 <section id="nginx_access">BASE64</section>，模型按分段 ID 返回
+{"sections": {"nginx_access": {"findings": [...], "summary": "..."}, ...}}。
+"""
+
+BATCH_SYSTEM_INSTRUCTION = """The user message contains several log sections, each wrapped as <section id="ID">BASE64_LOG_DATA</section>. Decode each section's Base64 log data and analyze it for security issues independently of the other sections. Respond ONLY with a single, valid JSON object: {"sections": {"ID": {"findings": [{"severity": "high|medium|low|info", "description": "issue_description", "recommendation": "suggested_action", "log_lines": ["relevant_decoded_log_line"]}], "summary": "overall_analysis_summary"}}}. Include every section ID exactly once. If a section has no issues, its 'findings' must be an empty array."""
+
+BATCH_USER_PROMPT_PREFIX = "请分别分析以下各分段的日志数据：\n\n"
+
+
+def plan_batches(items, max_chars, max_sections):
+    """
+    按数据长度贪心地把待分析项分组。
+    :param items: [{"id", "b64", ...}]
+    :return: 分组列表；单项超过 max_chars 时独占一组。
+    """
+    batches = []
+    current = []
+    current_chars = 0
+    for item in items:
+        size = len(item["b64"])
+        if current and (current_chars + size > max_chars or len(current) >= max_sections):
+            batches.append(current)
+            current = []
+            current_chars = 0
+        current.append(item)
+        current_chars += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_prompt(items):
+    """生成带分段标签的用户消息正文"""
+    return "\n".join(f'<section id="{item["id"]}">\n{item["b64"]}\n</section>' for item in items)
+
+
+def split_batch_result(result, section_ids):
+    """
+    将批量响应拆分为各分段各自的结果。
+    :return: {分段 ID: 结果字典}；响应中缺失的分段对应 None，由调用方决定是否单独重试。
+    """
+    if not result or not isinstance(result, dict):
+        return {section_id: None for section_id in section_ids}
+    if result.get("error") and not result.get("sections"):
+        return {section_id: dict(result) for section_id in section_ids}
+
+    sections = result.get("sections")
+    if isinstance(sections, list):
+        # 部分模型会返回 [{"id": ..., "findings": ...}] 形式
+        sections = {str(entry.get("id")): entry for entry in sections if isinstance(entry, dict)}
+    if not isinstance(sections, dict):
+        sections = {}
+
+    split = {}
+    for section_id in section_ids:
+        section = sections.get(section_id)
+        if not isinstance(section, dict):
+            split[section_id] = None
+            continue
+        section = dict(section)
+        section.pop("id", None)
+        if "f" not in section and "flag" not in section:  # 紧凑结果 (f / m) 与分诊结果 (flag / score) 保持原结构
+            section.setdefault("findings", [])
+            section.setdefault("summary", "")
+        for key in ("warning_finish_reason", "parse_recovery"):
+            if result.get(key):
+                section[key] = result[key]
+        section["batched"] = True
+        split[section_id] = section
+    return split
@@ -0,0 +1,90 @@
+# cascade.py
+"""
+模型分级 (级联) 分析: 先由快速、廉价的分诊模型对每个日志窗口给出 {"flag": 是否可疑, "score": 0-100}，
+只有评分达到阈值 (或分诊失败) 的窗口才升级到更强的模型做完整分析。
+
+分诊模型、深度分析模型和升级阈值都可以按日志类型单独配置 (CASCADE_LOG_TYPE_SETTINGS)。
+"""
+
+TRIAGE_SYSTEM_INSTRUCTION = (
+    "Decode the Base64 log data and triage it for security relevance. Do NOT list findings. "
+    'Respond ONLY with JSON: {"flag": true|false, "score": 0-100}, where flag is true if any line looks like an attack, '
+    "intrusion attempt, abuse or a service problem worth a detailed review, and score is how suspicious the most suspicious line is "
+    "(0 = clearly benign routine traffic, 100 = certain attack)."
+)
+
+TRIAGE_BATCH_SYSTEM_INSTRUCTION = (
+    "The user message contains several log sections, each wrapped as <section id=\"ID\">BASE64_LOG_DATA</section>. "
+    "Decode each section independently and triage it for security relevance. Do NOT list findings. "
+    'Respond ONLY with JSON: {"sections": {"ID": {"flag": true|false, "score": 0-100}}}, where flag is true if any line of the section '
+    "looks like an attack, intrusion attempt, abuse or a service problem worth a detailed review, and score is how suspicious "
+    "the most suspicious line is (0 = clearly benign routine traffic, 100 = certain attack). Include every section ID exactly once."
+)
+
+TRIAGE_USER_PROMPT_PREFIX = "请对以下日志数据进行分诊：\n\n"
+
+TRIAGE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "flag": {"type": "boolean"},
+        "score": {"type": "integer"},
+    },
+    "required": ["flag", "score"],
+    "additionalProperties": False,
+}
+
+# 分诊输出只有两个字段，每个分段给少量 tokens 即可
+TRIAGE_MAX_OUTPUT_TOKENS = 64
+
+
+def build_triage_batch_schema(section_ids):
+    """批量分诊请求的响应结构，每个分段 ID 都是必填属性"""
+    return {
+        "type": "object",
+        "properties": {
+            "sections": {
+                "type": "object",
+                "properties": {section_id: TRIAGE_RESPONSE_SCHEMA for section_id in section_ids},
+                "required": list(section_ids),
+                "additionalProperties": False,
+            }
+        },
+        "required": ["sections"],
+        "additionalProperties": False,
+    }
+
+
+def is_enabled(config):
+    return getattr(config, "ENABLE_MODEL_CASCADE", False)
+
+
+def tier_settings(config, log_type):
+    """
+    返回某日志类型的分级设置。
+    :return: {"enabled", "triage_model", "analysis_model", "escalate_score"}；模型为 None 表示使用提供商的默认模型。
+    """
+    provider = getattr(config, "AI_PROVIDER", "gemini").lower()
+    triage_models = getattr(config, "CASCADE_TRIAGE_MODEL", {}) or {}
+    settings = {
+        "enabled": True,
+        "triage_model": triage_models.get(provider),
+        "analysis_model": None,
+        "escalate_score": getattr(config, "CASCADE_ESCALATE_SCORE", 40),
+    }
+    overrides = (getattr(config, "CASCADE_LOG_TYPE_SETTINGS", {}) or {}).get(log_type) or {}
+    settings.update(overrides)
+    for key in ("triage_model", "analysis_model"):
+        if isinstance(settings[key], dict):
+            # 允许按提供商分别指定模型: {"gemini": "...", "openrouter": "..."}
+            settings[key] = settings[key].get(provider)
+    return settings
+
+
+def should_escalate(verdict, escalate_score):
+    """
+    判断分诊结果是否需要升级到深度分析。
+    分诊失败 (无结果、出错或缺少评分) 时一律升级，宁可多花一次调用也不漏掉可疑窗口。
+    """
+    if not verdict or verdict.get("error") or "score" not in verdict:
+        return True
+    return verdict["score"] >= escalate_score
@@ -0,0 +1,124 @@
+# compact_schema.py
+"""
+紧凑输出模式: 缩短模型输出以降低输出 token 数和延迟。
+
+模型只返回枚举化的类别代码、严重性缩写和日志行序号 (指向发送窗口中带编号的行)，
+例如 {"f": [{"s": "h", "c": "SQLI", "l": [3, 7], "n": "union select 注入"}], "m": "摘要"}；
+描述和建议由本地的 CATEGORIES 表补全，日志行由序号回填，展开后与常规结果结构一致。
+该结构通过 Gemini responseSchema / OpenRouter json_schema 强制约束。
+"""
+
+# 类别代码 -> (名称, 建议)
+CATEGORIES = {
+    "SQLI": ("SQL 注入尝试", "检查相关接口是否使用参数化查询，并在 WAF 中拦截该来源。"),
+    "XSS": ("跨站脚本 (XSS) 尝试", "确认输出已正确转义，并考虑启用 Content-Security-Policy。"),
+    "TRAV": ("路径穿越 / 本地文件包含", "检查文件读取与 include 逻辑是否限制了路径，并封禁该来源。"),
+    "RCE": ("命令执行 / WebShell 访问", "立即排查服务器上是否存在 WebShell 或被篡改的文件，并封禁该来源。"),
+    "SCAN": ("漏洞扫描 / 目录枚举", "封禁扫描来源，并确认备份文件、.env、.git 等敏感文件未暴露。"),
+    "BRUTE": ("登录暴力破解", "对登录端点启用限速或验证码，封禁来源 IP，必要时禁用 xmlrpc.php。"),
+    "DOS": ("高频请求 / 拒绝服务", "启用 limit_req / limit_conn 限速，并评估是否需要 CDN 或上游防护。"),
+    "SENS": ("敏感文件探测", "确认敏感文件不可通过 Web 访问，并在 Nginx 中显式拒绝此类路径。"),
+    "BOT": ("恶意爬虫 / 异常 User-Agent", "按 User-Agent 或来源 IP 进行拦截或限速。"),
+    "AUTH": ("认证 / 权限异常", "检查相关账户与权限配置，确认没有未授权访问成功。"),
+    "ERR": ("应用错误 / 配置问题", "根据错误信息修复应用或 Nginx/PHP 配置，避免泄露敏感信息。"),
+    "FPM": ("php-fpm 资源问题", "检查 php-fpm 进程池配置 (pm.max_children 等) 与慢请求日志。"),
+    "OTHER": ("其他可疑活动", "人工复核相关日志行。"),
+}
+
+SEVERITY_CODES = {"c": "critical", "h": "high", "m": "medium", "l": "low", "i": "info"}
+
+_CATEGORY_LIST = ", ".join(f"{code}={name}" for code, (name, _) in CATEGORIES.items())
+
+COMPACT_SYSTEM_INSTRUCTION = (
+    "Decode the Base64 log data. Every decoded line is prefixed with its index as 'N|'. "
+    "Analyze the lines for security issues and respond ONLY with compact JSON: "
+    '{"f": [{"s": "c|h|m|l|i", "c": "CATEGORY", "l": [line_indexes], "n": "short note, max 15 words"}], "m": "one-sentence summary"}. '
+    f"Categories: {_CATEGORY_LIST}. "
+    "Reference lines only by index; never echo log text. Group lines of the same issue into one finding. "
+    "If no issues are found, 'f' must be an empty array."
+)
+
+COMPACT_BATCH_SYSTEM_INSTRUCTION = (
+    "The user message contains several log sections, each wrapped as <section id=\"ID\">BASE64_LOG_DATA</section>. "
+    "Decode each section independently; every decoded line is prefixed with its index within that section as 'N|'. "
+    "Analyze each section for security issues and respond ONLY with compact JSON: "
+    '{"sections": {"ID": {"f": [{"s": "c|h|m|l|i", "c": "CATEGORY", "l": [line_indexes], "n": "short note, max 15 words"}], "m": "one-sentence summary"}}}. '
+    f"Categories: {_CATEGORY_LIST}. "
+    "Reference lines only by index; never echo log text. Include every section ID exactly once; use an empty 'f' array when a section has no issues."
+)
+
+_FINDING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "s": {"type": "string", "enum": list(SEVERITY_CODES)},
+        "c": {"type": "string", "enum": list(CATEGORIES)},
+        "l": {"type": "array", "items": {"type": "integer"}},
+        "n": {"type": "string"},
+    },
+    "required": ["s", "c", "l", "n"],
+    "additionalProperties": False,
+}
+
+COMPACT_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "f": {"type": "array", "items": _FINDING_SCHEMA},
+        "m": {"type": "string"},
+    },
+    "required": ["f", "m"],
+    "additionalProperties": False,
+}
+
+
+def build_batch_schema(section_ids):
+    """批量紧凑请求的响应结构，每个分段 ID 都是必填属性"""
+    return {
+        "type": "object",
+        "properties": {
+            "sections": {
+                "type": "object",
+                "properties": {section_id: COMPACT_RESPONSE_SCHEMA for section_id in section_ids},
+                "required": list(section_ids),
+                "additionalProperties": False,
+            }
+        },
+        "required": ["sections"],
+        "additionalProperties": False,
+    }
+
+
+def number_lines(lines):
+    """为发送窗口中的每一行加上 'N|' 序号前缀"""
+    return "".join(f"{index}|{line if line.endswith(chr(10)) else line + chr(10)}" for index, line in enumerate(lines))
+
+
+def is_compact(result):
+    return isinstance(result, dict) and "f" in result and "findings" not in result
+
+
+def expand_compact(result, window_lines):
+    """
+    把紧凑结果展开为常规结果结构 (findings / summary)。
+    :param window_lines: 发送给模型的日志行，序号即为其下标。
+    """
+    findings = []
+    for entry in result.get("f") or []:
+        code = str(entry.get("c", "OTHER")).upper()
+        name, recommendation = CATEGORIES.get(code, CATEGORIES["OTHER"])
+        note = str(entry.get("n") or "").strip()
+        log_lines = []
+        for index in entry.get("l") or []:
+            if 0 <= index < len(window_lines):
+                log_lines.append(window_lines[index].rstrip('\n'))
+        findings.append({
+            "severity": SEVERITY_CODES.get(str(entry.get("s", "i")).lower()[:1], "info"),
+            "category": code,
+            "description": f"{name}：{note}" if note else name,
+            "recommendation": recommendation,
+            "log_lines": log_lines,
+        })
+    expanded = {key: value for key, value in result.items() if key not in ("f", "m")}
+    expanded["findings"] = findings
+    expanded["summary"] = str(result.get("m") or "")
+    expanded["compact"] = True
+    return expanded
@@ -27,6 +27,36 @@ PHP_FPM_LOG_PATH = "/www/server/php/74/var/log/php-fpm.log"
 # 每次检测读取的最新日志行数
 LOG_LINES_TO_READ = 50
 
+# 是否把多行记录 (PHP 堆栈跟踪、php-fpm 慢日志等) 组装为完整记录，窗口只在记录之间截断
+ENABLE_RECORD_ASSEMBLY = True
+# 单条记录最多保留的行数 (超出部分的续行不发送)
+RECORD_MAX_LINES = 200
+# 单次运行模式下，文件末尾的记录在日志静止该秒数之前可能还有续行未写入，留到下次读取
+RECORD_FLUSH_SECONDS = 5
+
+# ==================== 流量感知抽样配置 ====================
+# 是否启用抽样: 读取整个扫描间隔的日志 (而不是最后 LOG_LINES_TO_READ 行)，行数超过预算时
+# 按 (状态码类别, 客户端 IP, 路径前缀) 分层做蓄水池抽样，样本行数不超过 LOG_LINES_TO_READ，
+# 真实总量、各状态码计数和抽样率会作为窗口头部发送给模型
+ENABLE_TRAFFIC_SAMPLING = False
+# 启用抽样的日志类型
+SAMPLING_LOG_TYPES = ("nginx_access",)
+# 单次最多读取的字节数 (间隔内日志超过该大小时只读取最后这部分)
+SAMPLING_MAX_BYTES = 64 * 1024 * 1024
+# 每个分层保留的候选记录数
+SAMPLING_RESERVOIR_SIZE = 4
+# 分层数上限，超出后新 IP 合并到同一状态码类别 / 路径前缀的公共层
+SAMPLING_MAX_STRATA = 2048
+# (状态码类别, 路径前缀) 组合在间隔内出现不超过该次数时视为稀有，全部选入
+SAMPLING_RARE_THRESHOLD = 2
+# 非常规方法 / 5xx 等必选记录最多占用的行数 (None 表示预算的一半)；命中攻击特征的记录优先选入且不受此限制，最多占满整个预算
+SAMPLING_ALWAYS_INCLUDE_MAX = None
+# 访问日志解析进紧凑的列式存储 (IP / 方法 / 路径前缀 / User-Agent 字典编码，时间戳与状态码为整数，不保留行文本)，
+# 整个间隔的数十万条记录只占用数十 MB；抽样选中的记录再按偏移从文件中读取
+SAMPLING_COLUMNAR_STORE = True
+# 列式存储中每个字典最多保存的不重复值个数 (超出后新值统一记为 "*")
+SAMPLING_MAX_DISTINCT_VALUES = 262144
+
 # ==================== Gemini API 详细配置 ====================
 # Gemini API 与模型相关配置
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent"
@@ -55,6 +85,30 @@ GEMINI_API_LOG_PATH = AI_API_LOG_PATH     # 向后兼容
 # 如果在其他系统上运行或不希望进行此检测，可以将其设置为 False。
 ENABLE_NGINX_STATUS_CHECK = False
 
+# ==================== 运行状态监控配置 ====================
+# 是否启用 nginx / php-fpm 运行状态监控 (直接读取 /proc，不启动外部进程；非 Linux 系统自动禁用)
+# 采样结果保留为时间序列写入报告，并在指标偏离基线时提高日志窗口的异常评分
+# 默认关闭: 在容器或只收集日志的主机上看不到 nginx 进程。"nginx 未运行" 告警另外需要 ENABLE_NGINX_STATUS_CHECK = True
+ENABLE_HEALTH_MONITOR = False
+# 常驻模式下的采样间隔 (秒)
+HEALTH_POLL_INTERVAL_SECONDS = 15
+# 保留的样本数
+HEALTH_HISTORY_SAMPLES = 360
+# nginx 应监听的端口 (无权限读取 nginx 进程的 fd 时，以这些端口是否在监听作为判断依据)
+HEALTH_EXPECTED_PORTS = (80, 443)
+# Nginx stub_status 地址 (需在 nginx 中配置 stub_status，仅允许本机访问)，None 表示不轮询
+# 例如 "http://127.0.0.1/nginx_status"
+NGINX_STUB_STATUS_URL = None
+# php-fpm 状态页地址 (pm.status_path，需带 ?json)，None 表示不轮询
+# 例如 "http://127.0.0.1/fpm-status?json"
+PHP_FPM_STATUS_URL = None
+# 运行指标相对 EWMA 基线的 z-score 达到该值时告警
+HEALTH_ZSCORE_THRESHOLD = 4.0
+# php-fpm 监听队列长度达到该值时告警 (0 表示不告警)
+HEALTH_FPM_QUEUE_THRESHOLD = 1
+# 同一类健康告警的冷却时间 (秒)
+HEALTH_ALERT_COOLDOWN_SECONDS = 600
+
 # 代理服务器配置 (可选)
 # 如果您的服务器需要通过代理访问外部网络 (例如 Google API)，请在此处配置。
 # 将下面的 "your_proxy_address" 和 "port" 替换为您的实际代理服务器地址和端口。
@@ -69,4 +123,194 @@ PROXIES = None
 # PROXIES = {
 #    "http": "socks5h://127.0.0.1:10808", # socks5h 表示通过代理进行 DNS 解析
 #    "https": "socks5h://127.0.0.1:10808",
-# }
\ No newline at end of file
+# }
+# ==================== 历史日志回填配置 (backfill.py) ====================
+# 时间分区长度 (分钟)，回填时按该粒度对日志分段
+BACKFILL_PARTITION_MINUTES = 60
+# 解析/预过滤使用的进程数，None 表示使用全部 CPU 核
+BACKFILL_WORKERS = None
+# 同时在途的 AI API 请求上限
+BACKFILL_CONCURRENCY = 2
+# 每个时间分区最多保留的可疑日志行数，防止单个分区过大
+BACKFILL_MAX_LINES_PER_PARTITION = 2000
+# 断点文件路径，中断后重新运行会跳过已完成的日志块
+BACKFILL_CHECKPOINT_PATH = "/www/wwwroot/yanshanlaosiji.top/NginxPhpAIScanner/backfill_checkpoint.json"
+
+# ==================== 跨扫描去重配置 ====================
+# 是否启用日志行/发现指纹去重: 已分析过的日志行不再重复发送，重复的发现在报告中折叠显示
+ENABLE_FINDING_DEDUP = True
+# 指纹存储文件路径 (重启后保留)
+FINGERPRINT_STORE_PATH = "/www/wwwroot/yanshanlaosiji.top/NginxPhpAIScanner/fingerprints.json"
+# 指纹过期时间 (秒)，超过该时间未再出现的指纹会被淘汰
+FINGERPRINT_TTL_SECONDS = 86400
+# 指纹存储容量上限，超出后淘汰最久未出现的条目
+FINGERPRINT_MAX_ENTRIES = 50000
+
+# ==================== 本地异常评分配置 ====================
+# 是否在调用 AI 之前进行本地异常评分，仅在评分超过阈值时调用 AI
+ENABLE_ANOMALY_GATE = True
+# 窗口异常评分阈值 (近似 z 分数)，低于该值的窗口不调用 AI
+ANOMALY_SCORE_THRESHOLD = 3.0
+# 基线预热窗口数，预热期间所有窗口都会送去 AI 分析
+ANOMALY_WARMUP_WINDOWS = 3
+# 全局指标 (请求速率、4xx/5xx 比例、路径熵) 的 EWMA 平滑系数
+ANOMALY_EWMA_ALPHA = 0.2
+# 每个窗口对 IP/URI 前缀/UA 历史频次的衰减系数
+ANOMALY_SKETCH_DECAY = 0.9
+# 每个维度在窗口内跟踪的高频键数量 (Top-K)
+ANOMALY_TOP_K = 32
+# 超过阈值时最多发送的日志行数 (按异常程度选取)
+ANOMALY_MAX_LINES_TO_SEND = LOG_LINES_TO_READ
+
+# ==================== 本地滑动窗口检测器配置 ====================
+# 是否启用无需 AI 的确定性检测器 (登录暴力破解、目录枚举、php-fpm max_children 饱和)
+ENABLE_LOCAL_DETECTORS = True
+# 登录端点路径 (正则)，同一 IP 在窗口内 POST 次数达到阈值即告警
+DETECTOR_LOGIN_PATH_PATTERN = r"wp-login\.php|xmlrpc\.php"
+DETECTOR_BRUTE_FORCE_WINDOW_SECONDS = 60
+DETECTOR_BRUTE_FORCE_THRESHOLD = 10
+# 同一 IP 在窗口内 404 次数达到阈值即视为目录枚举
+DETECTOR_404_WINDOW_SECONDS = 60
+DETECTOR_404_THRESHOLD = 30
+# php-fpm 在窗口内出现 max_children / seems busy 告警的次数阈值
+DETECTOR_FPM_WINDOW_SECONDS = 60
+DETECTOR_FPM_THRESHOLD = 1
+# 同一对象 (IP / 进程池) 重复告警的冷却时间 (秒)
+DETECTOR_COOLDOWN_SECONDS = 300
+# 检测器按自己的偏移处理自上次检测以来的每一个新行 (不受 LOG_LINES_TO_READ 与抽样限制)，单次最多读取的字节数
+DETECTOR_MAX_BYTES = 64 * 1024 * 1024
+
+# ==================== 提示缓存配置 ====================
+# 是否启用提示缓存: 系统提示作为稳定前缀缓存在提供商侧，减少每次请求的预填充时间和费用
+ENABLE_PROMPT_CACHE = True
+# Gemini 是否为系统提示创建显式缓存 (cachedContents)。显式缓存要求前缀达到模型的最小缓存长度
+# (Gemini 2.5 Flash 为 1024 tokens，Pro 更高)，内置系统提示只有约 100 tokens，因此默认关闭
+# (Gemini 2.5 对重复前缀另有隐式缓存)；使用较长的自定义系统提示时再开启
+GEMINI_EXPLICIT_CACHE = False
+# 估算长度低于该 token 数的系统提示不创建显式缓存，直接内联发送
+GEMINI_CACHE_MIN_TOKENS = 1024
+# Gemini cachedContents 的 TTL (秒)，临近过期时自动续期，服务停止时删除
+GEMINI_CACHE_TTL_SECONDS = 3600
+# OpenRouter 是否在系统消息上添加 cache_control 缓存断点 (不支持的模型会自动回退)
+OPENROUTER_PROMPT_CACHE = True
+
+# ==================== 批量请求配置 ====================
+# 是否把多个日志来源打包为一次多分段请求 (每个分段带标签，响应按分段拆回各日志类型)
+BATCH_REQUESTS = True
+# 单次批量请求中 Base64 日志数据的最大总字符数，超出时拆分为多个批次
+BATCH_MAX_CHARS = 60000
+# 单次批量请求的最大分段数
+BATCH_MAX_SECTIONS = 8
+# 批量请求的最大输出 tokens (None 表示沿用各提供商的默认设置)
+BATCH_MAX_OUTPUT_TOKENS = 4096
+
+# ==================== 紧凑输出配置 ====================
+# 是否启用紧凑输出模式: 模型只返回类别代码、严重性缩写和日志行序号，由本地回填描述与日志行
+# 结构由 Gemini responseSchema / OpenRouter json_schema 强制约束 (不支持 json_schema 的模型自动回退为 json_object)
+COMPACT_OUTPUT_MODE = True
+# 紧凑模式下单个分段的最大输出 tokens (批量请求按分段数累加)
+COMPACT_MAX_OUTPUT_TOKENS = 1024
+
+# ==================== 扫描调度配置 ====================
+# 扫描按固定速率的节拍开始 (单调时钟)，扫描耗时不会累积为周期漂移
+# 扫描超过间隔 (错过下一个节拍) 时的处理策略:
+#   "skip"     - 放弃错过的节拍，等待下一个节拍
+#   "coalesce" - 错过的节拍合并为一次，立即执行
+#   "reduce"   - 立即执行，但读取行数与截止时间按 SCAN_REDUCED_BUDGET_FACTOR 缩减
+SCAN_OVERRUN_POLICY = "coalesce"
+SCAN_REDUCED_BUDGET_FACTOR = 0.5
+# 每轮扫描的截止时间 (秒)，None 表示等于 SCAN_INTERVAL_SECONDS。到期后进行中的提供商请求被放弃且不再重试，尚未发出的分析请求被取消
+# (启用待分析队列时这些窗口写入队列，稍后重放)
+SCAN_DEADLINE_SECONDS = None
+# 节拍的随机抖动上限 (秒)，避免同时启动的多台服务器同步请求提供商；0 表示不抖动
+SCAN_JITTER_SECONDS = 5
+
+# ==================== 单次运行模式配置 ====================
+# python main.py --once 的状态快照路径 (gzip 压缩的 JSON)，保存读取偏移、异常评分基线、检测器计数和提示缓存
+STATE_SNAPSHOT_PATH = "/www/wwwroot/yanshanlaosiji.top/NginxPhpAIScanner/state_snapshot.json.gz"
+
+# ==================== 待分析队列配置 ====================
+# 是否启用磁盘待分析队列: 提供商暂时不可用 (超时、网络错误、HTTP 429 / 5xx、扫描截止) 时日志窗口写入只追加的段文件，
+# 提供商恢复后按有限并发重放，避免只读取日志末尾时窗口在断连期间永久丢失。缺少 API Key 等配置错误与输出解析失败不写入队列
+ENABLE_ANALYSIS_SPOOL = True
+# 段文件目录
+SPOOL_DIR = "/www/wwwroot/yanshanlaosiji.top/NginxPhpAIScanner/spool"
+# 单个段文件的最大字节数，超过后切换到新段
+SPOOL_SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+# 队列总大小上限 (字节)，超出时丢弃最旧的段并给出警告
+SPOOL_MAX_BYTES = 256 * 1024 * 1024
+# fsync 策略: "always" (每条记录都落盘) / "interval" (最多每 SPOOL_FSYNC_INTERVAL_SECONDS 秒落盘一次) / "never" (交给操作系统)
+SPOOL_FSYNC_POLICY = "interval"
+SPOOL_FSYNC_INTERVAL_SECONDS = 1.0
+# 重放积压窗口时的最大并发请求数
+SPOOL_DRAIN_CONCURRENCY = 2
+# 每轮扫描最多重放的积压窗口数
+SPOOL_DRAIN_MAX_ITEMS = 20
+# 单个窗口重放失败达到该次数后放弃，并在报告中记录错误
+SPOOL_MAX_ATTEMPTS = 5
+
+# ==================== 模型分级配置 ====================
+# 是否启用模型分级: 先由快速、廉价的分诊模型为每个日志窗口输出 {"flag", "score"}，
+# 只有评分达到升级阈值 (或分诊失败) 的窗口才交给深度分析模型 (默认即上面配置的模型) 生成完整发现
+ENABLE_MODEL_CASCADE = False
+# 各提供商的分诊模型 (Gemini 为 GEMINI_API_URL 中替换的模型名，OpenRouter 为模型 ID)
+CASCADE_TRIAGE_MODEL = {
+    "gemini": "gemini-2.0-flash-lite",
+    "openrouter": "google/gemini-2.0-flash-lite-001",
+}
+# 默认升级阈值 (分诊评分 0-100，达到该值即升级)
+CASCADE_ESCALATE_SCORE = 40
+# 按日志类型覆盖分级设置，可用键:
+#   enabled: False 表示该类型跳过分诊直接深度分析
+#   triage_model / analysis_model: 模型名，或按提供商区分的字典 {"gemini": ..., "openrouter": ...}；None 表示默认模型
+#   escalate_score: 升级阈值
+CASCADE_LOG_TYPE_SETTINGS = {
+    "nginx_access": {"escalate_score": 50},   # 访问日志以正常流量为主，提高阈值
+    "nginx_error": {"escalate_score": 30},
+    "php_fpm": {"escalate_score": 30},
+}
+
+# ==================== 扫描流水线配置 ====================
+# 每轮扫描按 tail → parse → filter → chunk → analyze → sink 流水线执行，阶段之间由有界队列连接 (队列满时上游阻塞)
+# 各阶段的工作线程数。parse / filter 会更新检测器与异常基线的内部状态，保持 1 个线程
+PIPELINE_WORKERS = {
+    "tail": 3,      # 读取日志文件 (I/O)
+    "parse": 1,
+    "filter": 1,
+    "chunk": 1,
+    "analyze": 2,   # 并发的 AI 请求数
+}
+# 阶段之间的队列容量
+PIPELINE_QUEUE_SIZE = 16
+# analyze 阶段凑批的最长等待时间 (秒)；批大小上限为 BATCH_MAX_SECTIONS (BATCH_REQUESTS 关闭时为 1)
+PIPELINE_BATCH_LINGER_SECONDS = 0.2
+# 单个待分析项的最大行数，超过时在记录边界处切分为多个分段 (0 表示不切分)
+PIPELINE_CHUNK_LINES = 0
+
+# ==================== 告警通知配置 ====================
+# 是否启用告警通知: 达到 ALERT_MIN_SEVERITY 的发现在扫描过程中异步推送，不必等人打开报告
+ENABLE_ALERTS = False
+# 触发告警的最低严重性: critical / high / medium / low / info
+ALERT_MIN_SEVERITY = "high"
+# 只通知首次出现的发现 (跨扫描重复出现的发现只在报告中累计次数)
+ALERT_ONLY_NEW_FINDINGS = True
+# 带 dedup_key 的发现 (本地检测器、运行状态监控) 在该时间 (秒) 内只通知一次 (ALERT_ONLY_NEW_FINDINGS 开启时生效，
+# 不依赖指纹存储，指纹存储未启用时同样去重)
+ALERT_DEDUP_SECONDS = 3600
+# 合并窗口 (秒): 第一个发现到达后等待该时间，窗口内的发现合并为一条聚合告警
+ALERT_COALESCE_SECONDS = 10
+# 通知渠道列表。每个渠道可额外指定 name / min_severity / rate_per_minute (默认 6) / burst (默认 3) / max_findings (默认 20)
+ALERT_SINKS = [
+    # {"type": "webhook", "url": "https://example.com/hooks/scanner", "headers": {"Authorization": "Bearer xxx"}},
+    # {"type": "syslog", "address": "/dev/log", "facility": "auth"},             # journald 同样监听 /dev/log
+    # {"type": "smtp", "host": "localhost", "port": 25, "recipients": ["root@localhost"], "min_severity": "critical"},
+    # {"type": "command", "command": ["/usr/local/bin/scanner-alert.sh"]},       # 告警 JSON 写入标准输入
+]
+# 发送失败时的指数退避重试: 初始间隔、最大间隔 (秒) 与最大重试次数
+ALERT_RETRY_BASE_SECONDS = 5
+ALERT_RETRY_MAX_SECONDS = 300
+ALERT_MAX_RETRIES = 8
+# 等待合并的发现队列容量 (满时丢弃新的发现并计数)
+ALERT_MAX_QUEUE = 1000
+# 单次运行模式退出 / 服务停止时等待告警发送完毕的最长时间 (秒)
+ALERT_FLUSH_TIMEOUT_SECONDS = 15
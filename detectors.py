@@ -0,0 +1,234 @@
+# detectors.py
+"""
+无需 AI 的确定性滑动窗口检测器。
+
+每个检测器按键 (IP、php-fpm 进程池等) 维护一个环形缓冲计数器，计数在窗口内超过阈值时
+立即生成与报告相同结构的发现 ({"severity", "description", "recommendation", "log_lines"})。
+同一键在冷却时间内只告警一次。
+"""
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import log_parser
+
+
+class RingCounter:
+    """按时间分桶的环形计数器，用于统计最近 window_seconds 秒内的事件数"""
+
+    __slots__ = ("bucket_seconds", "counts", "epochs")
+
+    def __init__(self, window_seconds, bucket_seconds=5):
+        size = max(1, int(math.ceil(window_seconds / bucket_seconds)))
+        self.bucket_seconds = bucket_seconds
+        self.counts = [0] * size
+        self.epochs = [-1] * size
+
+    def add(self, ts, amount=1):
+        epoch = int(ts // self.bucket_seconds)
+        index = epoch % len(self.counts)
+        if self.epochs[index] != epoch:
+            # 该桶属于已滑出窗口的旧时间段，重置后复用
+            self.epochs[index] = epoch
+            self.counts[index] = 0
+        self.counts[index] += amount
+
+    def total(self, ts):
+        epoch = int(ts // self.bucket_seconds)
+        oldest = epoch - len(self.counts)
+        return sum(count for count, bucket in zip(self.counts, self.epochs) if oldest < bucket <= epoch)
+
+
+class SlidingWindowDetector:
+    """滑动窗口检测器基类，子类实现 match() 和 describe()"""
+
+    name = "base"
+    category = "other"
+    severity = "medium"
+    log_types = ()
+
+    def __init__(self, window_seconds=60, threshold=10, cooldown_seconds=300, max_keys=10000, bucket_seconds=5):
+        self.window_seconds = window_seconds
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.max_keys = max_keys
+        self.bucket_seconds = min(bucket_seconds, window_seconds)
+        self._state = OrderedDict()  # 键 -> [RingCounter, 最近样本行, 上次告警时间]
+
+    def match(self, record, line):
+        """返回事件对应的键，不相关的行返回 None"""
+        raise NotImplementedError
+
+    def describe(self, key, count):
+        """返回 (描述, 建议)"""
+        raise NotImplementedError
+
+    def feed(self, record, line, ts):
+        key = self.match(record, line)
+        if key is None:
+            return None
+        state = self._state.get(key)
+        if state is None:
+            state = [RingCounter(self.window_seconds, self.bucket_seconds), deque(maxlen=5), None]
+            self._state[key] = state
+            if len(self._state) > self.max_keys:
+                self._state.popitem(last=False)
+        else:
+            self._state.move_to_end(key)
+        counter, samples, last_alert = state
+        counter.add(ts)
+        samples.append(line.rstrip('\n'))
+        count = counter.total(ts)
+        if count < self.threshold or (last_alert is not None and ts - last_alert < self.cooldown_seconds):
+            return None
+        state[2] = ts
+        description, recommendation = self.describe(key, count)
+        return {
+            "severity": self.severity,
+            "category": self.category,
+            "description": description,
+            "recommendation": recommendation,
+            "log_lines": list(samples),
+            "detector": self.name,
+            "dedup_key": f"{self.name}:{key}",
+        }
+
+    def to_dict(self):
+        """导出各键的计数桶、样本行和上次告警时间，用于跨进程持久化"""
+        return {"state": [[key, list(counter.counts), list(counter.epochs), list(samples), last_alert]
+                          for key, (counter, samples, last_alert) in self._state.items()]}
+
+    def load_dict(self, data):
+        for key, counts, epochs, samples, last_alert in data.get("state", []):
+            counter = RingCounter(self.window_seconds, self.bucket_seconds)
+            if len(counts) == len(counter.counts):
+                counter.counts, counter.epochs = counts, epochs
+            self._state[key] = [counter, deque(samples, maxlen=5), last_alert]
+        while len(self._state) > self.max_keys:
+            self._state.popitem(last=False)
+        return self
+
+
+class LoginBruteForceDetector(SlidingWindowDetector):
+    """同一 IP 短时间内大量 POST 登录端点 (wp-login.php / xmlrpc.php 等)"""
+
+    name = "login_brute_force"
+    category = "brute_force"
+    severity = "high"
+    log_types = ("nginx_access",)
+
+    def __init__(self, path_pattern=r"wp-login\.php|xmlrpc\.php", **kwargs):
+        super().__init__(**kwargs)
+        self.path_re = re.compile(path_pattern, re.IGNORECASE)
+
+    def match(self, record, line):
+        if record and record["method"] == "POST" and self.path_re.search(record["path"]):
+            return record["ip"]
+        return None
+
+    def describe(self, key, count):
+        return (f"IP {key} 在 {self.window_seconds} 秒内向登录/XML-RPC 端点发送了 {count} 次 POST 请求，疑似暴力破解。",
+                f"在防火墙或 Nginx 中封禁 {key}，并对登录端点启用限速 (limit_req) 或禁用 xmlrpc.php。")
+
+
+class DirectoryEnumerationDetector(SlidingWindowDetector):
+    """同一 IP 短时间内产生大量 404，疑似目录/文件枚举"""
+
+    name = "directory_enumeration"
+    category = "scanning"
+    severity = "medium"
+    log_types = ("nginx_access",)
+
+    def match(self, record, line):
+        if record and record["status"] == 404:
+            return record["ip"]
+        return None
+
+    def describe(self, key, count):
+        return (f"IP {key} 在 {self.window_seconds} 秒内触发了 {count} 次 404，疑似目录枚举扫描。",
+                f"确认 {key} 是否为恶意扫描器，必要时封禁并检查是否有敏感文件 (备份、.env、.git) 暴露。")
+
+
+class FpmSaturationDetector(SlidingWindowDetector):
+    """php-fpm 进程池达到 pm.max_children 上限或繁忙告警"""
+
+    name = "fpm_saturation"
+    category = "availability"
+    severity = "high"
+    log_types = ("php_fpm",)
+
+    _POOL_RE = re.compile(r'\[pool ([^\]]+)\]')
+
+    def match(self, record, line):
+        if "max_children" in line or "seems busy" in line:
+            pool = self._POOL_RE.search(line)
+            return pool.group(1) if pool else "unknown"
+        return None
+
+    def describe(self, key, count):
+        return (f"php-fpm 进程池 {key} 在 {self.window_seconds} 秒内 {count} 次达到 pm.max_children 上限或处于繁忙状态，请求可能排队或超时。",
+                "检查是否存在慢请求或 CC 攻击，必要时调大 pm.max_children 并排查 slowlog。")
+
+
+class DetectorSet:
+    """按日志类型分发日志行到各检测器"""
+
+    def __init__(self, detectors):
+        self.detectors = detectors
+        self._last_ts = {}
+        self._lock = threading.Lock()  # 各日志来源在流水线的不同 tail 线程中处理
+
+    def process_lines(self, log_type, lines):
+        """处理一批日志行，返回新产生的发现列表"""
+        detectors = [detector for detector in self.detectors if log_type in detector.log_types]
+        if not detectors:
+            return []
+        findings = []
+        with self._lock:
+            for line in lines:
+                record = log_parser.parse_access_line(line) if log_type == "nginx_access" else None
+                ts = record["ts"] if record else log_parser.parse_line_timestamp(line, log_type)
+                if ts is None:
+                    ts = self._last_ts.get(log_type) or time.time()
+                self._last_ts[log_type] = ts
+                for detector in detectors:
+                    finding = detector.feed(record, line, ts)
+                    if finding:
+                        findings.append(finding)
+        return findings
+
+    def to_dict(self):
+        return {"last_ts": self._last_ts, "detectors": {detector.name: detector.to_dict() for detector in self.detectors}}
+
+    def load_dict(self, data):
+        self._last_ts.update(data.get("last_ts") or {})
+        states = data.get("detectors") or {}
+        for detector in self.detectors:
+            if detector.name in states:
+                detector.load_dict(states[detector.name])
+        return self
+
+
+def build_default_detectors(config):
+    """根据 config.py 中的 DETECTOR_* 配置创建检测器集合"""
+    cooldown_seconds = getattr(config, "DETECTOR_COOLDOWN_SECONDS", 300)
+    return DetectorSet([
+        LoginBruteForceDetector(
+            path_pattern=getattr(config, "DETECTOR_LOGIN_PATH_PATTERN", r"wp-login\.php|xmlrpc\.php"),
+            window_seconds=getattr(config, "DETECTOR_BRUTE_FORCE_WINDOW_SECONDS", 60),
+            threshold=getattr(config, "DETECTOR_BRUTE_FORCE_THRESHOLD", 10),
+            cooldown_seconds=cooldown_seconds,
+        ),
+        DirectoryEnumerationDetector(
+            window_seconds=getattr(config, "DETECTOR_404_WINDOW_SECONDS", 60),
+            threshold=getattr(config, "DETECTOR_404_THRESHOLD", 30),
+            cooldown_seconds=cooldown_seconds,
+        ),
+        FpmSaturationDetector(
+            window_seconds=getattr(config, "DETECTOR_FPM_WINDOW_SECONDS", 60),
+            threshold=getattr(config, "DETECTOR_FPM_THRESHOLD", 1),
+            cooldown_seconds=cooldown_seconds,
+        ),
+    ])
@@ -0,0 +1,170 @@
+# fingerprint_store.py
+"""
+跨扫描的日志行 / 发现指纹存储 (TTL + LRU，持久化到 JSON 文件)。
+
+- 日志行指纹: 日志类型 + 去除首尾空白后的行内容，用于在重叠的读取窗口中排除已分析过的行。
+- 发现指纹: 日志类型 + 类别 + 归一化后的相关日志行 (或描述)，用于把重复出现的发现折叠为
+  "已出现 N 次，自 T 起"。
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# 归一化时去除的易变片段: 各类时间戳、nginx 进程/连接编号
+_VOLATILE_RES = (
+    re.compile(r'\[\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4}\]'),   # access log
+    re.compile(r'^\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} '),                 # error log
+    re.compile(r'^\[\d{2}-\w{3}-\d{4} \d{2}:\d{2}:\d{2}[^\]]*\] '),       # php-fpm log
+    re.compile(r'\b\d+#\d+: \*\d+ '),                                      # nginx pid#tid: *conn
+)
+
+
+def normalize_line(line):
+    """去除时间戳等易变部分，使同一事件在不同时间的记录得到相同的指纹"""
+    text = line.strip()
+    for pattern in _VOLATILE_RES:
+        text = pattern.sub('', text)
+    return text
+
+
+def _digest(*parts):
+    return hashlib.sha1("\x1f".join(parts).encode('utf-8', 'replace')).hexdigest()[:20]
+
+
+def line_fingerprint(log_type, line):
+    """日志行指纹 (精确匹配，仅忽略首尾空白)"""
+    return "L" + _digest(log_type, line.strip())
+
+
+def finding_fingerprint(log_type, finding):
+    """
+    发现指纹: 类别 (无类别时使用严重性) + 归一化的日志行，缺少日志行时使用描述。
+    本地检测器给出的 dedup_key (如 "login_brute_force:1.2.3.4") 优先于日志行。
+    """
+    category = str(finding.get("category") or finding.get("severity") or "info").lower()
+    log_lines = finding.get("log_lines") or []
+    if finding.get("dedup_key"):
+        body = str(finding["dedup_key"])
+    elif log_lines:
+        body = "\n".join(sorted(normalize_line(str(line)) for line in log_lines))
+    else:
+        body = normalize_line(str(finding.get("description", "")))
+    return "F" + _digest(log_type, category, body)
+
+
+class FingerprintStore:
+    """带 TTL 和容量上限 (LRU 淘汰) 的指纹存储"""
+
+    def __init__(self, path=None, ttl_seconds=86400, max_entries=50000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 指纹 -> [首次时间, 最近时间, 次数]
+        self._lock = threading.RLock()  # 流水线的多个阶段会并发访问
+
+    def load(self):
+        """从文件加载指纹，文件不存在或损坏时以空存储开始"""
+        if not self.path or not os.path.exists(self.path):
+            return self
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 文件中按最近使用时间升序保存，恢复后 LRU 顺序保持不变
+            for key, entry in data.get("entries", []):
+                self._entries[key] = entry
+            self.prune()
+        except Exception as e:
+            print(f"读取指纹存储 {self.path} 失败，将使用空存储: {e}")
+            self._entries.clear()
+        return self
+
+    def save(self):
+        """原子地写回文件"""
+        if not self.path:
+            return
+        self.prune()
+        try:
+            store_dir = os.path.dirname(self.path)
+            if store_dir:
+                os.makedirs(store_dir, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with self._lock:
+                entries = list(self._entries.items())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"saved_at": time.time(), "entries": entries}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"写入指纹存储 {self.path} 失败: {e}")
+
+    def prune(self, now=None):
+        """淘汰过期条目以及超出容量的最久未使用条目"""
+        now = now or time.time()
+        cutoff = now - self.ttl_seconds
+        with self._lock:
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if entry[1] >= cutoff and len(self._entries) <= self.max_entries:
+                    break
+                self._entries.popitem(last=False)
+
+    def get(self, key, now=None):
+        """返回未过期的条目 [首次时间, 最近时间, 次数]，不存在时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[1] < (now or time.time()) - self.ttl_seconds:
+            return None
+        return entry
+
+    def touch(self, key, now=None):
+        """记录一次出现并移到 LRU 末尾，返回更新后的条目"""
+        now = now or time.time()
+        with self._lock:
+            entry = self.get(key, now)
+            if entry is None:
+                entry = [now, now, 0]
+            entry[1] = now
+            entry[2] += 1
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def filter_new_lines(self, log_type, lines):
+        """过滤掉之前已经分析过的日志行"""
+        now = time.time()
+        return [line for line in lines if self.get(line_fingerprint(log_type, line), now) is None]
+
+    def mark_lines(self, log_type, lines):
+        """将日志行标记为已分析"""
+        now = time.time()
+        for line in lines:
+            self.touch(line_fingerprint(log_type, line), now)
+
+    def record_findings(self, log_type, findings):
+        """
+        记录本次的发现并合并重复项。
+        每个保留下来的发现会附带 seen_count / first_seen / fingerprint 字段。
+        :return: 去重后的发现列表。
+        """
+        now = time.time()
+        merged = OrderedDict()
+        for finding in findings:
+            if not isinstance(finding, dict):
+                continue
+            key = finding_fingerprint(log_type, finding)
+            if key in merged:
+                continue  # 同一次响应中的重复发现只计一次
+            entry = self.touch(key, now)
+            finding["fingerprint"] = key
+            finding["seen_count"] = entry[2]
+            finding["first_seen"] = entry[0]
+            merged[key] = finding
+        return list(merged.values())
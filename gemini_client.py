@@ -5,6 +5,14 @@ import time # 新增 time 模块用于重试间隔
 import config # 假设 config.py 仍然在根目录，并且 gemini_client.py 需要访问它
 import datetime
 import os
+import re
+import prompt_cache
+from json_extract import parse_model_output, describe_recovery
+from prompt_cache import gemini_prompt_cache
+from scheduler import current_deadline, call_with_deadline, DeadlineExceeded
+
+# 单日志分析的默认系统提示 (稳定前缀，可被提示缓存)
+SYSTEM_INSTRUCTION_TEXT = """Decode the Base64 log data. Analyze the decoded logs for security issues. Respond ONLY with a single, valid JSON object: {"timestamp": "ISO_timestamp", "log_type": "log_type_analyzed", "findings": [{"severity": "high|medium|low|info", "description": "issue_description", "recommendation": "suggested_action", "log_lines": ["relevant_decoded_log_line"]}], "summary": "overall_analysis_summary"}. If no issues are found, 'findings' must be an empty array."""
 
 def _log_api_call(request_payload, response_data=None, error_message=None):
     """以 JSON Lines 格式记录 Gemini API 调用到日志文件"""
@@ -33,11 +41,41 @@ def _log_api_call(request_payload, response_data=None, error_message=None):
     except Exception as e:
         print(f"写入 Gemini API 日志失败: {e}")
 
-def call_gemini_api(log_data_str, proxies=None):
+def _to_gemini_schema(schema):
+    """把 JSON Schema 转换为 Gemini responseSchema 支持的 OpenAPI 子集 (类型大写，去掉 additionalProperties)"""
+    if isinstance(schema, dict):
+        converted = {}
+        for key, value in schema.items():
+            if key == "additionalProperties":
+                continue
+            if key == "type" and isinstance(value, str):
+                converted[key] = value.upper()
+            elif key == "properties":
+                converted[key] = {name: _to_gemini_schema(sub) for name, sub in value.items()}
+            else:
+                converted[key] = _to_gemini_schema(value)
+        return converted
+    if isinstance(schema, list):
+        return [_to_gemini_schema(item) for item in schema]
+    return schema
+
+def _api_url_for_model(model):
+    """把 GEMINI_API_URL 中的模型名替换为指定模型 (模型分级时使用)"""
+    if not model:
+        return config.GEMINI_API_URL
+    model = model[len("models/"):] if model.startswith("models/") else model
+    return re.sub(r'/models/[^:/]+:', f'/models/{model}:', config.GEMINI_API_URL, count=1)
+
+def call_gemini_api(log_data_str, proxies=None, system_instruction_text=None, user_prompt_prefix=None, max_output_tokens=None, response_schema=None, model=None):
     """
     调用 Gemini API 并获取分析结果。
     :param log_data_str: 要分析的日志数据字符串。
     :param proxies: 可选的代理配置字典，例如 {"http": "http://127.0.0.1:10809", "https": "http://127.0.0.1:10809"}
+    :param system_instruction_text: 可选的系统提示，默认使用单日志分析提示 SYSTEM_INSTRUCTION_TEXT。
+    :param user_prompt_prefix: 可选的用户消息前缀 (位于日志数据之前)。
+    :param max_output_tokens: 可选的 maxOutputTokens，默认按 GEMINI_MAX_OUTPUT_TOKENS 动态调整。
+    :param response_schema: 可选的输出 JSON Schema，通过 generationConfig.responseSchema 强制约束输出结构。
+    :param model: 可选的模型覆盖 (模型分级时使用)，默认使用 GEMINI_API_URL 中的模型。
     :return: API 分析结果或错误信息。
     """
     if not config.GEMINI_API_KEY or config.GEMINI_API_KEY == "YOUR_GEMINI_API_KEY":
@@ -48,7 +86,8 @@ def call_gemini_api(log_data_str, proxies=None):
         return None
 
     # generativelanguage.googleapis.com 端点使用 API Key 作为 URL 参数
-    api_url_with_key = f"{config.GEMINI_API_URL}?key={config.GEMINI_API_KEY}"
+    api_url = _api_url_for_model(model)
+    api_url_with_key = f"{api_url}?key={config.GEMINI_API_KEY}"
 
     headers = {
         "Content-Type": "application/json",
@@ -56,14 +95,18 @@ def call_gemini_api(log_data_str, proxies=None):
 
     # 日志分析的 system_instruction 和 user prompt
     # 对于 generativelanguage.googleapis.com, 使用 system_instruction
-    system_instruction_text = """Decode the Base64 log data. Analyze the decoded logs for security issues. Respond ONLY with a single, valid JSON object: {"timestamp": "ISO_timestamp", "log_type": "log_type_analyzed", "findings": [{"severity": "high|medium|low|info", "description": "issue_description", "recommendation": "suggested_action", "log_lines": ["relevant_decoded_log_line"]}], "summary": "overall_analysis_summary"}. If no issues are found, 'findings' must be an empty array."""
+    system_instruction_text = system_instruction_text or SYSTEM_INSTRUCTION_TEXT
+    if user_prompt_prefix is None:
+        user_prompt_prefix = "请分析以下日志数据：\n\n"
 
     # 动态调整 maxOutputTokens
     # 目标设为 8192，除非配置中已设置更高且合理的值
     configured_max_tokens = getattr(config, 'GEMINI_MAX_OUTPUT_TOKENS', 2048) # 默认2048以防万一未配置
     target_max_output_tokens = 8192
 
-    if configured_max_tokens > target_max_output_tokens and configured_max_tokens <= 8192: # 如果配置值在合理范围内且大于我们的目标
+    if max_output_tokens:
+        effective_max_output_tokens = max_output_tokens
+    elif configured_max_tokens > target_max_output_tokens and configured_max_tokens <= 8192: # 如果配置值在合理范围内且大于我们的目标
         effective_max_output_tokens = configured_max_tokens
     else:
         effective_max_output_tokens = target_max_output_tokens
@@ -75,6 +118,11 @@ def call_gemini_api(log_data_str, proxies=None):
             print(f"       本次调用将使用 {effective_max_output_tokens} 作为 maxOutputTokens。")
 
 
+    # 系统提示是稳定前缀，可放入提示缓存；用户消息只包含每次变化的日志数据
+    cache_name = None
+    if prompt_cache.gemini_cache_enabled():
+        cache_name = gemini_prompt_cache.get(system_instruction_text, api_url, config.GEMINI_API_KEY, proxies=proxies)
+
     payload = {
         "system_instruction": {
             "parts": [{"text": system_instruction_text}]
@@ -82,7 +130,7 @@ def call_gemini_api(log_data_str, proxies=None):
         "contents": [
             {
                 "role": "user",
-                "parts": [{"text": f"请分析以下日志数据：\n\n{log_data_str}"}]
+                "parts": [{"text": f"{user_prompt_prefix}{log_data_str}"}]
             }
         ],
         "generationConfig": {
@@ -96,6 +144,12 @@ def call_gemini_api(log_data_str, proxies=None):
             {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
         ]
     }
+    if response_schema:
+        payload["generationConfig"]["responseSchema"] = _to_gemini_schema(response_schema)
+    if cache_name:
+        # 使用缓存时系统提示已包含在 cachedContent 中，不能再重复发送
+        del payload["system_instruction"]
+        payload["cachedContent"] = cache_name
 
     try:
         # 定义重试参数
@@ -106,53 +160,92 @@ def call_gemini_api(log_data_str, proxies=None):
 
         for attempt in range(max_retries):
             try:
+                deadline = current_deadline()
+                if deadline is not None and deadline.expired():
+                    print("Gemini: 本轮扫描已到截止时间，取消请求。")
+                    return {"error": "Scan deadline exceeded; request cancelled.", "deadline_exceeded": True}
+                request_timeout = deadline.clamp((connect_timeout, read_timeout)) if deadline is not None else (connect_timeout, read_timeout)
                 # 在发送请求前记录 (每次尝试都记录)
                 if config.LOG_GEMINI_API_CALLS:
                     _log_api_call(request_payload=payload) # 注意：如果重试，这会记录多次请求体
 
                 print(f"尝试调用 Gemini API (第 {attempt + 1}/{max_retries} 次)...")
-                response = requests.post(
+                response = call_with_deadline(
+                    deadline,
+                    requests.post,
                     api_url_with_key,
                     headers=headers,
                     json=payload,
-                    timeout=(connect_timeout, read_timeout), # 使用元组设置连接和读取超时
+                    timeout=request_timeout, # 使用元组设置连接和读取超时 (按本轮扫描的截止时间收紧)
                     proxies=proxies
                 )
+                if payload.get("cachedContent") and response.status_code in (400, 403, 404):
+                    # 缓存已过期/被删除或不被接受: 回退为内联系统提示并立即重发
+                    print(f"Gemini: 提示缓存 {payload['cachedContent']} 不可用 (HTTP {response.status_code})，改为内联发送系统提示。")
+                    gemini_prompt_cache.invalidate(payload.pop("cachedContent"))
+                    payload["system_instruction"] = {"parts": [{"text": system_instruction_text}]}
+                    response = call_with_deadline(
+                        deadline,
+                        requests.post,
+                        api_url_with_key,
+                        headers=headers,
+                        json=payload,
+                        timeout=request_timeout,
+                        proxies=proxies
+                    )
                 response.raise_for_status() # 如果状态码是 4xx 或 5xx，则抛出 HTTPError
                 
                 response_json = response.json()
                 # 如果请求成功，跳出重试循环
                 break
+            except DeadlineExceeded as e:
+                # 请求超时只限制单次读取，整个请求 (含回退重发) 超过本轮扫描截止时间时放弃
+                print("Gemini: 请求超过本轮扫描截止时间，已放弃。")
+                if config.LOG_GEMINI_API_CALLS:
+                    _log_api_call(request_payload=payload, error_message=f"Attempt {attempt + 1} DeadlineExceeded: {e}")
+                return {"error": "Scan deadline exceeded; request cancelled.", "deadline_exceeded": True}
             except requests.exceptions.Timeout as e:
                 error_msg = f"调用 Gemini API 时发生超时 (尝试 {attempt + 1}/{max_retries}): {e}"
                 print(error_msg)
                 if config.LOG_GEMINI_API_CALLS:
                     # 为特定尝试记录错误
                     _log_api_call(request_payload=payload, error_message=f"Attempt {attempt + 1} Timeout: {e}")
+                if attempt < max_retries - 1 and deadline is not None and deadline.remaining() <= retry_delay_seconds:
+                    print("本轮扫描剩余时间不足以重试，放弃。")
+                    return {"error": f"API request failed and the scan deadline leaves no time to retry: {e}", "deadline_exceeded": True}
                 if attempt < max_retries - 1:
                     print(f"{retry_delay_seconds} 秒后重试...")
                     time.sleep(retry_delay_seconds)
                 else:
                     print("已达到最大重试次数，放弃。")
-                    return {"error": f"API request failed after {max_retries} attempts due to timeout: {e}"}
+                    return {"error": f"API request failed after {max_retries} attempts due to timeout: {e}", "transport_error": True}
             except requests.exceptions.RequestException as e: # 其他网络相关错误
                 error_msg = f"调用 Gemini API 时发生网络错误 (尝试 {attempt + 1}/{max_retries}): {e}"
                 print(error_msg)
                 if config.LOG_GEMINI_API_CALLS:
                      _log_api_call(request_payload=payload, error_message=f"Attempt {attempt + 1} RequestException: {e}")
+                if attempt < max_retries - 1 and deadline is not None and deadline.remaining() <= retry_delay_seconds:
+                    print("本轮扫描剩余时间不足以重试，放弃。")
+                    return {"error": f"API request failed and the scan deadline leaves no time to retry: {e}", "deadline_exceeded": True}
                 if attempt < max_retries - 1:
                     # 对于某些错误 (例如 DNS 解析失败), 立即重试可能没有意义，但这里为了简单统一处理
                     print(f"{retry_delay_seconds} 秒后重试...")
                     time.sleep(retry_delay_seconds)
                 else:
                     print("已达到最大重试次数，放弃。")
-                    return {"error": f"API request failed after {max_retries} attempts: {e}"}
+                    # 网络错误与 HTTP 错误 (带状态码) 都标记为传输错误，由 spool.is_provider_outage 判断是否为提供商故障
+                    return {"error": f"API request failed after {max_retries} attempts: {e}", "transport_error": True,
+                            "status_code": getattr(getattr(e, "response", None), "status_code", None)}
         else:
             # 如果循环正常结束 (例如 break 未执行，理论上不应该到这里，因为上面已经 return 了)
             # 但作为保险，如果循环结束而 response 未定义
             return {"error": "API request failed after all retries without a definitive success or specific error."}
 
 
+        usage = response_json.get("usageMetadata") or {}
+        if usage.get("cachedContentTokenCount"):
+            print(f"Gemini: 命中提示缓存 {usage['cachedContentTokenCount']} tokens (输入共 {usage.get('promptTokenCount')} tokens)。")
+
         # 检查是否有候选内容以及 finishReason
         if not response_json.get("candidates") or not response_json["candidates"]:
             error_msg = f"Gemini API 响应中缺少 'candidates'。响应: {response_json}"
@@ -172,49 +265,26 @@ def call_gemini_api(log_data_str, proxies=None):
             
             model_output_text = candidate["content"]["parts"][0]["text"]
             
-            # 增强 JSON 清理逻辑，参考 openrouter_client.py
-            cleaned_text = model_output_text.strip()
-
-            # 检查是否被 ```json 和 ``` 包装
-            if cleaned_text.startswith("```json") and cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[7:-3].strip()
-                print("Gemini: 检测到 markdown 'json' 代码块，已清理。")
-            elif cleaned_text.startswith("```") and cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[3:-3].strip()
-                print("Gemini: 检测到无标识 markdown 代码块，已清理。")
-            
-            # 进一步清理可能残余的语言标识符，例如 "json\n{...}"
-            # Gemini 通常不会有这个前缀，但为了稳健性可以保留
-            if cleaned_text.lower().startswith("json"):
-                first_bracket = cleaned_text.find('{')
-                first_square_bracket = cleaned_text.find('[')
-                
-                start_index = -1
-                if first_bracket != -1 and first_square_bracket != -1:
-                    start_index = min(first_bracket, first_square_bracket)
-                elif first_bracket != -1:
-                    start_index = first_bracket
-                elif first_square_bracket != -1:
-                    start_index = first_square_bracket
-                
-                if start_index != -1:
-                    cleaned_text = cleaned_text[start_index:]
-                    print(f"Gemini: 检测到前缀语言标识符，已清理。处理后文本前缀: {cleaned_text[:30]}...")
-
-            try:
-                parsed_model_output = json.loads(cleaned_text)
+            # 使用共享的容错 JSON 提取器: 去除包装、修复截断输出并校验发现结构
+            parsed_model_output, parse_info = parse_model_output(model_output_text)
+            if parsed_model_output is not None:
+                if parse_info.get("repaired") or parse_info.get("stripped_wrapper"):
+                    recovery_note = describe_recovery(parse_info)
+                    print(f"Gemini: {recovery_note}")
+                    if parse_info.get("repaired"):
+                        parsed_model_output["parse_recovery"] = recovery_note
                 if config.LOG_GEMINI_API_CALLS:
-                    _log_api_call(request_payload=payload, response_data={"parsed_model_output": parsed_model_output, "raw_api_response": response_json, "original_model_text": model_output_text})
+                    _log_api_call(request_payload=payload, response_data={"parsed_model_output": parsed_model_output, "raw_api_response": response_json, "original_model_text": model_output_text, "parse_info": parse_info})
                 # 如果因为MAX_TOKENS完成，也附加一个警告
                 if finish_reason == "MAX_TOKENS":
                     parsed_model_output["warning_finish_reason"] = "MAX_TOKENS: Response might be truncated."
                 return parsed_model_output
-            except json.JSONDecodeError as e:
-                error_msg = f"Gemini API 返回的文本不是有效的 JSON 格式。原始文本: {model_output_text}. 清理后文本: {cleaned_text}. Error: {e}"
+            else:
+                error_msg = f"Gemini API 返回的文本无法提取出有效的 JSON 结果。原始文本: {model_output_text}. Error: {parse_info.get('error')}"
                 print(error_msg)
-                error_detail = {"error": "Invalid JSON response from model", "raw_output": model_output_text, "cleaned_output": cleaned_text, "finish_reason": finish_reason}
+                error_detail = {"error": "Invalid JSON response from model", "raw_output": model_output_text, "parse_info": parse_info, "finish_reason": finish_reason}
                 if config.LOG_GEMINI_API_CALLS:
-                    _log_api_call(request_payload=payload, response_data={"raw_api_response": response_json, "model_text_output": model_output_text, "cleaned_text": cleaned_text}, error_message=error_msg)
+                    _log_api_call(request_payload=payload, response_data={"raw_api_response": response_json, "model_text_output": model_output_text, "parse_info": parse_info}, error_message=error_msg)
                 return error_detail
         elif finish_reason == "MAX_TOKENS":
             error_msg = f"Gemini API 响应因 MAX_TOKENS 而截断，且未能提取有效文本内容。响应: {response_json}"
@@ -0,0 +1,355 @@
+# health.py
+"""
+Nginx / php-fpm 运行状态探测 (不启动外部进程)。
+
+- 进程: 扫描 /proc/<pid>/comm 找到 nginx master / worker，读取 /proc/<pid>/status 统计内存。
+- 监听端口: 解析 /proc/net/tcp 与 /proc/net/tcp6 中 LISTEN 状态的套接字，并通过 /proc/<pid>/fd
+  的 socket:[inode] 链接确认属于 nginx (无权限读取 fd 时退化为检查配置的端口是否在监听)。
+- 可选轮询 Nginx stub_status 与 php-fpm 状态页 (?json)。
+
+HealthMonitor 按固定间隔采样并保留时间序列 (活动连接、accepts/handled/requests 速率、fpm 队列长度等)，
+对关键指标维护 EWMA 基线，生成与报告相同结构的发现，并给出供异常评分闸门使用的健康异常分数。
+"""
+import json
+import os
+import threading
+import time
+import urllib.request
+from collections import deque
+
+from anomaly import Ewma
+
+_TCP_LISTEN = "0A"
+
+
+def _read(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def find_processes(name):
+    """返回进程名为 name 的 {pid: ppid}"""
+    processes = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            if _read(f'/proc/{entry}/comm').strip() != name:
+                continue
+            stat = _read(f'/proc/{entry}/stat')
+            # comm 可能包含空格，ppid 位于最后一个 ')' 之后的第二个字段
+            processes[int(entry)] = int(stat[stat.rindex(')') + 2:].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue  # 进程已退出或无权限
+    return processes
+
+
+def process_rss_kb(pid):
+    try:
+        for line in _read(f'/proc/{pid}/status').splitlines():
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def listening_sockets():
+    """解析 /proc/net/tcp{,6}，返回 {inode: 端口}"""
+    sockets = {}
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            lines = _read(path).splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 9 and fields[3] == _TCP_LISTEN:
+                sockets[fields[9]] = int(fields[1].rsplit(':', 1)[1], 16)
+    return sockets
+
+
+def process_socket_inodes(pid):
+    """返回进程持有的套接字 inode 集合；无权限读取时抛出 PermissionError，进程已退出时抛出 FileNotFoundError"""
+    inodes = set()
+    fd_dir = f'/proc/{pid}/fd'
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+    return inodes
+
+
+def probe_nginx(expected_ports=(80, 443)):
+    """
+    探测 nginx 进程与监听端口。
+    :return: {"running", "master_pid", "workers", "ports", "rss_kb", "port_check"}；
+             port_check 为 "fd" (按进程套接字确认) 或 "port" (无权限时按端口号推断)。
+    """
+    processes = find_processes('nginx')
+    masters = [pid for pid, ppid in processes.items() if ppid not in processes]
+    status = {
+        "running": False,
+        "master_pid": masters[0] if masters else None,
+        "workers": len(processes) - len(masters),
+        "ports": [],
+        "rss_kb": sum(process_rss_kb(pid) for pid in processes),
+        "port_check": "fd",
+    }
+    if not processes:
+        return status
+    sockets = listening_sockets()
+    try:
+        inodes = set()
+        for pid in masters or processes:
+            try:
+                inodes |= process_socket_inodes(pid)
+            except (FileNotFoundError, ProcessLookupError):
+                continue  # 进程在 find_processes 之后已退出 (如 worker 重启)
+        ports = {port for inode, port in sockets.items() if inode in inodes}
+    except PermissionError:
+        status["port_check"] = "port"
+        ports = {port for port in sockets.values() if port in expected_ports}
+    status["ports"] = sorted(ports)
+    status["running"] = bool(ports)
+    return status
+
+
+def parse_stub_status(text):
+    """解析 ngx_http_stub_status_module 的输出"""
+    lines = text.strip().splitlines()
+    active = int(lines[0].split(':')[1])
+    accepts, handled, requests_total = (int(value) for value in lines[2].split())
+    rest = lines[3].split()
+    return {
+        "active": active, "accepts": accepts, "handled": handled, "requests": requests_total,
+        "reading": int(rest[1]), "writing": int(rest[3]), "waiting": int(rest[5]),
+    }
+
+
+def parse_fpm_status(text):
+    """解析 php-fpm 状态页 (?json) 输出"""
+    data = json.loads(text)
+    return {
+        "fpm_queue": int(data.get("listen queue", 0)),
+        "fpm_active": int(data.get("active processes", 0)),
+        "fpm_idle": int(data.get("idle processes", 0)),
+        "fpm_max_children_reached": int(data.get("max children reached", 0)),
+        "fpm_slow_requests": int(data.get("slow requests", 0)),
+        "fpm_accepted": int(data.get("accepted conn", 0)),
+    }
+
+
+def _fetch(url, timeout):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read().decode('utf-8', 'replace')
+
+
+class HealthMonitor:
+    """健康状态采样、时间序列与告警"""
+
+    # 计数器型指标 -> 派生的速率 / 增量指标
+    RATES = {"accepts": "accepts_rate", "requests": "requests_rate"}
+    DELTAS = {"fpm_max_children_reached": "fpm_max_children_delta", "fpm_slow_requests": "fpm_slow_delta"}
+    # 维护 EWMA 基线、参与健康异常分数的指标
+    BASELINE_METRICS = ("active", "requests_rate", "fpm_queue", "fpm_active")
+    # 偏离基线时单独告警的指标 (fpm_queue 已有按阈值的告警)
+    SPIKE_ALERT_METRICS = ("active", "requests_rate", "fpm_active")
+
+    def __init__(self, stub_status_url=None, fpm_status_url=None, expected_ports=(80, 443), history=360,
+                 timeout=2.0, zscore_threshold=4.0, fpm_queue_threshold=1, cooldown_seconds=600, warmup_samples=5,
+                 alert_nginx_down=False):
+        self.stub_status_url = stub_status_url
+        self.fpm_status_url = fpm_status_url
+        self.expected_ports = tuple(expected_ports)
+        self.timeout = timeout
+        self.zscore_threshold = zscore_threshold
+        self.fpm_queue_threshold = fpm_queue_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.warmup_samples = warmup_samples
+        self.alert_nginx_down = alert_nginx_down  # 只有确认本机运行 nginx 时才对 "未检测到 nginx" 告警
+        self.series = deque(maxlen=history)
+        self.baselines = {name: Ewma(0.1) for name in self.BASELINE_METRICS}
+        self._last_counters = None
+        self._last_alerts = {}
+        self._pending_findings = []
+        self._last_score = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    # ---------- 采样 ----------
+
+    def sample(self):
+        """采集一个样本，更新时间序列、基线和待报告的发现，返回样本"""
+        now = time.time()
+        point = {"ts": round(now, 3)}
+        nginx = probe_nginx(self.expected_ports)
+        point.update(nginx_up=nginx["running"], workers=nginx["workers"], rss_kb=nginx["rss_kb"])
+        counters = {}
+        if self.stub_status_url:
+            try:
+                counters.update(parse_stub_status(_fetch(self.stub_status_url, self.timeout)))
+            except Exception as e:
+                point["stub_status_error"] = str(e)
+        if self.fpm_status_url:
+            try:
+                counters.update(parse_fpm_status(_fetch(self.fpm_status_url, self.timeout)))
+            except Exception as e:
+                point["fpm_status_error"] = str(e)
+        for key in ("active", "reading", "writing", "waiting", "fpm_queue", "fpm_active", "fpm_idle"):
+            if key in counters:
+                point[key] = counters[key]
+
+        with self._lock:
+            last = self._last_counters
+            if last and now > last["ts"]:
+                elapsed = now - last["ts"]
+                for counter, rate in self.RATES.items():
+                    if counter in counters and counter in last and counters[counter] >= last[counter]:
+                        point[rate] = round((counters[counter] - last[counter]) / elapsed, 3)
+                for counter, delta in self.DELTAS.items():
+                    if counter in counters and counter in last and counters[counter] >= last[counter]:
+                        point[delta] = counters[counter] - last[counter]
+                if {"accepts", "handled"} <= set(counters) and {"accepts", "handled"} <= set(last):
+                    point["dropped"] = max(0, (counters["accepts"] - counters["handled"]) - (last["accepts"] - last["handled"]))
+            self._last_counters = dict(counters, ts=now)
+            self.series.append(point)
+            self._evaluate(point, nginx)
+        return point
+
+    def _alert(self, key, severity, description, recommendation, now):
+        last = self._last_alerts.get(key)
+        if last is not None and now - last < self.cooldown_seconds:
+            return
+        self._last_alerts[key] = now
+        self._pending_findings.append({
+            "severity": severity,
+            "category": "availability",
+            "description": description,
+            "recommendation": recommendation,
+            "log_lines": [],
+            "detector": "health",
+            "dedup_key": f"health:{key}",
+        })
+
+    def _evaluate(self, point, nginx):
+        now = point["ts"]
+        if self.alert_nginx_down and not point["nginx_up"]:
+            self._alert("nginx_down", "critical",
+                        "未检测到 nginx 进程。" if not nginx["workers"] and not nginx["master_pid"]
+                        else f"nginx 进程存在 (master {nginx['master_pid']})，但未监听任何端口。",
+                        "检查 nginx 服务状态与错误日志 (nginx -t / systemctl status nginx)。", now)
+        if point.get("dropped"):
+            self._alert("dropped", "high", f"nginx 在最近一个采样间隔内丢弃了 {point['dropped']} 个连接 (accepts 与 handled 之差增加)。",
+                        "检查 worker_connections、worker_rlimit_nofile 等资源限制。", now)
+        if point.get("fpm_max_children_delta"):
+            self._alert("fpm_max_children", "high", f"php-fpm 在最近一个采样间隔内 {point['fpm_max_children_delta']} 次达到 pm.max_children 上限。",
+                        "检查慢请求或 CC 攻击，必要时调大 pm.max_children。", now)
+        if point.get("fpm_queue", 0) >= self.fpm_queue_threshold > 0:
+            self._alert("fpm_queue", "medium", f"php-fpm 监听队列中有 {point['fpm_queue']} 个等待的连接。",
+                        "php-fpm 进程已全部繁忙，检查 slowlog 与进程池配置。", now)
+
+        score = 0.0
+        for name in self.BASELINE_METRICS:
+            if name not in point:
+                continue
+            baseline = self.baselines[name]
+            if baseline.n >= self.warmup_samples:
+                z = baseline.zscore(point[name])
+                score = max(score, z)
+                if z >= self.zscore_threshold and name in self.SPIKE_ALERT_METRICS:
+                    self._alert(f"spike_{name}", "medium",
+                                f"运行指标 {name} 当前值 {point[name]} 显著高于基线 (均值 {round(baseline.mean, 2)}，z={round(z, 1)})。",
+                                "结合同一时段的访问日志确认是否为攻击或异常流量。", now)
+            baseline.update(point[name])
+        self._last_score = round(score, 3)
+
+    # ---------- 后台轮询 ----------
+
+    def start(self, interval_seconds):
+        """启动后台采样线程 (守护线程)"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.sample()
+                except Exception as e:
+                    print(f"健康检查采样失败: {e}")
+                self._stop.wait(interval_seconds)
+
+        self._thread = threading.Thread(target=run, name="health-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    # ---------- 输出 ----------
+
+    def anomaly_score(self):
+        """最近一次采样的健康异常分数 (基线指标的最大 z-score)"""
+        with self._lock:
+            return self._last_score
+
+    def report(self, window_seconds=None):
+        """生成报告条目并清空待报告的发现"""
+        with self._lock:
+            findings, self._pending_findings = self._pending_findings, []
+            points = list(self.series)
+        if not points:
+            return None
+        if window_seconds:
+            points = [point for point in points if point["ts"] >= points[-1]["ts"] - window_seconds] or points[-1:]
+        latest = points[-1]
+        parts = [f"nginx {'运行中' if latest['nginx_up'] else '未运行'} ({latest['workers']} 个 worker，内存 {latest['rss_kb'] // 1024} MB)"]
+
+        def series_text(key, label, unit=""):
+            values = [point[key] for point in points if key in point]
+            if values:
+                parts.append(f"{label} 当前 {values[-1]}{unit}，区间平均 {round(sum(values) / len(values), 2)}{unit}，峰值 {max(values)}{unit}")
+
+        series_text("active", "活动连接")
+        series_text("requests_rate", "请求速率", "/s")
+        series_text("fpm_queue", "php-fpm 队列")
+        series_text("fpm_active", "php-fpm 活动进程")
+        errors = latest.get("stub_status_error") or latest.get("fpm_status_error")
+        if errors:
+            parts.append(f"状态页读取失败: {errors}")
+        return {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(latest["ts"])),
+            "log_type": "system_health",
+            "findings": findings,
+            "summary": f"运行状态 ({len(points)} 个样本): " + "；".join(parts) + "。",
+        }
+
+    def to_dict(self, series_limit=60):
+        with self._lock:
+            return {
+                "last_counters": self._last_counters,
+                "series": list(self.series)[-series_limit:],
+                "baselines": {name: ewma.to_dict() for name, ewma in self.baselines.items()},
+                "last_alerts": dict(self._last_alerts),
+            }
+
+    def load_dict(self, data):
+        with self._lock:
+            self._last_counters = data.get("last_counters")
+            self.series.extend(data.get("series") or [])
+            for name, values in (data.get("baselines") or {}).items():
+                if name in self.baselines:
+                    self.baselines[name] = Ewma.from_dict(values, self.baselines[name].alpha)
+            self._last_alerts.update(data.get("last_alerts") or {})
+        return self
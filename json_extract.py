@@ -0,0 +1,320 @@
+# json_extract.py
+"""
+模型输出的容错 JSON 提取 (Gemini / OpenRouter 共用)。
+
+单次扫描即可完成:
+- 跳过 markdown 代码块、"json" 前缀等包装，定位最外层 JSON 对象；
+- 去除对象/数组末尾多余的逗号；
+- 输出被截断 (MAX_TOKENS / length，即扫描到文本末尾仍未闭合) 时回退到最后一个完整闭合的发现
+  (或顶层字段)，补齐缺失的括号，被截断的发现整条丢弃而不是保留其片段；截断发生在第一个发现之中
+  (一个完整的发现都没有恢复) 时按失败处理，而不是当作 "没有发现"；
+- 遇到结构错误 (如说明文字中的 "{...}") 时放弃当前 '{'，从下一个 '{' 重新开始；
+- 按发现结构 (findings / summary、紧凑模式的 f / m、分诊的 flag / score，或批量请求的 sections) 校验并规范化结果；
+并在 info 字典中如实记录恢复过程。
+"""
+import json
+
+SEVERITIES = ("critical", "high", "medium", "low", "info")
+
+_CLOSERS = {'{': '}', '[': ']'}
+_WHITESPACE = " \t\r\n"
+
+
+def _scan_object(text, start):
+    """
+    从 text[start] (必须为 '{') 开始扫描一个 JSON 对象。
+    只有扫描到文本末尾仍未闭合时才视为截断并修复，遇到结构错误直接返回 None (由调用方尝试下一个 '{')。
+    修复时回退到的安全点只记录在: 顶层对象的标量字段之后、第一二层括号打开之后，以及数组元素或第一二层的对象/数组
+    完整闭合之后 —— 这样 findings 中被截断的最后一个发现 (连同其 log_lines 等内部片段) 会被整条丢弃。
+    :return: (文本, info)；文本为 None 表示无法恢复。
+    """
+    out = []
+    stack = []           # 每层: [括号, 期望状态]，对象: key/colon/value/next，数组: value/next
+    in_string = False
+    escape = False
+    string_is_key = False
+    in_primitive = False
+    safe = None          # (输出长度, 当时的括号栈)，在该点补齐括号即可得到合法 JSON
+    removed_commas = 0
+
+    def safe_point():
+        return (len(out), [entry[0] for entry in stack])
+
+    def scalar_done():
+        stack[-1][1] = "next"
+        return safe_point() if len(stack) == 1 else safe
+
+    index = start
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if in_string:
+            out.append(char)
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+                if string_is_key:
+                    stack[-1][1] = "colon"
+                else:
+                    safe = scalar_done()
+            index += 1
+            continue
+
+        if in_primitive:
+            if char in _WHITESPACE or char in ',]}':
+                in_primitive = False
+                safe = scalar_done()
+                # 不前进 index，让结构字符在下面正常处理
+            else:
+                out.append(char)
+                index += 1
+                continue
+
+        if char in _WHITESPACE:
+            out.append(char)
+        elif char == '"':
+            in_string = True
+            string_is_key = bool(stack) and stack[-1][0] == '{' and stack[-1][1] == "key"
+            out.append(char)
+        elif char in '{[':
+            if stack and stack[-1][1] != "value":
+                return None, {"truncated": False, "structural_error": index}
+            stack.append([char, "key" if char == '{' else "value"])
+            out.append(char)
+            if len(stack) <= 2:
+                safe = safe_point()
+        elif char in '}]':
+            if not stack or _CLOSERS[stack[-1][0]] != char:
+                return None, {"truncated": False, "structural_error": index}
+            # 去除末尾多余的逗号: {"a": 1,} / [1, 2,]
+            tail = len(out) - 1
+            while tail >= 0 and out[tail] in _WHITESPACE:
+                tail -= 1
+            if tail >= 0 and out[tail] == ',':
+                del out[tail]
+                removed_commas += 1
+            stack.pop()
+            out.append(char)
+            if not stack:
+                return "".join(out), {"truncated": False, "trailing_commas_removed": removed_commas,
+                                      "end": index + 1}
+            stack[-1][1] = "next"
+            if len(stack) <= 2 or stack[-1][0] == '[':
+                safe = safe_point()  # 数组元素 (如一个发现) 或第一二层的值已完整闭合
+        elif char == ',':
+            if not stack or stack[-1][1] != "next":
+                return None, {"truncated": False, "structural_error": index}
+            stack[-1][1] = "key" if stack[-1][0] == '{' else "value"
+            out.append(char)
+        elif char == ':':
+            if not stack or stack[-1][1] != "colon":
+                return None, {"truncated": False, "structural_error": index}
+            stack[-1][1] = "value"
+            out.append(char)
+        else:
+            if not stack or stack[-1][1] != "value":
+                return None, {"truncated": False, "structural_error": index}
+            in_primitive = True
+            out.append(char)
+        index += 1
+
+    # 到达文本末尾仍未闭合 (输出被截断): 回退到最后一个安全点并补齐括号
+    if safe is None:
+        return None, {"truncated": True}
+    safe_length, safe_stack = safe
+    repaired = "".join(out[:safe_length]).rstrip()
+    if repaired.endswith(','):
+        repaired = repaired[:-1]
+    repaired += "".join(_CLOSERS[bracket] for bracket in reversed(safe_stack))
+    # 安全点之后已打开的数组元素对象 (如一个发现) 被整条丢弃
+    partial_element = any(stack[depth - 1][0] == '[' and stack[depth][0] == '{'
+                          for depth in range(max(1, len(safe_stack)), len(stack)))
+    return repaired, {"truncated": True, "trailing_commas_removed": removed_commas, "partial_element": partial_element,
+                      "closed_brackets": len(safe_stack), "discarded_chars": length - start - safe_length}
+
+
+def extract_json(text):
+    """
+    从模型输出文本中提取最外层 JSON 对象。
+    :return: (对象或 None, info)
+    """
+    info = {"repaired": False}
+    if not text:
+        info["error"] = "empty model output"
+        return None, info
+    start = text.find('{')
+    while start != -1:
+        candidate, scan_info = _scan_object(text, start)
+        if candidate is not None:
+            try:
+                obj = json.loads(candidate)
+            except json.JSONDecodeError as e:
+                info["error"] = f"JSON decode failed after extraction: {e}"
+            else:
+                info.update(scan_info)
+                if start > 0 or text[scan_info.get("end", len(text)):].strip():
+                    info["stripped_wrapper"] = True  # 去掉了代码块、前缀或尾随说明
+                info["repaired"] = bool(scan_info.get("truncated") or scan_info.get("trailing_commas_removed"))
+                return obj, info
+        # 当前 '{' 无法构成对象 (例如出现在前置说明文字中)，尝试下一个
+        start = text.find('{', start + 1)
+    info.setdefault("error", "no JSON object found in model output")
+    return None, info
+
+
+def _validate_finding(finding):
+    if not isinstance(finding, dict):
+        return None
+    description = finding.get("description")
+    if not isinstance(description, str) or not description.strip():
+        return None
+    severity = str(finding.get("severity", "info")).lower()
+    finding["severity"] = severity if severity in SEVERITIES else "info"
+    if not isinstance(finding.get("recommendation", ""), str):
+        finding["recommendation"] = str(finding["recommendation"])
+    log_lines = finding.get("log_lines", [])
+    if isinstance(log_lines, str):
+        log_lines = [log_lines]
+    finding["log_lines"] = [str(line) for line in log_lines] if isinstance(log_lines, list) else []
+    return finding
+
+
+def _validate_compact_finding(finding):
+    """紧凑模式的发现: s (严重性缩写) / c (类别代码) / l (行序号列表) / n (备注)"""
+    if not isinstance(finding, dict) or not finding.get("c") or not finding.get("s"):
+        return None
+    indexes = finding.get("l", [])
+    if not isinstance(indexes, list):
+        indexes = [indexes]
+    valid_indexes = []
+    for index in indexes:
+        try:
+            valid_indexes.append(int(index))
+        except (TypeError, ValueError):
+            continue
+    finding["l"] = valid_indexes
+    finding["c"] = str(finding["c"]).upper()
+    finding["s"] = str(finding["s"]).lower()
+    if not isinstance(finding.get("n", ""), str):
+        finding["n"] = str(finding["n"])
+    return finding
+
+
+def _validate_section(section, info):
+    if "f" in section and "findings" not in section:
+        return _validate_compact_section(section, info)
+    if ("flag" in section or "score" in section) and "findings" not in section:
+        return _validate_triage(section)
+    findings = section.get("findings", [])
+    if isinstance(findings, dict):
+        findings = [findings]
+    if not isinstance(findings, list):
+        findings = []
+    valid = []
+    for finding in findings:
+        checked = _validate_finding(finding)
+        if checked is None:
+            info["dropped_findings"] = info.get("dropped_findings", 0) + 1
+        else:
+            valid.append(checked)
+    section["findings"] = valid
+    info["recovered_findings"] = info.get("recovered_findings", 0) + len(valid)
+    if not isinstance(section.get("summary", ""), str):
+        section["summary"] = str(section["summary"])
+    section.setdefault("summary", "")
+    return section
+
+
+def _validate_compact_section(section, info):
+    findings = section.get("f", [])
+    if isinstance(findings, dict):
+        findings = [findings]
+    if not isinstance(findings, list):
+        findings = []
+    valid = []
+    for finding in findings:
+        checked = _validate_compact_finding(finding)
+        if checked is None:
+            info["dropped_findings"] = info.get("dropped_findings", 0) + 1
+        else:
+            valid.append(checked)
+    section["f"] = valid
+    info["recovered_findings"] = info.get("recovered_findings", 0) + len(valid)
+    section["m"] = str(section.get("m") or "")
+    return section
+
+
+def _validate_triage(section):
+    """分诊结果: flag (是否可疑) / score (0-100 可疑程度)，缺少其中一项时由另一项推断"""
+    flag = section.get("flag")
+    if isinstance(flag, str):
+        flag = flag.strip().lower() in ("true", "yes", "y", "1")
+    try:
+        score = int(float(section["score"]))
+    except (KeyError, TypeError, ValueError):
+        score = 100 if flag else 0
+    section["score"] = max(0, min(100, score))
+    section["flag"] = bool(flag) if flag is not None else section["score"] >= 50
+    return section
+
+
+def validate_analysis(obj, info):
+    """
+    按发现结构校验并规范化分析结果 (支持批量请求的 sections 结构)。
+    无效的发现 (缺少描述、被截断到只剩片段等) 会被丢弃并计入 info["dropped_findings"]。
+    :return: 规范化后的对象；对象中完全没有可用内容时返回 None。
+    """
+    if not isinstance(obj, dict):
+        info["error"] = "model output is not a JSON object"
+        return None
+    if "sections" in obj:
+        sections = obj["sections"]
+        if isinstance(sections, dict):
+            for section in sections.values():
+                if isinstance(section, dict):
+                    _validate_section(section, info)
+        elif isinstance(sections, list):
+            for section in sections:
+                if isinstance(section, dict):
+                    _validate_section(section, info)
+        return obj
+    if not any(key in obj for key in ("findings", "summary", "f", "flag", "score")):
+        info["error"] = "model output has neither 'findings' nor 'summary'"
+        return None
+    return _validate_section(obj, info)
+
+
+def parse_model_output(text):
+    """
+    提取、修复并校验模型输出。
+    :return: (结果对象或 None, info)；输出在第一个发现之中被截断时也返回 None (原因见 info["error"])。
+    """
+    obj, info = extract_json(text)
+    if obj is None:
+        return None, info
+    result = validate_analysis(obj, info)
+    if (result is not None and "sections" not in result and info.get("partial_element")
+            and not info.get("recovered_findings")):
+        # 截断发生在第一个发现之中: 修复后的 "没有发现" 并不可信，按失败处理，让这些日志行稍后重新分析
+        info["error"] = "model output truncated inside the first finding; no complete finding recovered"
+        return None, info
+    return result, info
+
+
+def describe_recovery(info):
+    """生成面向人的恢复说明，用于控制台和报告"""
+    parts = []
+    if info.get("stripped_wrapper"):
+        parts.append("去除了 JSON 之外的包装文本")
+    if info.get("trailing_commas_removed"):
+        parts.append(f"移除了 {info['trailing_commas_removed']} 个多余逗号")
+    if info.get("truncated"):
+        parts.append(f"输出被截断，丢弃末尾 {info.get('discarded_chars', 0)} 个不完整字符并补齐 {info.get('closed_brackets', 0)} 个括号")
+    if info.get("dropped_findings"):
+        parts.append(f"丢弃了 {info['dropped_findings']} 个不完整的发现")
+    if "recovered_findings" in info:
+        parts.append(f"保留 {info['recovered_findings']} 个完整发现")
+    return "；".join(parts)
@@ -0,0 +1,108 @@
+# log_parser.py
+"""Nginx / PHP-FPM 日志行解析与预过滤工具。"""
+import re
+import calendar
+from datetime import datetime
+
+# Nginx combined 格式: 1.2.3.4 - user [01/May/2024:12:00:00 +0800] "GET /path HTTP/1.1" 200 123 "ref" "ua"
+ACCESS_LINE_RE = re.compile(
+    r'^(?P<ip>\S+) \S+ (?P<user>\S+) \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+|-)? ?(?P<path>[^" ]*)?(?: (?P<proto>[^"]*))?" '
+    r'(?P<status>\d{3}) (?P<bytes>\d+|-)'
+    r'(?: "(?P<referer>[^"]*)" "(?P<ua>[^"]*)")?'
+)
+# Nginx error log: 2024/05/01 12:00:00 [error] 1234#0: *5 ...
+ERROR_LINE_RE = re.compile(r'^(?P<time>\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}) \[(?P<level>\w+)\]')
+# PHP-FPM log: [01-May-2024 12:00:00] WARNING: [pool www] ...
+PHP_FPM_LINE_RE = re.compile(r'^\[(?P<time>\d{2}-\w{3}-\d{4} \d{2}:\d{2}:\d{2})(?: [^\]]*)?\] (?P<level>[A-Z]+):')
+
+_MONTHS = {m: i for i, m in enumerate(calendar.month_abbr) if m}
+
+# 访问日志中常见的攻击特征 (大小写不敏感)
+SUSPICIOUS_REQUEST_RE = re.compile(
+    r"\.\./|%2e%2e|/etc/passwd|union(\s|%20|\+)+select|<script|%3cscript|\beval\(|base64_decode|"
+    r"\bcmd=|\bexec\(|phpmyadmin|wp-login\.php|xmlrpc\.php|/\.env|/\.git|\.(bak|sql|swp)\b|"
+    r"sleep\(|benchmark\(|information_schema|\$\{jndi:|/cgi-bin/|shell|webshell",
+    re.IGNORECASE,
+)
+COMMON_METHODS = frozenset(("GET", "POST", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"))
+# 错误日志中需要关注的级别
+ERROR_LEVELS = frozenset(("warn", "error", "crit", "alert", "emerg"))
+PHP_FPM_LEVELS = frozenset(("WARNING", "ERROR", "ALERT", "EMERGENCY"))
+
+
+def _parse_access_time(value):
+    """解析 '01/May/2024:12:00:00 +0800' 为 Unix 时间戳 (秒)"""
+    try:
+        day, month, rest = value.split('/', 2)
+        year, hh, mm, ss_tz = rest.split(':', 3)
+        ss, _, tz = ss_tz.partition(' ')
+        ts = calendar.timegm((int(year), _MONTHS[month], int(day), int(hh), int(mm), int(ss)))
+        if tz and len(tz) == 5:
+            offset = (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (1 if tz[0] == '+' else -1)
+            ts -= offset
+        return ts
+    except (ValueError, KeyError):
+        return None
+
+
+def _parse_local_time(value, fmt):
+    """按本地时区解析时间字符串为 Unix 时间戳 (秒)"""
+    try:
+        return int(datetime.strptime(value, fmt).timestamp())
+    except ValueError:
+        return None
+
+
+def parse_access_line(line):
+    """
+    解析一行 Nginx 访问日志。
+    :return: 包含 ip/method/path/status/ua/ts 等字段的字典，无法解析时返回 None。
+    """
+    match = ACCESS_LINE_RE.match(line)
+    if not match:
+        return None
+    record = match.groupdict()
+    record["status"] = int(record["status"])
+    record["ts"] = _parse_access_time(record["time"])
+    record["path"] = record.get("path") or ""
+    record["ua"] = record.get("ua") or ""
+    return record
+
+
+def parse_line_timestamp(line, log_type):
+    """提取日志行的时间戳 (Unix 秒)，不含时间戳的行 (如堆栈续行) 返回 None"""
+    if log_type == "nginx_access":
+        start = line.find('[')
+        end = line.find(']', start + 1)
+        if start == -1 or end == -1:
+            return None
+        return _parse_access_time(line[start + 1:end])
+    if log_type == "nginx_error":
+        match = ERROR_LINE_RE.match(line)
+        return _parse_local_time(match.group("time"), "%Y/%m/%d %H:%M:%S") if match else None
+    if log_type == "php_fpm":
+        match = PHP_FPM_LINE_RE.match(line)
+        return _parse_local_time(match.group("time"), "%d-%b-%Y %H:%M:%S") if match else None
+    return None
+
+
+def is_suspicious(line, log_type):
+    """
+    廉价的本地预过滤：判断一行日志是否值得送去 AI 分析。
+    访问日志关注 4xx/5xx、非常规方法和攻击特征；错误日志关注 warn 及以上级别。
+    """
+    if log_type == "nginx_access":
+        record = parse_access_line(line)
+        if record is None:
+            return bool(SUSPICIOUS_REQUEST_RE.search(line))
+        if record["status"] >= 400 or (record["method"] and record["method"] not in COMMON_METHODS):
+            return True
+        return bool(SUSPICIOUS_REQUEST_RE.search(record["path"]) or SUSPICIOUS_REQUEST_RE.search(record["ua"]))
+    if log_type == "nginx_error":
+        match = ERROR_LINE_RE.match(line)
+        return match is None or match.group("level") in ERROR_LEVELS
+    if log_type == "php_fpm":
+        match = PHP_FPM_LINE_RE.match(line)
+        return match is None or match.group("level") in PHP_FPM_LEVELS
+    return True
@@ -1,14 +1,32 @@
 # main.py
 import time
+_STARTED_AT = time.perf_counter() # 用于统计冷启动到首次 AI 请求的耗时
 import json
 import os
+import sys
 import subprocess # 用于执行外部命令
 # import requests # requests 已移至 gemini_client.py
 from datetime import datetime
+from functools import partial
 
-# 从 AI 客户端模块导入封装的 API 调用函数
-from gemini_client import call_gemini_api
-from openrouter_client import call_openrouter_api
+# AI 客户端模块 (gemini_client / openrouter_client) 在 call_ai_api 中按所选提供商延迟导入
+from fingerprint_store import FingerprintStore
+from anomaly import AnomalyDetector
+from detectors import build_default_detectors
+from batching import BATCH_SYSTEM_INSTRUCTION, BATCH_USER_PROMPT_PREFIX, plan_batches, build_batch_prompt, split_batch_result
+from compact_schema import (COMPACT_SYSTEM_INSTRUCTION, COMPACT_BATCH_SYSTEM_INSTRUCTION, COMPACT_RESPONSE_SCHEMA,
+                            build_batch_schema, number_lines, is_compact, expand_compact)
+import cascade
+from spool import Spool, drain, is_provider_outage
+from state_snapshot import load_snapshot, save_snapshot
+from health import HealthMonitor, probe_nginx
+from pipeline import Pipeline, Stage, format_stats
+from sampling import StratifiedSampler, format_sampling_header
+from record_store import AccessRecordStore
+from alerts import AlertDispatcher, build_sink
+from scheduler import FixedRateScheduler, Deadline, set_scan_deadline, current_deadline, format_cadence
+from records import (RECORD_START_PATTERNS, RecordAssembler, assemble, record_lines, take_first, take_last, chunk_records,
+                     select_top_records)
 
 # 从 config.py 导入配置
 try:
@@ -17,47 +35,563 @@ except ImportError:
     print("错误：找不到 config.py 文件。请确保该文件存在于项目根目录中。")
     exit()
 
-# 确认加载的 OPENROUTER_MODEL 值
-if hasattr(config, "OPENROUTER_MODEL"):
-    print(f"DEBUG: Loaded OPENROUTER_MODEL = {config.OPENROUTER_MODEL}")
-else:
-    print("DEBUG: OPENROUTER_MODEL not found in config.")
+_fingerprint_store = None
 
-def read_latest_log_lines(log_path, num_lines):
-    """读取日志文件的最后 N 行"""
+def get_fingerprint_store():
+    """返回进程内共享的指纹存储 (首次调用时从磁盘加载)，未启用去重时返回 None"""
+    global _fingerprint_store
+    if not getattr(config, "ENABLE_FINDING_DEDUP", True):
+        return None
+    if _fingerprint_store is None:
+        _fingerprint_store = FingerprintStore(
+            path=getattr(config, "FINGERPRINT_STORE_PATH", None),
+            ttl_seconds=getattr(config, "FINGERPRINT_TTL_SECONDS", 86400),
+            max_entries=getattr(config, "FINGERPRINT_MAX_ENTRIES", 50000),
+        ).load()
+    return _fingerprint_store
+
+_anomaly_detectors = {}
+
+def get_anomaly_detector(log_type):
+    """返回指定日志类型的异常评分器，未启用异常评分时返回 None"""
+    if not getattr(config, "ENABLE_ANOMALY_GATE", True):
+        return None
+    detector = _anomaly_detectors.get(log_type)
+    if detector is None:
+        detector = _anomaly_detectors[log_type] = AnomalyDetector(
+            log_type,
+            alpha=getattr(config, "ANOMALY_EWMA_ALPHA", 0.2),
+            decay=getattr(config, "ANOMALY_SKETCH_DECAY", 0.9),
+            top_k=getattr(config, "ANOMALY_TOP_K", 32),
+        )
+    return detector
+
+_detector_set = None
+
+def get_detector_set():
+    """返回本地滑动窗口检测器集合，未启用时返回 None"""
+    global _detector_set
+    if not getattr(config, "ENABLE_LOCAL_DETECTORS", True):
+        return None
+    if _detector_set is None:
+        _detector_set = build_default_detectors(config)
+    return _detector_set
+
+_spool = None
+
+def get_spool():
+    """返回待分析窗口的磁盘队列 (首次调用时恢复已有段文件)，未启用时返回 None"""
+    global _spool
+    if not getattr(config, "ENABLE_ANALYSIS_SPOOL", True) or not getattr(config, "SPOOL_DIR", None):
+        return None
+    if _spool is None:
+        _spool = Spool(
+            config.SPOOL_DIR,
+            segment_max_bytes=getattr(config, "SPOOL_SEGMENT_MAX_BYTES", 4 * 1024 * 1024),
+            max_bytes=getattr(config, "SPOOL_MAX_BYTES", 256 * 1024 * 1024),
+            fsync_policy=getattr(config, "SPOOL_FSYNC_POLICY", "interval"),
+            fsync_interval_seconds=getattr(config, "SPOOL_FSYNC_INTERVAL_SECONDS", 1.0),
+        ).open()
+    return _spool
+
+_health_monitor = None
+
+def get_health_monitor():
+    """返回 nginx / php-fpm 运行状态监控器，未启用时返回 None"""
+    global _health_monitor
+    if not getattr(config, "ENABLE_HEALTH_MONITOR", False) or not os.path.exists('/proc/net/tcp'):
+        return None
+    if _health_monitor is None:
+        _health_monitor = HealthMonitor(
+            stub_status_url=getattr(config, "NGINX_STUB_STATUS_URL", None),
+            fpm_status_url=getattr(config, "PHP_FPM_STATUS_URL", None),
+            expected_ports=getattr(config, "HEALTH_EXPECTED_PORTS", (80, 443)),
+            history=getattr(config, "HEALTH_HISTORY_SAMPLES", 360),
+            zscore_threshold=getattr(config, "HEALTH_ZSCORE_THRESHOLD", 4.0),
+            fpm_queue_threshold=getattr(config, "HEALTH_FPM_QUEUE_THRESHOLD", 1),
+            cooldown_seconds=getattr(config, "HEALTH_ALERT_COOLDOWN_SECONDS", 600),
+            alert_nginx_down=getattr(config, "ENABLE_NGINX_STATUS_CHECK", False),
+        )
+    return _health_monitor
+
+_alert_dispatcher = None
+
+def get_alert_dispatcher():
+    """返回告警分发器 (首次调用时启动发送线程)，未启用或没有配置通知渠道时返回 None"""
+    global _alert_dispatcher
+    if not getattr(config, "ENABLE_ALERTS", False) or not getattr(config, "ALERT_SINKS", None):
+        return None
+    if _alert_dispatcher is None:
+        _alert_dispatcher = AlertDispatcher(
+            [build_sink(spec) for spec in config.ALERT_SINKS],
+            min_severity=getattr(config, "ALERT_MIN_SEVERITY", "high"),
+            coalesce_seconds=getattr(config, "ALERT_COALESCE_SECONDS", 10),
+            max_queue=getattr(config, "ALERT_MAX_QUEUE", 1000),
+            retry_base_seconds=getattr(config, "ALERT_RETRY_BASE_SECONDS", 5),
+            retry_max_seconds=getattr(config, "ALERT_RETRY_MAX_SECONDS", 300),
+            max_retries=getattr(config, "ALERT_MAX_RETRIES", 8),
+            dedup_seconds=getattr(config, "ALERT_DEDUP_SECONDS", 3600) if getattr(config, "ALERT_ONLY_NEW_FINDINGS", True) else 0,
+        ).start()
+    return _alert_dispatcher
+
+def notify_findings(result):
+    """把结果中的发现提交给告警分发器 (非阻塞)；默认只通知首次出现的发现"""
+    dispatcher = get_alert_dispatcher()
+    if dispatcher is None or not isinstance(result, dict) or not result.get("findings"):
+        return
+    findings = result["findings"]
+    if getattr(config, "ALERT_ONLY_NEW_FINDINGS", True):
+        findings = [finding for finding in findings if isinstance(finding, dict) and finding.get("seen_count", 1) <= 1]
+    dispatcher.submit(result.get("log_type", "unknown"), findings)
+
+_log_offsets = None # 日志文件 -> [inode, 已读取到的偏移]；仅在加载了状态快照 (--once) 时启用
+
+def read_log_records(log_path, log_type, num_lines, offsets=None):
+    """
+    读取日志文件末尾的完整记录 (总行数最多 num_lines 行)。
+    多行记录 (PHP 堆栈跟踪、php-fpm 慢日志等) 按 records.RECORD_START_PATTERNS 组装为一条记录，窗口只在记录之间截断，
+    从文件中间开始读取时丢弃开头不完整记录的续行。
+    传入 offsets 且已有上次的偏移时，从该偏移处向后读取最早的新增记录 (最多 num_lines 行)，偏移停在第一条未返回的记录处，
+    新增内容超出窗口时不会被跳过，而是留待下次读取 (并提示积压量)；文件被轮转或截断 (inode 变化 / 变小) 时从新文件开头读取，
+    首次读取时读取末尾。最后一条记录之后可能还有续行尚未写入，文件静止 RECORD_FLUSH_SECONDS 秒之前留到下次读取。
+    :return: [LogRecord]；没有新内容时返回空列表，文件不存在或读取失败时返回 None。
+    """
     if not os.path.exists(log_path):
         print(f"警告：日志文件 {log_path} 不存在。")
-        return []
+        return None
     try:
-        with open(log_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        return lines[-num_lines:]
+        stat = os.stat(log_path)
+        previous = offsets.get(log_path) if offsets is not None else None
+        start = previous[1] if previous and previous[0] == stat.st_ino and previous[1] <= stat.st_size else 0
+        if start == stat.st_size and previous:
+            return []
+        forward = previous is not None
+        # 只读取足够容纳 num_lines 行的部分，避免在大日志上整文件读取
+        if forward:
+            read_from, read_to = start, min(stat.st_size, start + num_lines * 4096)
+        else:
+            read_from, read_to = max(start, stat.st_size - num_lines * 4096), stat.st_size
+        with open(log_path, 'rb') as f:
+            if read_from > start:
+                # 从上一个字节开始读，丢弃第一个换行符之前的部分 (可能是不完整的行)
+                f.seek(read_from - 1)
+                data = f.read(read_to - read_from + 1)
+                cut = data.find(b'\n') + 1
+                read_from, data = read_from - 1 + cut, data[cut:]
+            else:
+                f.seek(read_from)
+                data = f.read(read_to - read_from)
+            if read_to < stat.st_size and b'\n' not in data:
+                data += f.read(stat.st_size - read_to) # 单行超过读取范围时读到文件末尾
+                read_to = stat.st_size
+        complete = data.rfind(b'\n') + 1 # 最后一行尚未写完时留到下次读取
+        assembly_enabled = getattr(config, "ENABLE_RECORD_ASSEMBLY", True)
+        records, last, dropped = assemble(data[:complete], read_from, log_type,
+                                          drop_leading=read_from > start,
+                                          max_record_lines=getattr(config, "RECORD_MAX_LINES", 200),
+                                          enabled=assembly_enabled)
+        if dropped:
+            print(f"{log_type} 日志窗口开头有 {dropped} 行属于被截断的记录，已丢弃。")
+        next_offset = read_from + complete
+        if last is not None:
+            multiline = assembly_enabled and RECORD_START_PATTERNS.get(log_type) is not None
+            # 记录可能尚未写完 (文件最近仍在写入，或后续续行在本次读取范围之外)，下次从它的起始处重新读取
+            incomplete = read_to < stat.st_size or time.time() - stat.st_mtime < getattr(config, "RECORD_FLUSH_SECONDS", 5)
+            if offsets is not None and multiline and incomplete and (records or last.start > start):
+                next_offset = last.start
+            else:
+                records.append(last)
+        if not forward:
+            if offsets is not None:
+                offsets[log_path] = [stat.st_ino, next_offset]
+            return take_last(records, num_lines)
+        taken = take_first(records, num_lines)
+        if len(taken) < len(records):
+            next_offset = records[len(taken)].start
+        offsets[log_path] = [stat.st_ino, next_offset]
+        if len(taken) < len(records) or read_to < stat.st_size:
+            print(f"{log_type} 日志新增内容超过本次 {num_lines} 行的窗口，剩余 {stat.st_size - next_offset} 字节留待下次运行分析。")
+        return taken
     except Exception as e:
         print(f"读取日志文件 {log_path} 时出错: {e}")
+        return None
+
+_sampling_offsets = {} # 循环模式下抽样读取的偏移 (单次运行模式使用 _log_offsets)
+
+def read_sampled_records(log_path, log_type, budget, offsets):
+    """
+    流式读取自上次偏移以来的整个扫描间隔 (最多 SAMPLING_MAX_BYTES 字节)，总行数超过 budget 时分层抽样。
+    访问日志 (SAMPLING_COLUMNAR_STORE 开启时) 解析进列式存储 record_store.AccessRecordStore，不为每条记录保留字符串，
+    抽样在记录下标上进行，选中的记录再按偏移从文件中读取；统计信息直接在列上聚合。
+    多行记录与 read_log_records 一样，最后一条记录在文件静止 RECORD_FLUSH_SECONDS 秒之前留到下次读取。
+    :return: (记录列表, 抽样统计或 None (未抽样))；没有新内容时返回 ([], None)，文件不存在或读取失败时返回 (None, None)。
+    """
+    if not os.path.exists(log_path):
+        print(f"警告：日志文件 {log_path} 不存在。")
+        return None, None
+    try:
+        stat = os.stat(log_path)
+        previous = offsets.get(log_path)
+        start = previous[1] if previous and previous[0] == stat.st_ino and previous[1] <= stat.st_size else 0
+        if start == stat.st_size and previous:
+            return [], None
+        read_from = max(start, stat.st_size - getattr(config, "SAMPLING_MAX_BYTES", 64 * 1024 * 1024))
+        store = None
+        columnar = {}
+        if log_type == "nginx_access" and getattr(config, "SAMPLING_COLUMNAR_STORE", True):
+            # 抽样对象是存储中的记录下标 (每条访问记录一行)，分层键中的 IP / 路径前缀为字典代码
+            store = AccessRecordStore(max_distinct_values=getattr(config, "SAMPLING_MAX_DISTINCT_VALUES", 262144))
+            columnar = {"classify": store.classify, "size_of": lambda index: 1, "labels": store.labels}
+        else:
+            assembler = RecordAssembler(log_type, getattr(config, "RECORD_MAX_LINES", 200), drop_leading=read_from > start,
+                                        enabled=getattr(config, "ENABLE_RECORD_ASSEMBLY", True))
+        sampler = StratifiedSampler(budget,
+                                    reservoir_size=getattr(config, "SAMPLING_RESERVOIR_SIZE", 4),
+                                    max_strata=getattr(config, "SAMPLING_MAX_STRATA", 2048),
+                                    rare_threshold=getattr(config, "SAMPLING_RARE_THRESHOLD", 2),
+                                    always_include_max=getattr(config, "SAMPLING_ALWAYS_INCLUDE_MAX", None),
+                                    **columnar)
+        head = [] # 间隔内记录不超过预算时直接原样返回
+        offset = read_from
+        with open(log_path, 'rb') as f:
+            f.seek(read_from)
+            if read_from > start:
+                skipped = f.readline() # 从文件中间开始时丢弃第一个不完整的行
+                offset += len(skipped)
+            for raw in f:
+                if not raw.endswith(b'\n') or offset + len(raw) > stat.st_size:
+                    break # 最后一行尚未写完时留到下次读取
+                if store is not None:
+                    sampler.add(store.append(raw.decode('utf-8', 'replace'), offset, len(raw)))
+                    offset += len(raw)
+                    continue
+                record = assembler.feed(raw.decode('utf-8', 'replace'), offset, offset + len(raw))
+                offset += len(raw)
+                if record is not None:
+                    sampler.add(record)
+                    if len(head) <= budget:
+                        head.append(record)
+            if store is not None:
+                offsets[log_path] = [stat.st_ino, offset]
+                if len(store) <= budget:
+                    return store.materialize(f, range(len(store))), None
+                indices, stats = sampler.sample()
+                aggregate = store.aggregate()
+                # 列上的聚合是精确值 (分层在超过 SAMPLING_MAX_STRATA 后会把 IP / 路径前缀并入 "*")
+                stats.update({key: aggregate[key] for key in ("status_counts", "top_ips", "top_path_prefixes", "top_user_agents")})
+                stats["store_bytes"] = store.nbytes()
+                return store.materialize(f, indices), stats
+        last = assembler.flush()
+        if last is not None:
+            multiline = getattr(config, "ENABLE_RECORD_ASSEMBLY", True) and RECORD_START_PATTERNS.get(log_type) is not None
+            # 与 read_log_records 相同: 最后一条记录可能尚未写完，下次从它的起始处重新读取
+            incomplete = offset < stat.st_size or time.time() - stat.st_mtime < getattr(config, "RECORD_FLUSH_SECONDS", 5)
+            if multiline and incomplete and (sampler.total or last.start > start):
+                offset = last.start
+            else:
+                sampler.add(last)
+                if len(head) <= budget:
+                    head.append(last)
+        offsets[log_path] = [stat.st_ino, offset]
+        if sum(len(record.lines) for record in head) <= budget and sampler.total == len(head):
+            return head, None
+        return sampler.sample()
+    except Exception as e:
+        print(f"读取日志文件 {log_path} 时出错: {e}")
+        return None, None
+
+_detector_offsets = {} # 日志文件 -> [inode, 本地检测器已处理到的偏移]；单次运行模式下随状态快照保存
+
+def feed_detectors(log_path, log_type, chunk_lines=2000):
+    """
+    把自上次偏移以来的每一个新日志行交给本地滑动窗口检测器。
+    送给模型的窗口只是末尾 LOG_LINES_TO_READ 行 (或抽样)，暴力破解 / 404 突发落在窗口之外时也必须被计数，
+    因此检测器按自己的偏移流式读取整个间隔。首次读取时从与模型窗口相同的文件末尾范围开始；
+    单次最多读取 DETECTOR_MAX_BYTES 字节，超出时跳过较早的部分并提示。
+    :return: 新产生的发现列表
+    """
+    detector_set = get_detector_set()
+    if detector_set is None or not os.path.exists(log_path):
         return []
+    findings = []
+    try:
+        stat = os.stat(log_path)
+        previous = _detector_offsets.get(log_path)
+        if previous and previous[0] == stat.st_ino and previous[1] <= stat.st_size:
+            start = previous[1]
+        elif previous:
+            start = 0 # 文件被轮转或截断，新文件从头开始
+        else:
+            start = max(0, stat.st_size - config.LOG_LINES_TO_READ * 4096)
+        read_from = max(start, stat.st_size - getattr(config, "DETECTOR_MAX_BYTES", 64 * 1024 * 1024))
+        if read_from > start:
+            print(f"{log_type} 日志新增 {stat.st_size - start} 字节，超过 DETECTOR_MAX_BYTES，本地检测器跳过较早的 {read_from - start} 字节。")
+        offset = read_from
+        batch = []
+        with open(log_path, 'rb') as f:
+            f.seek(read_from)
+            if read_from > 0 and (read_from > start or not previous):
+                offset += len(f.readline()) # 不在行边界上时丢弃第一个不完整的行
+            for raw in f:
+                if not raw.endswith(b'\n') or offset + len(raw) > stat.st_size:
+                    break # 最后一行尚未写完时留到下次读取
+                offset += len(raw)
+                batch.append(raw.decode('utf-8', 'replace'))
+                if len(batch) >= chunk_lines:
+                    findings.extend(detector_set.process_lines(log_type, batch))
+                    batch = []
+        if batch:
+            findings.extend(detector_set.process_lines(log_type, batch))
+        _detector_offsets[log_path] = [stat.st_ino, offset]
+    except Exception as e:
+        print(f"本地检测器读取日志文件 {log_path} 时出错: {e}")
+    return findings
 
 # def call_gemini_api(log_data_str): ... # 此函数已移至 gemini_client.py
 
-def call_ai_api(log_data_str, proxies=None):
+_first_request_ms = None
+
+def call_ai_api(log_data_str, proxies=None, **request_options):
     """
     根据配置选择合适的 AI API 提供商进行调用。
     :param log_data_str: 要分析的日志数据字符串。
     :param proxies: 可选的代理配置字典。
+    :param request_options: 透传给客户端的可选参数 (system_instruction_text / user_prompt_prefix / max_output_tokens / response_schema / model)。
     :return: API 分析结果或错误信息。
     """
+    global _first_request_ms
+    if _first_request_ms is None:
+        _first_request_ms = round((time.perf_counter() - _STARTED_AT) * 1000, 1)
+        print(f"冷启动到首次 AI 请求耗时: {_first_request_ms} ms")
     ai_provider = getattr(config, "AI_PROVIDER", "gemini").lower()
 
     if ai_provider == "openrouter":
-        print(f"使用 OpenRouter API (模型: {getattr(config, 'OPENROUTER_MODEL', 'unknown')}) 进行分析...")
-        return call_openrouter_api(log_data_str, proxies=proxies)
+        from openrouter_client import call_openrouter_api
+        print(f"使用 OpenRouter API (模型: {request_options.get('model') or getattr(config, 'OPENROUTER_MODEL', 'unknown')}) 进行分析...")
+        return call_openrouter_api(log_data_str, proxies=proxies, **request_options)
     elif ai_provider == "gemini":
-        print("使用 Gemini API 进行分析...")
-        return call_gemini_api(log_data_str, proxies=proxies)
+        from gemini_client import call_gemini_api
+        print(f"使用 Gemini API{' (模型: ' + request_options['model'] + ')' if request_options.get('model') else ''} 进行分析...")
+        return call_gemini_api(log_data_str, proxies=proxies, **request_options)
     else:
         error_msg = f"不支持的 AI 提供商: {ai_provider}。请在 config.py 中将 AI_PROVIDER 设置为 'gemini' 或 'openrouter'。"
         print(f"错误：{error_msg}")
         return {"error": error_msg}
 
+def _group_by_model(items, model_key):
+    """按模型分组 (保持原有顺序)，同一批量请求只能发给同一个模型"""
+    groups = {}
+    for item in items:
+        groups.setdefault(item.get(model_key), []).append(item)
+    return groups.items()
+
+def triage_pending(pending_analyses, proxies=None):
+    """
+    用分诊模型为每个待分析窗口给出 {"flag", "score"}。
+    :param pending_analyses: 已附带 "tier" 分级设置的窗口列表。
+    :return: {窗口 ID: 分诊结果或 None}
+    """
+    verdicts = {}
+    items = [dict(item, triage_model=item["tier"]["triage_model"]) for item in pending_analyses]
+    for triage_model, group in _group_by_model(items, "triage_model"):
+        model_name = triage_model or "默认模型"
+        if getattr(config, "BATCH_REQUESTS", True) and len(group) > 1:
+            for batch in plan_batches(group, getattr(config, "BATCH_MAX_CHARS", 60000), getattr(config, "BATCH_MAX_SECTIONS", 8)):
+                if len(batch) == 1:
+                    continue
+                section_ids = [item["id"] for item in batch]
+                print(f"模型分级: 使用 {model_name} 批量分诊 {len(batch)} 个分段 ({', '.join(section_ids)})...")
+                batch_result = call_ai_api(
+                    build_batch_prompt(batch),
+                    proxies=proxies,
+                    system_instruction_text=cascade.TRIAGE_BATCH_SYSTEM_INSTRUCTION,
+                    user_prompt_prefix=BATCH_USER_PROMPT_PREFIX,
+                    max_output_tokens=cascade.TRIAGE_MAX_OUTPUT_TOKENS * len(batch),
+                    response_schema=cascade.build_triage_batch_schema(section_ids),
+                    model=triage_model,
+                )
+                for section_id, verdict in split_batch_result(batch_result, section_ids).items():
+                    if verdict is not None:
+                        verdicts[section_id] = verdict
+        for item in group:
+            if item["id"] not in verdicts:
+                print(f"模型分级: 使用 {model_name} 分诊 {item['log_type']} 日志 ({len(item['lines'])} 行)...")
+                verdicts[item["id"]] = call_ai_api(
+                    item["b64"],
+                    proxies=proxies,
+                    system_instruction_text=cascade.TRIAGE_SYSTEM_INSTRUCTION,
+                    user_prompt_prefix=cascade.TRIAGE_USER_PROMPT_PREFIX,
+                    max_output_tokens=cascade.TRIAGE_MAX_OUTPUT_TOKENS,
+                    response_schema=cascade.TRIAGE_RESPONSE_SCHEMA,
+                    model=triage_model,
+                )
+    return verdicts
+
+def analyze_pending(pending_analyses, proxies=None):
+    """
+    调用 AI 分析待处理的日志窗口。
+    启用 ENABLE_MODEL_CASCADE 时先由分诊模型评分，只有达到升级阈值的窗口才交给深度分析模型。
+    启用 BATCH_REQUESTS 时把多个窗口打包为一次多分段请求，响应中缺失的分段再单独请求。
+    启用 COMPACT_OUTPUT_MODE 时以紧凑结构约束模型输出，返回前展开为常规结果结构。
+    :param pending_analyses: [{"id", "log_type", "lines", "b64"}]
+    :return: [(窗口, 分析结果或 None)]，顺序与输入一致。
+    """
+    ai_provider = getattr(config, "AI_PROVIDER", "gemini").lower()
+    compact = getattr(config, "COMPACT_OUTPUT_MODE", True)
+    compact_max_tokens = getattr(config, "COMPACT_MAX_OUTPUT_TOKENS", 1024)
+    results = {}
+
+    escalated = pending_analyses
+    if cascade.is_enabled(config):
+        tiered = []
+        for item in pending_analyses:
+            tier = cascade.tier_settings(config, item["log_type"])
+            item = dict(item, tier=tier, model=tier["analysis_model"])
+            tiered.append(item)
+        pending_analyses = tiered
+        to_triage = [item for item in tiered if item["tier"]["enabled"]]
+        verdicts = triage_pending(to_triage, proxies=proxies) if to_triage else {}
+        escalated = []
+        for item in tiered:
+            if not item["tier"]["enabled"]:
+                escalated.append(item)
+                continue
+            verdict = verdicts.get(item["id"])
+            threshold = item["tier"]["escalate_score"]
+            if cascade.should_escalate(verdict, threshold):
+                escalated.append(item)
+                if verdict and not verdict.get("error"):
+                    print(f"模型分级: {item['log_type']} 分诊评分 {verdict['score']} 达到阈值 {threshold}，升级到深度分析。")
+                else:
+                    print(f"模型分级: {item['log_type']} 分诊失败，直接升级到深度分析。")
+            else:
+                results[item["id"]] = {
+                    "findings": [],
+                    "summary": f"分诊模型评分 {verdict['score']} 低于升级阈值 {threshold}，{len(item['lines'])} 行日志未发现需要深度分析的内容。",
+                    "triage": {"flag": verdict.get("flag"), "score": verdict["score"], "model": item["tier"]["triage_model"]},
+                }
+        print(f"模型分级: {len(tiered)} 个窗口中 {len(escalated)} 个升级到深度分析。")
+
+    if getattr(config, "BATCH_REQUESTS", True) and len(escalated) > 1:
+        batches = []
+        for _, group in _group_by_model(escalated, "model"):
+            batches.extend(plan_batches(group,
+                                        getattr(config, "BATCH_MAX_CHARS", 60000),
+                                        getattr(config, "BATCH_MAX_SECTIONS", 8)))
+        for batch in batches:
+            if len(batch) == 1:
+                continue
+            section_ids = [item["id"] for item in batch]
+            total_lines = sum(len(item["lines"]) for item in batch)
+            print(f"准备调用 {ai_provider.upper()} API 批量分析 {len(batch)} 个分段 ({', '.join(section_ids)}; 共 {total_lines} 行)...")
+            if compact:
+                batch_options = {
+                    "system_instruction_text": COMPACT_BATCH_SYSTEM_INSTRUCTION,
+                    "response_schema": build_batch_schema(section_ids),
+                    "max_output_tokens": compact_max_tokens * len(batch),
+                }
+            else:
+                batch_options = {
+                    "system_instruction_text": BATCH_SYSTEM_INSTRUCTION,
+                    "max_output_tokens": getattr(config, "BATCH_MAX_OUTPUT_TOKENS", None),
+                }
+            batch_result = call_ai_api(
+                build_batch_prompt(batch),
+                proxies=proxies,
+                user_prompt_prefix=BATCH_USER_PROMPT_PREFIX,
+                model=batch[0].get("model"),
+                **batch_options
+            )
+            for section_id, section_result in split_batch_result(batch_result, section_ids).items():
+                if section_result is not None:
+                    results[section_id] = section_result
+                else:
+                    print(f"批量响应中缺少分段 {section_id}，将单独请求。")
+
+    analyzed = []
+    for item in pending_analyses:
+        if item["id"] not in results:
+            print(f"准备调用 {ai_provider.upper()} API 分析 {item['log_type']} 日志 ({len(item['lines'])} 行, Base64编码后长度: {len(item['b64'])})...")
+            single_options = {}
+            if compact:
+                single_options = {
+                    "system_instruction_text": COMPACT_SYSTEM_INSTRUCTION,
+                    "response_schema": COMPACT_RESPONSE_SCHEMA,
+                    "max_output_tokens": compact_max_tokens,
+                }
+            results[item["id"]] = call_ai_api(item["b64"], proxies=proxies, model=item.get("model"), **single_options) # 发送 Base64 编码后的数据
+        result = results[item["id"]]
+        if is_compact(result):
+            # 类别代码 / 行序号 -> 描述、建议和原始日志行
+            result = expand_compact(result, item["lines"])
+        analyzed.append((item, result))
+    return analyzed
+
+def build_pending_item(item_id, log_type, lines, header=""):
+    """
+    把日志窗口编码为待分析项 {"id", "log_type", "lines", "b64"}
+    :param header: 放在日志数据前面的说明行 (如抽样统计)，不计入行序号。
+    """
+    import base64
+    if getattr(config, "COMPACT_OUTPUT_MODE", True):
+        log_data_str_raw = number_lines(lines) # 紧凑模式下模型按行序号引用日志
+    else:
+        log_data_str_raw = "".join(lines)
+    # 对原始日志字符串进行 Base64 编码
+    log_data_str_b64 = base64.b64encode((header + log_data_str_raw).encode('utf-8')).decode('utf-8')
+    return {"id": item_id, "log_type": log_type, "lines": lines, "b64": log_data_str_b64}
+
+def annotate_sampling(result, sampling):
+    """在抽样窗口的分析结果上附加抽样统计，并在摘要前注明真实流量与抽样率"""
+    result["sampling"] = sampling
+    result["summary"] = (f"[抽样分析: 本间隔 {sampling['total_records']} 条请求中抽取 {sampling['sampled_records']} 条，"
+                         f"抽样率 {sampling['sampling_rate']:.2%}] {result.get('summary', '')}")
+
+def drain_spool(spool, proxies=None):
+    """
+    重放待分析队列中积压的窗口 (有限并发)。
+    :return: 可直接写入报告的结果列表。
+    """
+    def replay(entry):
+        sampling = entry.get("sampling")
+        item = build_pending_item(f"spool_{entry['id'][:8]}", entry["log_type"], entry["lines"],
+                                  header=format_sampling_header(sampling) if sampling else "") # 重放时保留抽样说明
+        _, result = analyze_pending([item], proxies=proxies)[0]
+        return bool(result) and not result.get("error"), result
+
+    print(f"待分析队列中有 {len(spool)} 个积压窗口，开始重放...")
+    results = []
+    fingerprint_store = get_fingerprint_store()
+    max_attempts = getattr(config, "SPOOL_MAX_ATTEMPTS", 5)
+    outcomes = drain(spool, replay,
+                     concurrency=getattr(config, "SPOOL_DRAIN_CONCURRENCY", 2),
+                     max_items=getattr(config, "SPOOL_DRAIN_MAX_ITEMS", 20),
+                     max_attempts=max_attempts)
+    for entry, result, status in outcomes:
+        log_type = entry["log_type"]
+        queued_at = datetime.fromtimestamp(entry["ts"]).strftime('%Y-%m-%d %H:%M:%S')
+        if status == "done":
+            result.setdefault("log_type", log_type)
+            result.setdefault("timestamp", datetime.now().isoformat())
+            if entry.get("sampling"):
+                annotate_sampling(result, entry["sampling"])
+            result["summary"] = f"[补发分析: 窗口于 {queued_at} 写入待分析队列] {result.get('summary', '')}"
+            if fingerprint_store is not None:
+                result["findings"] = fingerprint_store.record_findings(log_type, result.get("findings") or [])
+            results.append(result)
+        elif status == "gave_up":
+            results.append({
+                "timestamp": datetime.now().isoformat(),
+                "log_type": log_type,
+                "error": (result or {}).get("error") or "API call returned no result or an unrecoverable error.",
+                "summary": f"{queued_at} 写入待分析队列的 {len(entry['lines'])} 行日志重放 {max_attempts} 次均失败，已放弃。"
+            })
+    remaining = len(spool)
+    done = sum(1 for _, _, status in outcomes if status == "done")
+    corrupt = sum(1 for _, _, status in outcomes if status == "corrupt")
+    print(f"待分析队列: 本轮重放成功 {done} 个窗口，剩余 {remaining} 个" + (f"，丢弃 {corrupt} 个无法读取的窗口。" if corrupt else "。"))
+    return results
+
 def update_report_html(analysis_results):
     """将分析结果更新到静态 HTML 报告页面"""
     # TODO: 实现 HTML 生成逻辑
@@ -126,6 +660,11 @@ def update_report_html(analysis_results):
         .log-entry p {{
             margin: 10px 0;
         }}
+        .log-entry.recurring {{ /* 重复出现的发现，折叠显示 */
+            padding: 8px 20px;
+            margin-bottom: 12px;
+            color: #6c757d;
+        }}
         .log-entry strong.label {{ /* For "Description:", "Recommendation:" etc. */
             color: #343a40; /* Darker label */
             font-weight: 600; /* Slightly bolder */
@@ -295,6 +834,15 @@ def update_report_html(analysis_results):
                 description = finding.get('description', '无描述。')
                 recommendation = finding.get('recommendation', '')
                 log_lines = finding.get('log_lines', [])
+                seen_count = finding.get('seen_count', 1)
+
+                if seen_count > 1:
+                    # 重复出现的发现折叠为一行，避免报告中出现重复区块
+                    first_seen = datetime.fromtimestamp(finding.get('first_seen', time.time())).strftime("%Y-%m-%d %H:%M:%S")
+                    report_content_accumulator += f"<div class='log-entry recurring severity-{severity}'>\n"
+                    report_content_accumulator += f"  <p><span class='severity-badge severity-{severity}'>{severity.upper()}</span> {description} <em>(已出现 {seen_count} 次，自 {first_seen} 起)</em></p>\n"
+                    report_content_accumulator += "</div>\n"
+                    continue
 
                 report_content_accumulator += f"<div class='log-entry severity-{severity}'>\n"
                 report_content_accumulator += f"  <p><strong class='label'>严重性:</strong> <span class='severity-badge severity-{severity}'>{severity.upper()}</span></p>\n"
@@ -305,6 +853,8 @@ def update_report_html(analysis_results):
                     report_content_accumulator += f"  <p><strong class='label'>相关日志:</strong></p><pre class='raw-output'>{''.join(log_lines)}</pre>\n"
                 report_content_accumulator += "</div>\n"
             report_content_accumulator += f"<p class='summary'><strong class='label'>总体摘要:</strong> {summary}</p>\n"
+        if result_group.get("parse_recovery"):
+            report_content_accumulator += f"<p class='report-meta'>模型输出经过修复: {result_group['parse_recovery']}</p>\n"
         
         report_content_accumulator += "<hr>\n"
 
@@ -324,7 +874,20 @@ def update_report_html(analysis_results):
         print(f"写入报告 {config.REPORT_HTML_PATH} 失败: {e}")
 
 def is_nginx_running():
-    """检查 Nginx 服务是否正在运行并监听端口"""
+    """检查 Nginx 服务是否正在运行并监听端口 (直接读取 /proc，不可用时回退为 systemctl + ss/netstat)"""
+    if not os.path.exists('/proc/net/tcp'):
+        return _is_nginx_running_by_commands()
+    status = probe_nginx(getattr(config, "HEALTH_EXPECTED_PORTS", (80, 443)))
+    if status["running"]:
+        print(f"Nginx 正在运行并监听端口 {', '.join(map(str, status['ports']))} (master pid {status['master_pid']}, {status['workers']} 个 worker)。")
+    elif status["master_pid"] or status["workers"]:
+        print(f"Nginx 进程存在 (master pid {status['master_pid']})，但未检测到其监听任何端口。")
+    else:
+        print("未检测到 Nginx 进程。")
+    return status["running"]
+
+def _is_nginx_running_by_commands():
+    """通过 systemctl 与 ss/netstat 检查 Nginx 状态 (没有 /proc 的系统使用)"""
     try:
         # 检查 systemd 服务状态
         active_check = subprocess.run(['systemctl', 'is-active', 'nginx'], capture_output=True, text=True, check=False)
@@ -366,62 +929,359 @@ def is_nginx_running():
         print(f"检查 Nginx 状态时发生未知错误: {e}")
         return False
 
-def perform_scan_and_update_report(proxies=None):
-    """执行一次完整的日志扫描、分析和报告更新。"""
-    print(f"\n[{datetime.now().isoformat()}] 开始新一轮日志检测...")
-    all_analysis_results_for_this_run = []
+def _stage_tail(scan, source, emit):
+    """tail: 把新增的每一行交给本地检测器，并读取日志来源的最新 (或新增) 日志记录"""
+    log_type, log_path = source
+    print(f"正在读取 {log_type} 日志: {log_path}")
+    detector_findings = feed_detectors(log_path, log_type)
+    if detector_findings:
+        print(f"本地检测器在 {log_type} 日志中发现 {len(detector_findings)} 个问题。")
+        fingerprint_store = get_fingerprint_store()
+        if fingerprint_store is not None:
+            detector_findings = fingerprint_store.record_findings(log_type, detector_findings)
+        emit({"result": {
+            "timestamp": datetime.now().isoformat(),
+            "log_type": f"{log_type}_local_detectors",
+            "findings": detector_findings,
+            "summary": "由本地滑动窗口检测器 (暴力破解 / 目录枚举 / php-fpm 饱和) 生成，未经过 AI 分析。"
+        }}, to="sink")
+    sampling = None
+    if getattr(config, "ENABLE_TRAFFIC_SAMPLING", False) and log_type in getattr(config, "SAMPLING_LOG_TYPES", ("nginx_access",)):
+        offsets = _log_offsets if _log_offsets is not None else _sampling_offsets
+        first_read = log_path not in offsets
+        records, sampling = read_sampled_records(log_path, log_type, scan["max_lines"], offsets)
+        if records == [] and not first_read:
+            print(f"{log_type} 日志自上次检测后没有新内容，跳过分析。")
+            return
+        if sampling:
+            print(f"{log_type} 日志本间隔共 {sampling['total_records']} 条记录，分层抽样 {sampling['sampled_records']} 条 "
+                  f"(抽样率 {sampling['sampling_rate']:.2%}，必选 {sampling['always_included']} 条，稀有 {sampling['rare_included']} 条"
+                  + (f"，列式存储约 {sampling['store_bytes'] / 1024 / 1024:.1f} MB" if sampling.get("store_bytes") else "") + ")。")
+    else:
+        records = read_log_records(log_path, log_type, scan["max_lines"], _log_offsets)
+        if records == [] and _log_offsets is not None:
+            print(f"{log_type} 日志自上次检测后没有新内容，跳过分析。")
+            return
 
-    log_files_to_scan = {
-        "nginx_access": config.NGINX_ACCESS_LOG_PATH,
-        "nginx_error": config.NGINX_ERROR_LOG_PATH,
-        "php_fpm": config.PHP_FPM_LOG_PATH,
-    }
+    if not records:
+        print(f"{log_type} 日志为空或读取失败，跳过分析。")
+        emit({"result": {
+            "timestamp": datetime.now().isoformat(),
+            "log_type": log_type,
+            "findings": [],
+            "summary": f"日志文件 {log_path} 为空或无法读取。"
+        }}, to="sink")
+        return
+    emit({"log_type": log_type, "records": records, "sampling": sampling})
 
-    for log_type, log_path in log_files_to_scan.items():
-        print(f"正在读取 {log_type} 日志: {log_path}")
-        latest_lines = read_latest_log_lines(log_path, config.LOG_LINES_TO_READ)
+def _stage_parse(scan, window, emit):
+    """parse: 以记录为单位排除已分析过的行"""
+    log_type, records = window["log_type"], window["records"]
+    fingerprint_store = get_fingerprint_store()
+    if fingerprint_store is not None:
+        # 以记录为单位排除: 只要记录中有未分析过的行就整条保留 (堆栈中的重复帧不会让记录被拆开)
+        new_lines = set(fingerprint_store.filter_new_lines(log_type, record_lines(records)))
+        new_records = [record for record in records if any(line in new_lines for line in record.lines)]
+        if len(new_records) < len(records):
+            print(f"{log_type} 日志中有 {len(records) - len(new_records)} 条记录已在之前分析过，本次排除。")
+        if not new_records:
+            print(f"{log_type} 日志自上次检测后没有新内容，跳过分析。")
+            return
+        records = new_records
+    emit(dict(window, records=records))
 
-        if not latest_lines:
-            print(f"{log_type} 日志为空或读取失败，跳过分析。")
-            empty_log_result = {
+def _stage_filter(scan, window, emit):
+    """filter: 本地异常评分闸门，低于阈值的窗口不送去 AI 分析"""
+    log_type, records = window["log_type"], window["records"]
+    latest_lines = record_lines(records)
+    anomaly_detector = get_anomaly_detector(log_type)
+    if anomaly_detector is not None:
+        warming_up = anomaly_detector.windows_seen < getattr(config, "ANOMALY_WARMUP_WINDOWS", 3)
+        verdict = anomaly_detector.score_window(latest_lines)
+        health_score = scan["health_score"]
+        if health_score:
+            # 运行指标 (连接数、请求速率、fpm 队列) 偏离基线时，同一时段的日志窗口也应送去分析
+            verdict["components"]["health"] = health_score
+            verdict["score"] = max(verdict["score"], health_score)
+        threshold = getattr(config, "ANOMALY_SCORE_THRESHOLD", 3.0)
+        print(f"{log_type} 本地异常评分: {verdict['score']} (阈值 {threshold}{', 基线预热中' if warming_up else ''}) {verdict['components']}")
+        if verdict["score"] < threshold and not warming_up:
+            fingerprint_store = get_fingerprint_store()
+            if fingerprint_store is not None:
+                fingerprint_store.mark_lines(log_type, latest_lines)
+            emit({"result": {
                 "timestamp": datetime.now().isoformat(),
                 "log_type": log_type,
                 "findings": [],
-                "summary": f"日志文件 {log_path} 为空或无法读取。"
-            }
-            all_analysis_results_for_this_run.append(empty_log_result)
-            continue
+                "summary": f"本地异常评分 {verdict['score']} 低于阈值 {threshold}，{len(latest_lines)} 行日志未发现明显异常，未调用 AI 分析。"
+            }}, to="sink")
+            return
+        records = select_top_records(records, verdict["line_scores"],
+                                     getattr(config, "ANOMALY_MAX_LINES_TO_SEND", config.LOG_LINES_TO_READ))
+    emit(dict(window, records=records))
 
-        import base64
-        log_data_str_raw = "".join(latest_lines)
-        # 对原始日志字符串进行 Base64 编码
-        log_data_str_b64 = base64.b64encode(log_data_str_raw.encode('utf-8')).decode('utf-8')
-        
-        ai_provider = getattr(config, "AI_PROVIDER", "gemini").lower()
-        print(f"准备调用 {ai_provider.upper()} API 分析 {log_type} 日志 ({len(latest_lines)} 行, Base64编码后长度: {len(log_data_str_b64)})...")
+def _stage_chunk(scan, window, emit):
+    """chunk: 按 PIPELINE_CHUNK_LINES 在记录边界处切分窗口并编码为待分析项"""
+    log_type = window["log_type"]
+    chunks = chunk_records(window["records"], getattr(config, "PIPELINE_CHUNK_LINES", 0))
+    for index, chunk in enumerate(chunks):
+        item_id = log_type if len(chunks) == 1 else f"{log_type}_{index + 1}"
+        item = build_pending_item(item_id, log_type, record_lines(chunk),
+                                  header=format_sampling_header(window["sampling"]) if window.get("sampling") else "")
+        if window.get("sampling"):
+            item["sampling"] = window["sampling"]
+        item["chunk"] = index # 报告中同一日志来源的分块按顺序排列
+        emit(item)
 
-        analysis_result = call_ai_api(log_data_str_b64, proxies=proxies) # 发送 Base64 编码后的数据
+def _stage_analyze(scan, items, emit):
+    """analyze: 调用 AI 分析 (同一批内的多个待分析项可合并为一次批量请求)"""
+    deadline = current_deadline()
+    if deadline is not None and deadline.expired():
+        # 已过本轮截止时间: 不再发出新的请求 (启用待分析队列时窗口由 sink 写入队列，稍后重放)
+        print(f"本轮扫描已到截止时间，取消 {len(items)} 个窗口的分析请求。")
+        for item in items:
+            emit({"item": item, "analysis": {"error": "Scan deadline exceeded; analysis request cancelled.", "deadline_exceeded": True}})
+        return
+    for item, analysis_result in analyze_pending(items, proxies=scan["proxies"]):
+        emit({"item": item, "analysis": analysis_result})
 
-        if analysis_result:
-            analysis_result.setdefault("log_type", log_type)
-            analysis_result.setdefault("timestamp", datetime.now().isoformat())
-            all_analysis_results_for_this_run.append(analysis_result)
-            print(f"{ai_provider.upper()} API 对 {log_type} 日志分析完成。")
+def _sink_append(scan, result, log_type=None, chunk=0):
+    """
+    sink 收集一个结果。各日志来源在并行的工作线程中完成，到达顺序每轮都不同，因此结果带上
+    (日志来源顺序, 本地检测器在前, 分块序号) 排序键，流水线结束后按配置的日志来源顺序写入报告。
+    :param log_type: 结果所属的日志来源，默认取 result["log_type"] (模型返回的 log_type 不可靠，分析结果应显式传入)。
+    """
+    log_type = log_type or str(result.get("log_type", ""))
+    detectors = log_type.endswith("_local_detectors")
+    source = log_type[:-len("_local_detectors")] if detectors else log_type
+    source_order = scan["source_order"]
+    scan["sink_results"].append(((source_order.get(source, len(source_order)), 0 if detectors else 1, chunk), result))
+
+def _stage_sink(scan, message, emit):
+    """sink: 汇总结果 (单线程)，更新指纹存储；提供商调用失败的窗口写入待分析队列"""
+    if "result" in message:
+        _sink_append(scan, message["result"])
+        notify_findings(message["result"])
+        return
+    item, analysis_result = message["item"], message["analysis"]
+    chunk = item.get("chunk", 0)
+    log_type = item["log_type"]
+    ai_provider = getattr(config, "AI_PROVIDER", "gemini").lower()
+    fingerprint_store = get_fingerprint_store()
+    spool = get_spool()
+    if spool is not None and is_provider_outage(analysis_result):
+        # 提供商暂时不可用: 窗口 (连同抽样统计) 写入磁盘队列，提供商恢复后重放，而不是就此丢失。
+        # 配置错误 (如未设置 API Key) 与模型输出无法解析不会因重放而好转，按普通失败处理，不写入队列
+        scan["provider_failed"] = True
+        spool.put(log_type, item["lines"], sampling=item.get("sampling"))
+        if fingerprint_store is not None:
+            fingerprint_store.mark_lines(log_type, item["lines"]) # 已交给队列，后续扫描不再重复发送
+        print(f"{ai_provider.upper()} API 对 {log_type} 日志分析失败，{len(item['lines'])} 行日志已写入待分析队列 (积压 {len(spool)} 个窗口)。")
+        _sink_append(scan, {
+            "timestamp": datetime.now().isoformat(),
+            "log_type": log_type,
+            "error": analysis_result["error"],
+            "summary": f"无法从{ai_provider.upper()} API获取分析结果，日志窗口已写入待分析队列，将在提供商恢复后重新分析。"
+        }, log_type, chunk)
+        return
+    if analysis_result:
+        analysis_result.setdefault("log_type", log_type)
+        analysis_result.setdefault("timestamp", datetime.now().isoformat())
+        if item.get("sampling"):
+            annotate_sampling(analysis_result, item["sampling"])
+        if fingerprint_store is not None and not analysis_result.get("error"):
+            # 只有成功分析的行才标记为已分析，失败的窗口留待下次重试
+            fingerprint_store.mark_lines(log_type, item["lines"])
+            analysis_result["findings"] = fingerprint_store.record_findings(log_type, analysis_result.get("findings") or [])
+        _sink_append(scan, analysis_result, log_type, chunk)
+        notify_findings(analysis_result)
+        if analysis_result.get("error"):
+            print(f"{ai_provider.upper()} API 对 {log_type} 日志分析失败: {analysis_result['error']}")
         else:
-            print(f"{ai_provider.upper()} API 对 {log_type} 日志分析失败。")
-            error_result = {
-                "timestamp": datetime.now().isoformat(),
-                "log_type": log_type,
-                "error": "API call returned no result or an unrecoverable error.",
-                "summary": f"无法从{ai_provider.upper()} API获取分析结果。"
-            }
-            all_analysis_results_for_this_run.append(error_result)
+            print(f"{ai_provider.upper()} API 对 {log_type} 日志分析完成。")
+    else:
+        print(f"{ai_provider.upper()} API 对 {log_type} 日志分析失败。")
+        _sink_append(scan, {
+            "timestamp": datetime.now().isoformat(),
+            "log_type": log_type,
+            "error": "API call returned no result or an unrecoverable error.",
+            "summary": f"无法从{ai_provider.upper()} API获取分析结果。"
+        }, log_type, chunk)
+
+_last_pipeline_stats = None
+
+def build_scan_pipeline(scan):
+    """按 PIPELINE_WORKERS / PIPELINE_QUEUE_SIZE 配置创建本轮扫描的流水线"""
+    workers = dict({"tail": 3, "parse": 1, "filter": 1, "chunk": 1, "analyze": 2}, **getattr(config, "PIPELINE_WORKERS", {}))
+    queue_size = getattr(config, "PIPELINE_QUEUE_SIZE", 16)
+    batch_size = getattr(config, "BATCH_MAX_SECTIONS", 8) if getattr(config, "BATCH_REQUESTS", True) else 1
+    return Pipeline([
+        Stage("tail", partial(_stage_tail, scan), workers["tail"], queue_size),
+        Stage("parse", partial(_stage_parse, scan), workers["parse"], queue_size),
+        Stage("filter", partial(_stage_filter, scan), workers["filter"], queue_size),
+        Stage("chunk", partial(_stage_chunk, scan), workers["chunk"], queue_size),
+        Stage("analyze", partial(_stage_analyze, scan), workers["analyze"], queue_size,
+              batch_size=batch_size, linger_seconds=getattr(config, "PIPELINE_BATCH_LINGER_SECONDS", 0.2)),
+        Stage("sink", partial(_stage_sink, scan), 1, queue_size), # 汇总阶段固定单线程，避免并发修改结果与队列状态
+    ])
+
+def perform_scan_and_update_report(proxies=None, budget_factor=1.0, deadline=None):
+    """
+    执行一次完整的日志扫描、分析和报告更新 (tail → parse → filter → chunk → analyze → sink 流水线)。
+    :param budget_factor: 读取行数预算的缩放系数 (调度器以缩减预算追赶进度时小于 1)。
+    :param deadline: 本轮扫描的截止时间 (scheduler.Deadline)，到期后取消尚未完成的提供商请求。
+    """
+    set_scan_deadline(deadline)
+    try:
+        _perform_scan(proxies, budget_factor, deadline)
+    finally:
+        set_scan_deadline(None)
+
+def _perform_scan(proxies, budget_factor, deadline):
+    global _last_pipeline_stats
+    print(f"\n[{datetime.now().isoformat()}] 开始新一轮日志检测...")
+    scan = {"results": [], "sink_results": [], "proxies": proxies, "health_score": 0.0, "provider_failed": False,
+            "max_lines": max(1, int(config.LOG_LINES_TO_READ * budget_factor))}
+    if budget_factor < 1.0:
+        print(f"本轮以缩减预算运行: 每个日志最多读取 {scan['max_lines']} 行。")
+
+    health_monitor = get_health_monitor()
+    if health_monitor is not None:
+        if not health_monitor.running:
+            health_monitor.sample() # 未启动后台轮询时 (单次运行模式) 在扫描开始时采样一次
+        health_result = health_monitor.report(window_seconds=config.SCAN_INTERVAL_SECONDS)
+        if health_result:
+            fingerprint_store = get_fingerprint_store()
+            if fingerprint_store is not None and health_result["findings"]:
+                # 与本地检测器的发现一样记录 seen_count，重复出现的健康告警不会每个冷却周期都通知一次
+                health_result["findings"] = fingerprint_store.record_findings("system_health", health_result["findings"])
+            scan["results"].append(health_result)
+            notify_findings(health_result)
+        scan["health_score"] = health_monitor.anomaly_score()
+
+    log_files_to_scan = {
+        "nginx_access": config.NGINX_ACCESS_LOG_PATH,
+        "nginx_error": config.NGINX_ERROR_LOG_PATH,
+        "php_fpm": config.PHP_FPM_LOG_PATH,
+    }
+
+    scan["source_order"] = {log_type: index for index, log_type in enumerate(log_files_to_scan)}
+
+    _last_pipeline_stats = build_scan_pipeline(scan).run(log_files_to_scan.items())
+    print(f"流水线统计: {format_stats(_last_pipeline_stats)}")
+    # 按日志来源顺序 (access → error → php-fpm)、分块序号排列，报告各部分的顺序不受并行完成顺序影响
+    scan["results"].extend(result for _, result in sorted(scan["sink_results"], key=lambda entry: entry[0]))
+    all_analysis_results_for_this_run = scan["results"]
+
+    spool = get_spool()
+    if deadline is not None and deadline.expired():
+        print("本轮扫描已到截止时间，跳过待分析队列的重放。")
+    elif spool is not None and len(spool) and not scan["provider_failed"]:
+        for result in drain_spool(spool, proxies=proxies):
+            all_analysis_results_for_this_run.append(result)
+            notify_findings(result)
     
+    if _fingerprint_store is not None:
+        _fingerprint_store.save()
+
     if all_analysis_results_for_this_run:
         update_report_html(all_analysis_results_for_this_run)
     else:
         print("本轮没有日志数据被分析，不更新报告。")
 
+def collect_state():
+    """收集需要跨进程保留的状态，写入快照"""
+    ai_provider = getattr(config, "AI_PROVIDER", "gemini").lower()
+    state = {
+        "log_offsets": _log_offsets or {},
+        "detector_offsets": _detector_offsets,
+        "anomaly": {log_type: detector.to_dict() for log_type, detector in _anomaly_detectors.items()},
+    }
+    if _detector_set is not None:
+        state["detectors"] = _detector_set.to_dict()
+    if _health_monitor is not None:
+        state["health"] = _health_monitor.to_dict()
+    if ai_provider == "gemini":
+        from prompt_cache import gemini_prompt_cache
+        state["gemini_prompt_cache"] = gemini_prompt_cache.to_dict()
+    elif ai_provider == "openrouter":
+        from prompt_cache import openrouter_cache_hints
+        state["openrouter_cache_hints"] = openrouter_cache_hints.to_dict()
+    return state
+
+def restore_state(snapshot):
+    """从快照恢复状态 (只恢复当前配置启用的组件)"""
+    global _log_offsets
+    _log_offsets = dict(snapshot.get("log_offsets") or {})
+    _detector_offsets.update(snapshot.get("detector_offsets") or {})
+    for log_type, data in (snapshot.get("anomaly") or {}).items():
+        detector = get_anomaly_detector(log_type)
+        if detector is not None:
+            detector.load_dict(data)
+    detector_set = get_detector_set()
+    if detector_set is not None and snapshot.get("detectors"):
+        detector_set.load_dict(snapshot["detectors"])
+    health_monitor = get_health_monitor()
+    if health_monitor is not None and snapshot.get("health"):
+        health_monitor.load_dict(snapshot["health"])
+    if snapshot.get("gemini_prompt_cache"):
+        from prompt_cache import gemini_prompt_cache
+        gemini_prompt_cache.load_dict(snapshot["gemini_prompt_cache"])
+    if snapshot.get("openrouter_cache_hints"):
+        from prompt_cache import openrouter_cache_hints
+        openrouter_cache_hints.load_dict(snapshot["openrouter_cache_hints"])
+
+def run_once(proxies=None, state_path=None):
+    """
+    单次运行模式 (供 systemd timer / cron 调用): 从快照恢复状态，执行一次扫描，保存快照后退出。
+    Gemini 提示缓存不在退出时删除，而是记录在快照中供下一次运行继续使用，直到过期。
+    :return: 进程退出码。
+    """
+    snapshot = load_snapshot(state_path)
+    restore_state(snapshot)
+    startup_ms = round((time.perf_counter() - _STARTED_AT) * 1000, 1)
+    previous_metrics = snapshot.get("metrics") or {}
+    previous_first_request = previous_metrics.get("first_request_ms")
+    print(f"单次运行模式: 启动耗时 {startup_ms} ms" +
+          (f" (上次冷启动到首次 AI 请求: {previous_first_request} ms)。" if previous_first_request is not None else "。"))
+
+    if config.ENABLE_NGINX_STATUS_CHECK and not is_nginx_running():
+        print("Nginx 服务未运行或未正确监听端口，本次不执行扫描。")
+        update_report_html([{
+            "timestamp": datetime.now().isoformat(),
+            "log_type": "system_check",
+            "error": "Nginx 服务未运行或未正确监听端口。",
+            "summary": "无法执行安全扫描，因为依赖的 Nginx 服务存在问题。"
+        }])
+        return 1
+    if not os.path.exists(config.REPORT_HTML_PATH):
+        update_report_html([])
+
+    scan_started_at = time.time()
+    deadline = Deadline(getattr(config, "SCAN_DEADLINE_SECONDS", None) or config.SCAN_INTERVAL_SECONDS)
+    perform_scan_and_update_report(proxies=proxies, deadline=deadline)
+
+    state = collect_state()
+    state["metrics"] = {
+        "startup_ms": startup_ms,
+        # 调度指标: 与上一次运行的间隔 (实际周期) 以及本次开始时数据距上一次扫描完成的时间 (陈旧度)
+        "scan_started_at": scan_started_at,
+        "period_seconds": round(scan_started_at - previous_metrics["scan_started_at"], 3) if previous_metrics.get("scan_started_at") else None,
+        "staleness_seconds": round(scan_started_at - snapshot["saved_at"], 3) if snapshot.get("saved_at") else None,
+        "deadline_exceeded": deadline.expired(),
+        # 本次没有调用 AI 时沿用上一次的数值
+        "first_request_ms": _first_request_ms if _first_request_ms is not None else previous_metrics.get("first_request_ms"),
+        "run_seconds": round(time.perf_counter() - _STARTED_AT, 3),
+        "pipeline": _last_pipeline_stats,
+    }
+    save_snapshot(state_path, state)
+    if _alert_dispatcher is not None:
+        # 进程即将退出: 立即结束合并窗口并等待告警发送完毕
+        _alert_dispatcher.stop(flush_timeout=getattr(config, "ALERT_FLUSH_TIMEOUT_SECONDS", 15))
+    print(f"单次运行完成，总耗时 {state['metrics']['run_seconds']} 秒" +
+          (f"，距上次运行 {state['metrics']['period_seconds']} 秒。" if state['metrics']['period_seconds'] is not None else "。"))
+    return 0
+
 def main_scan_loop():
     """主扫描循环"""
     if config.ENABLE_NGINX_STATUS_CHECK:
@@ -454,22 +1314,62 @@ def main_scan_loop():
         print("报告文件不存在，正在创建初始报告结构...")
         update_report_html([])
     
+    health_monitor = get_health_monitor()
+    if health_monitor is not None:
+        # 后台按较短间隔采样运行指标，扫描时汇总为报告条目
+        health_monitor.start(getattr(config, "HEALTH_POLL_INTERVAL_SECONDS", 15))
+
+    # 固定速率调度: 按单调时钟上的节拍开始扫描，扫描耗时不会累积为周期漂移
+    scheduler = FixedRateScheduler(
+        config.SCAN_INTERVAL_SECONDS,
+        overrun_policy=getattr(config, "SCAN_OVERRUN_POLICY", "coalesce"),
+        jitter_seconds=getattr(config, "SCAN_JITTER_SECONDS", 0),
+        reduced_budget_factor=getattr(config, "SCAN_REDUCED_BUDGET_FACTOR", 0.5),
+    )
+    current_proxies = getattr(config, "PROXIES", None)
     # 首次启动时立即执行一次扫描
     print("执行首次即时扫描...")
-    current_proxies = getattr(config, "PROXIES", None)
-    perform_scan_and_update_report(proxies=current_proxies)
-    print(f"首次扫描完成。后续将每 {config.SCAN_INTERVAL_SECONDS} 秒检测一次。")
-
     while True:
-        print(f"等待 {config.SCAN_INTERVAL_SECONDS} 秒进行下一次检测...")
-        time.sleep(config.SCAN_INTERVAL_SECONDS)
-        perform_scan_and_update_report(proxies=current_proxies)
-        print(f"本轮检测完成。")
+        tick = scheduler.wait_next()
+        if tick["overrun"]:
+            print(f"上一轮扫描超过了 {config.SCAN_INTERVAL_SECONDS} 秒的间隔，按 {scheduler.overrun_policy} 策略立即开始下一轮。")
+        perform_scan_and_update_report(proxies=current_proxies, budget_factor=tick["budget_factor"],
+                                       deadline=scheduler.deadline_for(tick, getattr(config, "SCAN_DEADLINE_SECONDS", None)))
+        duration = scheduler.finish(tick)
+        if tick["index"] == 0:
+            print(f"首次扫描完成，耗时 {duration:.1f} 秒。后续将每 {config.SCAN_INTERVAL_SECONDS} 秒检测一次。")
+        else:
+            print(f"本轮检测完成，耗时 {duration:.1f} 秒。调度指标: {format_cadence(scheduler.stats())}")
 
 if __name__ == "__main__":
-    # 确保必要的配置存在
+    import argparse
+    parser = argparse.ArgumentParser(description="Nginx / PHP 日志 AI 安全检测服务")
+    parser.add_argument("--once", action="store_true", help="执行一次扫描后退出 (适用于 systemd timer / cron)，状态保存在快照中")
+    parser.add_argument("--state", default=None, help="状态快照路径 (默认 STATE_SNAPSHOT_PATH)")
+    args = parser.parse_args()
     ai_provider = getattr(config, "AI_PROVIDER", "gemini").lower()
 
+    if args.once:
+        # 单次运行: 跳过下面的完整配置校验和调试输出以缩短冷启动，提供商客户端会在调用时检查自身配置
+        exit_code = 1
+        try:
+            exit_code = run_once(proxies=getattr(config, "PROXIES", None),
+                                 state_path=args.state or getattr(config, "STATE_SNAPSHOT_PATH", None))
+        except Exception as e:
+            print(f"单次运行发生未捕获的错误: {e}")
+        finally:
+            if _spool is not None:
+                _spool.close()
+        sys.exit(exit_code)
+
+    # 确认加载的 OPENROUTER_MODEL 值
+    if hasattr(config, "OPENROUTER_MODEL"):
+        print(f"DEBUG: Loaded OPENROUTER_MODEL = {config.OPENROUTER_MODEL}")
+    else:
+        print("DEBUG: OPENROUTER_MODEL not found in config.")
+
+    # 确保必要的配置存在
+
     required_configs = {
         "AI_PROVIDER": ai_provider,
         "NGINX_ACCESS_LOG_PATH": getattr(config, "NGINX_ACCESS_LOG_PATH", None),
@@ -552,4 +1452,13 @@ if __name__ == "__main__":
             "error": f"服务发生未捕获的致命错误: {e}",
             "summary": "服务意外终止。"
         }]
-        update_report_html(error_report)
\ No newline at end of file
+        update_report_html(error_report)
+    finally:
+        if ai_provider == "gemini":
+            # 清理本次运行创建的 Gemini 提示缓存
+            from prompt_cache import gemini_prompt_cache
+            gemini_prompt_cache.delete_all(config.GEMINI_API_URL, config.GEMINI_API_KEY, proxies=getattr(config, "PROXIES", None))
+        if _spool is not None:
+            _spool.close() # 积压窗口保留在磁盘上，下次启动时恢复
+        if _alert_dispatcher is not None:
+            _alert_dispatcher.stop(flush_timeout=getattr(config, "ALERT_FLUSH_TIMEOUT_SECONDS", 15))
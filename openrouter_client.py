@@ -7,6 +7,9 @@ import datetime
 import os
 import http.client as http_client
 import logging
+from prompt_cache import openrouter_cache_hints
+from json_extract import parse_model_output, describe_recovery
+from scheduler import current_deadline, call_with_deadline, DeadlineExceeded
 
 # http.client debugging (暂不启用)
 # http_client.HTTPConnection.debuglevel = 1
@@ -16,6 +19,12 @@ import logging
 # requests_log.setLevel(logging.DEBUG)
 # requests_log.propagate = True
 
+# 拒绝 json_schema 结构化输出的模型 -> 下次允许尝试的时间
+_json_schema_unsupported = {}
+
+# 单日志分析的默认系统提示 (稳定前缀，可被提示缓存)
+SYSTEM_INSTRUCTION_TEXT = """IMPORTANT: Your ONLY output MUST be a single, valid JSON object. Do NOT include any other text, explanations, or markdown. The JSON object should conform to this structure: {"timestamp": "ISO_timestamp", "log_type": "log_type_analyzed", "findings": [{"severity": "high|medium|low|info", "description": "issue_description", "recommendation": "suggested_action", "log_lines": ["relevant_decoded_log_line"]}], "summary": "overall_analysis_summary"}. Analyze the provided Base64 decoded logs for security issues. If no issues are found, 'findings' must be an empty array."""
+
 def _log_api_call(request_payload, response_data=None, error_message=None):
     """以 JSON Lines 格式记录 OpenRouter API 调用到日志文件"""
     if not config.LOG_AI_API_CALLS:
@@ -43,11 +52,16 @@ def _log_api_call(request_payload, response_data=None, error_message=None):
     except Exception as e:
         print(f"写入 OpenRouter API 日志失败: {e}")
 
-def call_openrouter_api(log_data_str, proxies=None):
+def call_openrouter_api(log_data_str, proxies=None, system_instruction_text=None, user_prompt_prefix=None, max_output_tokens=None, response_schema=None, model=None):
     """
     调用 OpenRouter API 并获取分析结果。
     :param log_data_str: 要分析的日志数据字符串。
     :param proxies: 可选的代理配置字典，例如 {"http": "http://127.0.0.1:10808", "https": "http://127.0.0.1:10808"}
+    :param system_instruction_text: 可选的系统提示，默认使用单日志分析提示 SYSTEM_INSTRUCTION_TEXT。
+    :param user_prompt_prefix: 可选的用户消息前缀 (位于日志数据之前)。
+    :param max_output_tokens: 可选的 max_tokens，默认使用 OPENROUTER_MAX_OUTPUT_TOKENS。
+    :param response_schema: 可选的输出 JSON Schema，以 response_format=json_schema (strict) 强制约束输出结构。
+    :param model: 可选的模型覆盖 (模型分级时使用)，默认使用 OPENROUTER_MODEL。
     :return: API 分析结果或错误信息。
     """
     if not config.OPENROUTER_API_KEY or config.OPENROUTER_API_KEY == "YOUR_OPENROUTER_API_KEY":
@@ -65,24 +79,30 @@ def call_openrouter_api(log_data_str, proxies=None):
     }
 
     # 构建系统提示，与 Gemini 保持一致
-    system_instruction_text = """IMPORTANT: Your ONLY output MUST be a single, valid JSON object. Do NOT include any other text, explanations, or markdown. The JSON object should conform to this structure: {"timestamp": "ISO_timestamp", "log_type": "log_type_analyzed", "findings": [{"severity": "high|medium|low|info", "description": "issue_description", "recommendation": "suggested_action", "log_lines": ["relevant_decoded_log_line"]}], "summary": "overall_analysis_summary"}. Analyze the provided Base64 decoded logs for security issues. If no issues are found, 'findings' must be an empty array."""
+    system_instruction_text = system_instruction_text or SYSTEM_INSTRUCTION_TEXT
+    if user_prompt_prefix is None:
+        user_prompt_prefix = "请分析以下日志数据：\n\n"
+    model = model or config.OPENROUTER_MODEL
 
     # 构建 OpenRouter API 请求负载
     payload = {
-        "model": config.OPENROUTER_MODEL,
+        "model": model,
         "messages": [
-            {
-                "role": "system",
-                "content": system_instruction_text
-            },
+            # 系统提示作为稳定前缀放在最前面，并在支持时带上 cache_control 提示缓存断点
+            openrouter_cache_hints.system_message(model, system_instruction_text),
             {
                 "role": "user",
-                "content": f"请分析以下日志数据：\n\n{log_data_str}"
+                "content": f"{user_prompt_prefix}{log_data_str}"
             }
         ],
-        "max_tokens": config.OPENROUTER_MAX_OUTPUT_TOKENS,
+        "max_tokens": max_output_tokens or config.OPENROUTER_MAX_OUTPUT_TOKENS,
         "response_format": {"type": "json_object"}  # 恢复强制 JSON 输出
     }
+    if response_schema and _json_schema_unsupported.get(model, 0) <= time.time():
+        payload["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "log_analysis", "strict": True, "schema": response_schema},
+        }
 
     try:
         # 定义重试参数
@@ -93,48 +113,94 @@ def call_openrouter_api(log_data_str, proxies=None):
 
         for attempt in range(max_retries):
             try:
+                deadline = current_deadline()
+                if deadline is not None and deadline.expired():
+                    print("OpenRouter: 本轮扫描已到截止时间，取消请求。")
+                    return {"error": "Scan deadline exceeded; request cancelled.", "deadline_exceeded": True}
+                request_timeout = deadline.clamp((connect_timeout, read_timeout)) if deadline is not None else (connect_timeout, read_timeout)
                 # 在发送请求前记录
                 if config.LOG_AI_API_CALLS:
                     _log_api_call(request_payload=payload)
 
                 print(f"尝试调用 OpenRouter API (第 {attempt + 1}/{max_retries} 次)...")
-                response = requests.post(
+                response = call_with_deadline(
+                    deadline,
+                    requests.post,
                     config.OPENROUTER_API_URL,
                     headers=headers,
                     json=payload,
-                    timeout=(connect_timeout, read_timeout),
+                    timeout=request_timeout,
                     proxies=proxies
                 )
+                uses_cache_hint = isinstance(payload["messages"][0]["content"], list)
+                uses_json_schema = payload["response_format"]["type"] == "json_schema"
+                if response.status_code == 400 and (uses_cache_hint or uses_json_schema):
+                    # 部分提供商不接受 cache_control 内容块或 json_schema 结构化输出，回退为基础请求并立即重发
+                    if uses_cache_hint:
+                        print("OpenRouter: 当前模型不支持提示缓存提示，改为普通系统消息。")
+                        openrouter_cache_hints.mark_unsupported(model)
+                        payload["messages"][0] = {"role": "system", "content": system_instruction_text}
+                    if uses_json_schema:
+                        print("OpenRouter: 当前模型不支持 json_schema 结构化输出，改为 json_object。")
+                        _json_schema_unsupported[model] = time.time() + 6 * 3600
+                        payload["response_format"] = {"type": "json_object"}
+                    response = call_with_deadline(
+                        deadline,
+                        requests.post,
+                        config.OPENROUTER_API_URL,
+                        headers=headers,
+                        json=payload,
+                        timeout=request_timeout,
+                        proxies=proxies
+                    )
                 response.raise_for_status()
                 
                 response_json = response.json()
                 # 如果请求成功，跳出重试循环
                 break
+            except DeadlineExceeded as e:
+                # 请求超时只限制单次读取，整个请求 (含回退重发) 超过本轮扫描截止时间时放弃
+                print("OpenRouter: 请求超过本轮扫描截止时间，已放弃。")
+                if config.LOG_AI_API_CALLS:
+                    _log_api_call(request_payload=payload, error_message=f"Attempt {attempt + 1} DeadlineExceeded: {e}")
+                return {"error": "Scan deadline exceeded; request cancelled.", "deadline_exceeded": True}
             except requests.exceptions.Timeout as e:
                 error_msg = f"调用 OpenRouter API 时发生超时 (尝试 {attempt + 1}/{max_retries}): {e}"
                 print(error_msg)
                 if config.LOG_AI_API_CALLS:
                     _log_api_call(request_payload=payload, error_message=f"Attempt {attempt + 1} Timeout: {e}")
+                if attempt < max_retries - 1 and deadline is not None and deadline.remaining() <= retry_delay_seconds:
+                    print("本轮扫描剩余时间不足以重试，放弃。")
+                    return {"error": f"API request failed and the scan deadline leaves no time to retry: {e}", "deadline_exceeded": True}
                 if attempt < max_retries - 1:
                     print(f"{retry_delay_seconds} 秒后重试...")
                     time.sleep(retry_delay_seconds)
                 else:
                     print("已达到最大重试次数，放弃。")
-                    return {"error": f"API request failed after {max_retries} attempts due to timeout: {e}"}
+                    return {"error": f"API request failed after {max_retries} attempts due to timeout: {e}", "transport_error": True}
             except requests.exceptions.RequestException as e:
                 error_msg = f"调用 OpenRouter API 时发生网络错误 (尝试 {attempt + 1}/{max_retries}): {e}"
                 print(error_msg)
                 if config.LOG_AI_API_CALLS:
                     _log_api_call(request_payload=payload, error_message=f"Attempt {attempt + 1} RequestException: {e}")
+                if attempt < max_retries - 1 and deadline is not None and deadline.remaining() <= retry_delay_seconds:
+                    print("本轮扫描剩余时间不足以重试，放弃。")
+                    return {"error": f"API request failed and the scan deadline leaves no time to retry: {e}", "deadline_exceeded": True}
                 if attempt < max_retries - 1:
                     print(f"{retry_delay_seconds} 秒后重试...")
                     time.sleep(retry_delay_seconds)
                 else:
                     print("已达到最大重试次数，放弃。")
-                    return {"error": f"API request failed after {max_retries} attempts: {e}"}
+                    # 网络错误与 HTTP 错误 (带状态码) 都标记为传输错误，由 spool.is_provider_outage 判断是否为提供商故障
+                    return {"error": f"API request failed after {max_retries} attempts: {e}", "transport_error": True,
+                            "status_code": getattr(getattr(e, "response", None), "status_code", None)}
         else:
             return {"error": "API request failed after all retries without a definitive success or specific error."}
 
+        cached_tokens = ((response_json.get("usage") or {}).get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached_tokens:
+            print(f"OpenRouter: 命中提示缓存 {cached_tokens} tokens。")
+
         # 检查响应结构
         if not response_json.get("choices") or not response_json["choices"]:
             error_msg = f"OpenRouter API 响应中缺少 'choices'。响应: {response_json}"
@@ -150,53 +216,27 @@ def call_openrouter_api(log_data_str, proxies=None):
         if choice.get("message") and choice["message"].get("content"):
             model_output_text = choice["message"]["content"]
 
-            # 处理可能被 markdown 代码块包装的 JSON 响应
-            cleaned_text = model_output_text.strip()
-
-            # 检查是否被 ```json 和 ``` 包装
-            if cleaned_text.startswith("```json") and cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[7:-3].strip()
-                print("检测到 markdown 'json' 代码块，已清理。")
-            elif cleaned_text.startswith("```") and cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[3:-3].strip()
-                print("检测到无标识 markdown 代码块，已清理。")
-            
-            # 进一步清理可能残余的语言标识符，例如 "json\n{...}"
-            if cleaned_text.lower().startswith("json"):
-                # 寻找第一个 '{' 或 '['
-                first_bracket = cleaned_text.find('{')
-                first_square_bracket = cleaned_text.find('[')
-                
-                start_index = -1
-                if first_bracket != -1 and first_square_bracket != -1:
-                    start_index = min(first_bracket, first_square_bracket)
-                elif first_bracket != -1:
-                    start_index = first_bracket
-                elif first_square_bracket != -1:
-                    start_index = first_square_bracket
-                
-                if start_index != -1:
-                    cleaned_text = cleaned_text[start_index:]
-                    print(f"检测到前缀语言标识符，已清理。处理后文本前缀: {cleaned_text[:30]}...")
-                else:
-                    # 如果有 "json" 开头但找不到括号，可能不是有效的json，让后续解析处理
-                    pass
-
-            try:
-                parsed_model_output = json.loads(cleaned_text)
+            # 使用共享的容错 JSON 提取器: 去除包装、修复截断输出并校验发现结构
+            parsed_model_output, parse_info = parse_model_output(model_output_text)
+            if parsed_model_output is not None:
+                if parse_info.get("repaired") or parse_info.get("stripped_wrapper"):
+                    recovery_note = describe_recovery(parse_info)
+                    print(f"OpenRouter: {recovery_note}")
+                    if parse_info.get("repaired"):
+                        parsed_model_output["parse_recovery"] = recovery_note
                 if config.LOG_AI_API_CALLS:
-                    _log_api_call(request_payload=payload, response_data={"parsed_model_output": parsed_model_output, "raw_api_response": response_json})
+                    _log_api_call(request_payload=payload, response_data={"parsed_model_output": parsed_model_output, "raw_api_response": response_json, "parse_info": parse_info})
 
                 # 如果因为长度限制完成，添加警告
                 if finish_reason == "length":
                     parsed_model_output["warning_finish_reason"] = "length: Response might be truncated."
                 return parsed_model_output
-            except json.JSONDecodeError as e:
-                error_msg = f"OpenRouter API 返回的文本不是有效的 JSON 格式: {model_output_text}. 清理后的文本: {cleaned_text}. Error: {e}"
+            else:
+                error_msg = f"OpenRouter API 返回的文本无法提取出有效的 JSON 结果: {model_output_text}. Error: {parse_info.get('error')}"
                 print(error_msg)
-                error_detail = {"error": "Invalid JSON response from model", "raw_output": model_output_text, "cleaned_output": cleaned_text, "finish_reason": finish_reason}
+                error_detail = {"error": "Invalid JSON response from model", "raw_output": model_output_text, "parse_info": parse_info, "finish_reason": finish_reason}
                 if config.LOG_AI_API_CALLS:
-                    _log_api_call(request_payload=payload, response_data={"raw_api_response": response_json, "model_text_output": model_output_text, "cleaned_text": cleaned_text}, error_message=error_msg)
+                    _log_api_call(request_payload=payload, response_data={"raw_api_response": response_json, "model_text_output": model_output_text, "parse_info": parse_info}, error_message=error_msg)
                 return error_detail
         elif finish_reason == "length":
             error_msg = f"OpenRouter API 响应因长度限制而截断，且未能提取有效文本内容。响应: {response_json}"
@@ -0,0 +1,162 @@
+# pipeline.py
+"""
+生产者/消费者流水线: 各阶段由有界队列连接，每个阶段有独立的工作线程数。
+
+- 下游队列已满时上游的 emit() 会阻塞 (背压)，内存占用由队列容量上限决定；
+- 阶段可以按批消费 (batch_size > 1)，在 linger 秒内尽量凑满一批 (用于把多个窗口打包为一次请求)；
+- 每个阶段统计处理数、输出数、错误数、忙碌时间以及队列深度 (当前 / 峰值)。
+"""
+import queue
+import threading
+import time
+
+_STOP = object()
+
+
+class Stage:
+    """流水线中的一个阶段"""
+
+    def __init__(self, name, func, workers=1, queue_size=16, batch_size=1, linger_seconds=0.0):
+        """
+        :param func: func(item, emit)；batch_size > 1 时第一个参数为条目列表。
+                     emit(item, to=None) 把结果发送到下一个阶段，或通过 to 指定阶段名 (例如直接发给 sink)。
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.linger_seconds = linger_seconds
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._threads = []
+        self._lock = threading.Lock()
+        self._take_lock = threading.Lock()  # 同一时刻只有一个工作线程在凑批，避免条目被分散到多个不满的批次
+        self.received = 0
+        self.processed = 0
+        self.emitted = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_depth = 0
+        self.blocked_seconds = 0.0  # 向本阶段 put 时因队列已满而等待的总时间 (背压)
+        self.started_at = None
+        self.finished_at = None
+
+    def put(self, item):
+        started = time.perf_counter()
+        self.queue.put(item)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.received += 1
+            self.blocked_seconds += waited
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def _take_batch(self):
+        """取出一个条目；按批消费时在 linger 时间内继续收集，返回 (条目列表, 是否收到停止信号)"""
+        first = self.queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.linger_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self.queue.put(_STOP)  # 留给其他工作线程 (或本线程下一轮) 处理
+                break
+            batch.append(item)
+        return batch, False
+
+    def _run(self, emit):
+        while True:
+            with self._take_lock:
+                batch, stopped = self._take_batch()
+            if stopped:
+                return
+            started = time.perf_counter()
+            try:
+                self.func(batch if self.batch_size > 1 else batch[0], emit)
+            except Exception as e:
+                with self._lock:
+                    self.errors += len(batch)
+                print(f"流水线阶段 {self.name} 处理失败: {e}")
+            with self._lock:
+                self.processed += len(batch)
+                self.busy_seconds += time.perf_counter() - started
+
+    def start(self, emit):
+        self.started_at = time.perf_counter()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(emit,), name=f"pipeline-{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """发送停止信号并等待全部工作线程退出 (队列中剩余的条目会先处理完)"""
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.finished_at = time.perf_counter()
+
+    def stats(self):
+        elapsed = (self.finished_at or time.perf_counter()) - (self.started_at or time.perf_counter())
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "received": self.received,
+                "processed": self.processed,
+                "emitted": self.emitted,
+                "errors": self.errors,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_depth": self.max_depth,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "blocked_seconds": round(self.blocked_seconds, 3),
+                "throughput_per_second": round(self.processed / elapsed, 2) if elapsed > 0 else 0.0,
+                "utilization": round(self.busy_seconds / (elapsed * self.workers), 3) if elapsed > 0 else 0.0,
+            }
+
+
+class Pipeline:
+    """按顺序连接的阶段集合"""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self._by_name = {stage.name: index for index, stage in enumerate(stages)}
+
+    def _emitter(self, index):
+        def emit(item, to=None):
+            target = self.stages[self._by_name[to] if to else index + 1]
+            with self.stages[index]._lock:
+                self.stages[index].emitted += 1
+            target.put(item)
+        return emit
+
+    def run(self, items):
+        """
+        把 items 送入第一个阶段并等待流水线排空。
+        阶段按顺序关闭: 前一阶段的全部工作线程退出后，才向后一阶段发送停止信号。
+        """
+        for index, stage in enumerate(self.stages):
+            stage.start(self._emitter(index) if index + 1 < len(self.stages) else None)
+        for item in items:
+            self.stages[0].put(item)
+        for stage in self.stages:
+            stage.close()
+        return self.stats()
+
+    def stats(self):
+        return {stage.name: stage.stats() for stage in self.stages}
+
+
+def format_stats(stats):
+    """生成便于阅读的统计摘要"""
+    return "；".join(
+        f"{name}: {item['processed']} 项/{item['workers']} 线程, {item['throughput_per_second']}/s, "
+        f"利用率 {int(item['utilization'] * 100)}%, 队列峰值 {item['max_queue_depth']}"
+        + (f", 背压等待 {item['blocked_seconds']}s" if item['blocked_seconds'] else "")
+        + (f", 错误 {item['errors']}" if item['errors'] else "")
+        for name, item in stats.items()
+    )
@@ -0,0 +1,182 @@
+# prompt_cache.py
+"""
+系统提示 (稳定前缀) 的提示缓存管理。
+
+- Gemini: 通过 cachedContents API 为系统提示创建显式缓存，generateContent 请求只携带
+  cachedContent 名称和可变的日志数据；缓存临近过期时续期 TTL，失效 (404/403) 时重建。
+  显式缓存默认关闭 (GEMINI_EXPLICIT_CACHE)；估算长度低于最小缓存长度 (GEMINI_CACHE_MIN_TOKENS) 的系统提示
+  不创建缓存，提供商拒绝创建等不支持的情况下会记录下来，在一段时间内直接内联发送。
+- OpenRouter: 在系统消息上添加 cache_control 断点 (Anthropic / Gemini 等提供商支持，
+  OpenAI / DeepSeek 等会自动进行前缀缓存)，提供商拒绝时对该模型回退为普通系统消息。
+"""
+import hashlib
+import re
+import threading
+import time
+
+import requests
+
+import config
+
+# 不支持缓存的提示在这段时间内不再尝试创建缓存
+UNSUPPORTED_RETRY_SECONDS = 6 * 3600
+
+
+def _prompt_key(*parts):
+    return hashlib.sha1("\x1f".join(parts).encode('utf-8')).hexdigest()
+
+
+def is_enabled():
+    return getattr(config, "ENABLE_PROMPT_CACHE", True)
+
+
+def gemini_cache_enabled():
+    return is_enabled() and getattr(config, "GEMINI_EXPLICIT_CACHE", False)
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数 (按 UTF-8 字节数 / 4)，只用于判断是否达到最小缓存长度"""
+    return len(text.encode('utf-8')) // 4
+
+
+class GeminiPromptCache:
+    """Gemini cachedContents 生命周期管理 (创建 / 续期 / 失效 / 清理)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._caches = {}        # 提示哈希 -> {"name", "expire_at"}
+        self._unsupported = {}   # 提示哈希 -> 下次允许尝试的时间
+
+    @staticmethod
+    def _endpoints(api_url):
+        """由 generateContent URL 推导出模型名和 cachedContents 端点"""
+        match = re.match(r'^(?P<base>https?://.+?/v\d+\w*)/(?P<model>models/[^:/]+):', api_url)
+        if not match:
+            return None, None
+        return match.group("model"), f"{match.group('base')}/cachedContents"
+
+    def get(self, system_instruction_text, api_url, api_key, proxies=None):
+        """
+        返回可用的 cachedContent 名称；无法使用缓存时返回 None (调用方应内联发送系统提示)。
+        """
+        model, cache_endpoint = self._endpoints(api_url)
+        if not model:
+            return None
+        if estimate_tokens(system_instruction_text) < getattr(config, "GEMINI_CACHE_MIN_TOKENS", 1024):
+            return None  # 低于最小缓存长度，提供商会拒绝创建，也没有可节省的预填充
+        key = _prompt_key(model, system_instruction_text)
+        ttl_seconds = getattr(config, "GEMINI_CACHE_TTL_SECONDS", 3600)
+        now = time.time()
+        with self._lock:
+            if self._unsupported.get(key, 0) > now:
+                return None
+            entry = self._caches.get(key)
+            if entry and entry["expire_at"] - now > 60:
+                # 剩余有效期不足一半时顺带续期，避免在请求中途过期
+                if entry["expire_at"] - now < ttl_seconds / 2:
+                    self._extend(entry, cache_endpoint, api_key, ttl_seconds, proxies)
+                return entry["name"]
+            return self._create(key, model, cache_endpoint, system_instruction_text, api_key, ttl_seconds, proxies)
+
+    def _create(self, key, model, cache_endpoint, system_instruction_text, api_key, ttl_seconds, proxies):
+        body = {
+            "model": model,
+            "displayName": "NginxPhpAIScanner system instruction",
+            "systemInstruction": {"parts": [{"text": system_instruction_text}]},
+            "ttl": f"{ttl_seconds}s",
+        }
+        try:
+            response = requests.post(f"{cache_endpoint}?key={api_key}", json=body, timeout=(10, 30), proxies=proxies)
+            if response.status_code >= 400:
+                # 常见原因: 系统提示低于模型的最小缓存 token 数，或该模型不支持显式缓存
+                print(f"Gemini: 创建提示缓存失败 (HTTP {response.status_code})，将内联发送系统提示。{response.text[:200]}")
+                self._unsupported[key] = time.time() + UNSUPPORTED_RETRY_SECONDS
+                return None
+            name = response.json().get("name")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Gemini: 创建提示缓存时出错，本次内联发送系统提示: {e}")
+            return None
+        if not name:
+            return None
+        self._caches[key] = {"name": name, "expire_at": time.time() + ttl_seconds}
+        print(f"Gemini: 已创建提示缓存 {name} (TTL {ttl_seconds} 秒)。")
+        return name
+
+    def _extend(self, entry, cache_endpoint, api_key, ttl_seconds, proxies):
+        url = f"{cache_endpoint.rsplit('/cachedContents', 1)[0]}/{entry['name']}?key={api_key}&updateMask=ttl"
+        try:
+            response = requests.patch(url, json={"ttl": f"{ttl_seconds}s"}, timeout=(10, 30), proxies=proxies)
+            if response.status_code < 400:
+                entry["expire_at"] = time.time() + ttl_seconds
+        except requests.exceptions.RequestException as e:
+            print(f"Gemini: 提示缓存续期失败: {e}")
+
+    def invalidate(self, cache_name):
+        """缓存在服务端已失效 (过期或被删除) 时调用，下次请求会重新创建"""
+        with self._lock:
+            for key, entry in list(self._caches.items()):
+                if entry["name"] == cache_name:
+                    del self._caches[key]
+
+    def delete_all(self, api_url, api_key, proxies=None):
+        """删除本进程创建的全部缓存 (服务停止时调用，避免为未使用的缓存付费)"""
+        _, cache_endpoint = self._endpoints(api_url)
+        if not cache_endpoint:
+            return
+        with self._lock:
+            entries = list(self._caches.values())
+            self._caches.clear()
+        base = cache_endpoint.rsplit('/cachedContents', 1)[0]
+        for entry in entries:
+            try:
+                requests.delete(f"{base}/{entry['name']}?key={api_key}", timeout=(5, 10), proxies=proxies)
+            except requests.exceptions.RequestException:
+                pass
+
+    def to_dict(self):
+        """导出缓存名称与有效期，单次运行模式下由下一次进程继续使用而不是删除重建"""
+        with self._lock:
+            return {"caches": dict(self._caches), "unsupported": dict(self._unsupported)}
+
+    def load_dict(self, data):
+        now = time.time()
+        with self._lock:
+            for key, entry in (data.get("caches") or {}).items():
+                if entry.get("expire_at", 0) - now > 60:
+                    self._caches[key] = entry
+            for key, until in (data.get("unsupported") or {}).items():
+                if until > now:
+                    self._unsupported[key] = until
+        return self
+
+
+class OpenRouterCacheHints:
+    """记录哪些模型拒绝了 cache_control 提示"""
+
+    def __init__(self):
+        self._unsupported = {}
+
+    def system_message(self, model, system_instruction_text):
+        """构建系统消息；支持时以带 cache_control 断点的内容块形式发送"""
+        if not is_enabled() or not getattr(config, "OPENROUTER_PROMPT_CACHE", True) \
+                or self._unsupported.get(model, 0) > time.time():
+            return {"role": "system", "content": system_instruction_text}
+        return {
+            "role": "system",
+            "content": [{"type": "text", "text": system_instruction_text, "cache_control": {"type": "ephemeral"}}],
+        }
+
+    def mark_unsupported(self, model):
+        self._unsupported[model] = time.time() + UNSUPPORTED_RETRY_SECONDS
+
+    def to_dict(self):
+        return {"unsupported": dict(self._unsupported)}
+
+    def load_dict(self, data):
+        now = time.time()
+        self._unsupported.update({model: until for model, until in (data.get("unsupported") or {}).items() if until > now})
+        return self
+
+
+gemini_prompt_cache = GeminiPromptCache()
+openrouter_cache_hints = OpenRouterCacheHints()
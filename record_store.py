@@ -0,0 +1,189 @@
+# record_store.py
+"""
+访问日志记录的紧凑列式存储。
+
+抽样读取会遍历整个扫描间隔，流量高峰时有数十万条访问记录。每条记录都保留为字符串 (或解析结果字典) 时，
+内存占用是原始日志大小的数倍。这里按列保存解析后的字段:
+
+- 每个字段一个 array.array 列，记录只是列中的下标，不为单条记录创建对象；
+- IP、请求方法、路径前缀、User-Agent 按字典编码 (值 -> 整数代码)，重复值只保存一份；
+- 状态码、时间戳 (Unix 秒) 与文件偏移以整数保存，攻击特征 / 非常规方法等标志合并为一个字节；
+- 不保存原始行文本，选中的记录按偏移从文件中重新读取 (materialize)。
+
+每条记录约 33 字节 (另加各字典中不重复的值)，数十万条记录只占用数十 MB。
+窗口聚合 (aggregate) 与抽样分层 (classify) 直接在列上计算。
+"""
+import sys
+from array import array
+from collections import Counter
+
+from log_parser import parse_access_line, SUSPICIOUS_REQUEST_RE, COMMON_METHODS
+from records import LogRecord
+from sampling import path_prefix, _OVERFLOW
+
+# flags 列的位
+FLAG_SIGNATURE = 1  # 路径或 User-Agent 命中攻击特征
+FLAG_UNCOMMON_METHOD = 2  # 非常规请求方法
+FLAG_UNPARSED = 4  # 无法按 combined 格式解析
+
+_STATUS_CLASSES = tuple(f"{digit}xx" for digit in range(10))
+_UNPARSED_KEY = ("unparsed", _OVERFLOW, _OVERFLOW)
+
+
+class _Dictionary:
+    """字典编码: 值 <-> 整数代码。代码 0 保留给超出上限后的所有新值 ("*")"""
+
+    __slots__ = ("codes", "values", "max_values", "overflow")
+
+    def __init__(self, max_values):
+        self.codes = {}
+        self.values = [_OVERFLOW]
+        self.max_values = max_values
+        self.overflow = 0
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            if len(self.values) > self.max_values:
+                self.overflow += 1
+                return 0
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def nbytes(self):
+        return sys.getsizeof(self.codes) + sys.getsizeof(self.values) + sum(sys.getsizeof(value) for value in self.values)
+
+
+class AccessRecordStore:
+    """访问日志记录的列式存储: append() 逐行写入，记录以下标引用"""
+
+    __slots__ = ("start", "length", "ts", "status", "flags", "ip", "method", "prefix", "ua",
+                 "ips", "methods", "prefixes", "user_agents", "ua_max_length")
+
+    def __init__(self, max_distinct_values=262144, ua_max_length=200):
+        """
+        :param max_distinct_values: 每个字典最多保存的不重复值个数，超出后新值统一编码为 "*"。
+        :param ua_max_length: User-Agent 截断长度 (与异常评分一致)。
+        """
+        self.start = array('q')  # 记录在文件中的起始偏移
+        self.length = array('I')  # 记录的字节长度
+        self.ts = array('q')  # Unix 秒，无法解析时为 0
+        self.status = array('H')  # 无法解析时为 0
+        self.flags = array('B')
+        self.ip = array('I')
+        self.method = array('B')  # 方法字典最多 255 个值
+        self.prefix = array('I')
+        self.ua = array('I')
+        self.ips = _Dictionary(max_distinct_values)
+        self.methods = _Dictionary(255)
+        self.prefixes = _Dictionary(max_distinct_values)
+        self.user_agents = _Dictionary(max_distinct_values)
+        self.ua_max_length = ua_max_length
+
+    def __len__(self):
+        return len(self.start)
+
+    def append(self, line, start, length):
+        """解析一行访问日志并写入各列，返回记录下标"""
+        parsed = parse_access_line(line)
+        self.start.append(start)
+        self.length.append(length)
+        if parsed is None:
+            self.ts.append(0)
+            self.status.append(0)
+            self.flags.append(FLAG_UNPARSED | (FLAG_SIGNATURE if SUSPICIOUS_REQUEST_RE.search(line) else 0))
+            for column in (self.ip, self.method, self.prefix, self.ua):
+                column.append(0)
+            return len(self.start) - 1
+        flags = 0
+        if SUSPICIOUS_REQUEST_RE.search(parsed["path"]) or SUSPICIOUS_REQUEST_RE.search(parsed["ua"]):
+            flags |= FLAG_SIGNATURE
+        if parsed["method"] and parsed["method"] not in COMMON_METHODS:
+            flags |= FLAG_UNCOMMON_METHOD
+        self.ts.append(parsed["ts"] or 0)
+        self.status.append(min(parsed["status"], 0xFFFF))
+        self.flags.append(flags)
+        self.ip.append(self.ips.encode(parsed["ip"]))
+        self.method.append(self.methods.encode(parsed["method"] or "-"))
+        self.prefix.append(self.prefixes.encode(path_prefix(parsed["path"])))
+        self.ua.append(self.user_agents.encode(parsed["ua"][:self.ua_max_length]))
+        return len(self.start) - 1
+
+    def classify(self, index):
+        """
+        抽样用的分层键与必选原因 (与 sampling.classify_access_record 相同的规则)。
+        分层键中的 IP 与路径前缀是字典代码，用 labels() 还原。
+        """
+        flags = self.flags[index]
+        if flags & FLAG_UNPARSED:
+            return _UNPARSED_KEY, "unparsed"
+        status = self.status[index]
+        key = (_STATUS_CLASSES[status // 100], self.ip[index], self.prefix[index])
+        if flags & FLAG_SIGNATURE:
+            return key, "signature"
+        if status >= 500:
+            return key, "5xx"
+        if flags & FLAG_UNCOMMON_METHOD:
+            return key, "method"
+        return key, None
+
+    def labels(self, key):
+        """把分层键中的字典代码还原为 (状态码类别, IP, 路径前缀)"""
+        status_class, ip, prefix = key
+        return (status_class,
+                ip if ip == _OVERFLOW else self.ips.values[ip],
+                prefix if prefix == _OVERFLOW else self.prefixes.values[prefix])
+
+    def aggregate(self, top=5):
+        """
+        直接在列上计算整个间隔的聚合统计 (按代码计数，只有排名靠前的值才解码)。
+        :return: {"total_records", "status_counts", "method_counts", "top_ips", "top_path_prefixes",
+                  "top_user_agents", "signature_hits", "unparsed", "first_ts", "last_ts"}
+        """
+        status_counts = Counter()
+        for status, count in Counter(self.status).items():
+            status_counts["unparsed" if status == 0 else _STATUS_CLASSES[status // 100]] += count
+        flag_counts = Counter(self.flags)
+
+        def top_values(column, dictionary):
+            counts = Counter(column)
+            # 代码 0 同时用于无法解析的记录与超出字典上限的值，不参与排名
+            counts.pop(0, None)
+            return [(dictionary.values[code], count) for code, count in counts.most_common(top)]
+
+        first_ts = min((ts for ts in self.ts if ts), default=None)
+        return {
+            "total_records": len(self),
+            "status_counts": dict(sorted(status_counts.items())),
+            "method_counts": dict(Counter({self.methods.values[code]: count
+                                           for code, count in Counter(self.method).items() if code}).most_common()),
+            "top_ips": top_values(self.ip, self.ips),
+            "top_path_prefixes": top_values(self.prefix, self.prefixes),
+            "top_user_agents": top_values(self.ua, self.user_agents),
+            "signature_hits": sum(count for flags, count in flag_counts.items() if flags & FLAG_SIGNATURE),
+            "unparsed": sum(count for flags, count in flag_counts.items() if flags & FLAG_UNPARSED),
+            "first_ts": first_ts,
+            "last_ts": max(self.ts, default=0) or None,
+        }
+
+    def materialize(self, f, indices):
+        """
+        按偏移从已打开的日志文件 (二进制模式) 中重新读取选中的记录。
+        :return: 按下标顺序排列的 [LogRecord]；文件在读取期间被截断时跳过读不完整的记录。
+        """
+        records = []
+        for index in sorted(indices):
+            start, length = self.start[index], self.length[index]
+            f.seek(start)
+            raw = f.read(length)
+            if len(raw) != length:
+                continue
+            records.append(LogRecord(start, start + length, (raw.decode('utf-8', 'replace'),)))
+        return records
+
+    def nbytes(self):
+        """列与字典的近似内存占用 (字节)"""
+        columns = (self.start, self.length, self.ts, self.status, self.flags, self.ip, self.method, self.prefix, self.ua)
+        return (sum(len(column) * column.itemsize for column in columns) +
+                sum(dictionary.nbytes() for dictionary in (self.ips, self.methods, self.prefixes, self.user_agents)))
@@ -0,0 +1,164 @@
+# records.py
+"""
+多行日志记录组装。
+
+PHP 堆栈跟踪、php-fpm 慢日志 (slowlog) 以及部分 Nginx 错误记录会跨越多个物理行，按行截取窗口时
+记录会在窗口边缘被截断，模型只能看到片段，同一条记录的片段还可能在相邻窗口中重复发送。
+
+这里按每种日志类型的"记录起始"模式把物理行组装为完整记录:
+- 匹配起始模式的行开始一条新记录，其后不匹配的行 (续行) 归入当前记录；
+- 每条记录带有其在文件中的字节范围 [start, end)，读取偏移只会停在记录边界上；
+- 窗口切分 (chunk_records) 与异常行选取 (select_top_records) 都以记录为单位，不会把一条记录拆开。
+"""
+import re
+from collections import namedtuple
+
+# 记录起始模式；None 表示每个物理行都是一条独立记录 (访问日志不会跨行)
+RECORD_START_PATTERNS = {
+    "nginx_access": None,
+    # 2024/05/01 12:00:00 [error] 1234#0: ...
+    "nginx_error": re.compile(r'^\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} \['),
+    # [01-May-2024 12:00:00] WARNING: ... / [01-May-2024 12:00:00 UTC] PHP Fatal error: ... /
+    # 慢日志头部 [01-May-2024 12:00:00]  [pool www] pid 1234 (其后的 "[0x00007f...] func() file:line" 为续行)
+    "php_fpm": re.compile(r'^\[\d{2}-\w{3}-\d{4} \d{2}:\d{2}:\d{2}[^\]]*\] '),
+}
+
+LogRecord = namedtuple("LogRecord", ["start", "end", "lines"])
+
+
+def is_record_start(line, log_type):
+    pattern = RECORD_START_PATTERNS.get(log_type)
+    return pattern is None or bool(pattern.match(line))
+
+
+class RecordAssembler:
+    """流式记录组装器: 按顺序输入物理行及其字节范围，输出完整记录"""
+
+    def __init__(self, log_type, max_record_lines=200, drop_leading=False, enabled=True):
+        """
+        :param max_record_lines: 单条记录最多保留的行数，超出的续行不保留内容 (字节范围仍然连续)。
+        :param drop_leading: 丢弃第一条起始行之前的续行 (从文件中间开始读取时，它们是被截断记录的后半部分)。
+        :param enabled: False 时每个物理行都作为一条记录 (不做组装)。
+        """
+        self.pattern = RECORD_START_PATTERNS.get(log_type) if enabled else None
+        self.max_record_lines = max_record_lines
+        self.drop_leading = drop_leading
+        self.dropped_lines = 0
+        self._lines = []
+        self._start = None
+        self._end = None
+
+    def feed(self, line, start, end):
+        """输入一行，返回因此而完整的上一条记录 (没有时返回 None)"""
+        if self.pattern is None or self.pattern.match(line):
+            record = self.flush()
+            self._lines, self._start, self._end = [line], start, end
+            return record
+        if not self._lines:
+            if self.drop_leading:
+                self.dropped_lines += 1
+                return None
+            self._start = start  # 文件开头的续行单独成为一条记录
+        if len(self._lines) < self.max_record_lines:
+            self._lines.append(line)
+        self._end = end
+        return None
+
+    def flush(self):
+        """输出当前尚未完成的记录 (没有时返回 None)"""
+        if not self._lines:
+            return None
+        record = LogRecord(self._start, self._end, tuple(self._lines))
+        self._lines, self._start, self._end = [], None, None
+        return record
+
+    @property
+    def pending_start(self):
+        """尚未完成的记录的起始偏移"""
+        return self._start
+
+
+def assemble(data, base_offset, log_type, drop_leading=False, max_record_lines=200, enabled=True):
+    """
+    把一段以换行结尾的字节数据组装为记录。
+    :param data: 从文件 base_offset 处开始读取的字节 (只含完整的物理行)。
+    :return: (完整记录列表, 最后一条记录, 丢弃的前导续行数)。最后一条记录之后可能还有续行尚未写入，由调用方决定是否保留。
+    """
+    assembler = RecordAssembler(log_type, max_record_lines, drop_leading, enabled)
+    records = []
+    offset = base_offset
+    for raw in data.splitlines(keepends=True):
+        record = assembler.feed(raw.decode('utf-8', 'replace'), offset, offset + len(raw))
+        offset += len(raw)
+        if record is not None:
+            records.append(record)
+    return records, assembler.flush(), assembler.dropped_lines
+
+
+def record_lines(records):
+    """展开为物理行列表"""
+    return [line for record in records for line in record.lines]
+
+
+def take_first(records, max_lines):
+    """从开头选取总行数不超过 max_lines 的记录 (至少一条)"""
+    taken = []
+    total = 0
+    for record in records:
+        if taken and total + len(record.lines) > max_lines:
+            break
+        taken.append(record)
+        total += len(record.lines)
+    return taken
+
+
+def take_last(records, max_lines):
+    """从末尾选取总行数不超过 max_lines 的记录 (至少一条)"""
+    taken = []
+    total = 0
+    for record in reversed(records):
+        if taken and total + len(record.lines) > max_lines:
+            break
+        taken.append(record)
+        total += len(record.lines)
+    taken.reverse()
+    return taken
+
+
+def chunk_records(records, max_lines):
+    """按记录边界切分，每块不超过 max_lines 行 (单条记录超过上限时独占一块)；max_lines 为 0 时不切分"""
+    if not max_lines:
+        return [list(records)] if records else []
+    chunks, current, size = [], [], 0
+    for record in records:
+        if current and size + len(record.lines) > max_lines:
+            chunks.append(current)
+            current, size = [], 0
+        current.append(record)
+        size += len(record.lines)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def select_top_records(records, line_scores, max_lines):
+    """
+    按记录中得分最高的行为记录评分，选出最异常的记录，总行数不超过 max_lines (至少一条)，保持原始顺序。
+    :param line_scores: 与 record_lines(records) 一一对应的逐行得分。
+    """
+    if sum(len(record.lines) for record in records) <= max_lines:
+        return list(records)
+    scores = []
+    index = 0
+    for record in records:
+        scores.append(max(line_scores[index:index + len(record.lines)]))
+        index += len(record.lines)
+    chosen = []
+    total = 0
+    for position in sorted(range(len(records)), key=lambda i: scores[i], reverse=True):
+        size = len(records[position].lines)
+        if chosen and total + size > max_lines:
+            continue
+        chosen.append(position)
+        total += size
+    return [records[position] for position in sorted(chosen)]
@@ -0,0 +1,368 @@
+# replay.py
+"""
+AI API 调用记录的录制 / 重放工具。
+
+AI_API_LOG_PATH 以 JSON Lines 记录了每次请求与响应。本工具把它转换为确定性的离线样本集 (fixture corpus)，
+然后在不访问网络的情况下以最快速度重新执行响应的后处理路径，用于基准测试和回归测试:
+
+- parse: 容错 JSON 提取与结构校验 (json_extract.parse_model_output)；
+- merge: 批量响应拆分、紧凑结果展开、分诊升级判定与跨扫描发现合并 (FingerprintStore)；
+- render: HTML 报告渲染 (写入临时文件)。
+
+用法:
+    python replay.py build [--log AI_API_LOG_PATH] [--out 样本集路径]   # 生成样本集，并记录当前代码的结果摘要
+    python replay.py run [--corpus 样本集路径] [--repeat N] [--check] [--json]
+
+run 输出解析成功率 (按请求类型)、各阶段耗时 (总计 / 平均 / p50 / p95 / 最大)；
+--check 把每个样本的结果摘要与生成样本集时记录的摘要比较，不一致时以退出码 1 结束。
+"""
+import base64
+import binascii
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+import config
+from json_extract import parse_model_output
+from batching import split_batch_result
+from compact_schema import is_compact, expand_compact
+from fingerprint_store import FingerprintStore
+import cascade
+
+CORPUS_VERSION = 1
+
+_SECTION_RE = re.compile(r'<section id="([^"]+)">\s*([A-Za-z0-9+/=\s]+?)\s*</section>')
+_TRAILING_B64_RE = re.compile(r'([A-Za-z0-9+/]{16,}={0,2})\s*$')
+_NUMBERED_RE = re.compile(r'^\d+\|')
+# 每次运行都会变化、不参与回归比较的字段
+_VOLATILE_KEYS = frozenset(("timestamp", "first_seen", "seen_count", "fingerprint"))
+
+
+def default_corpus_path():
+    return os.path.splitext(getattr(config, "AI_API_LOG_PATH", "ai_api_log.json"))[0] + ".replay.jsonl"
+
+
+# ---------- 从调用记录中提取 ----------
+
+def _model_text(response):
+    """从记录的响应中取出模型输出文本与结束原因 (兼容 Gemini / OpenRouter 两种原始响应)"""
+    if not isinstance(response, dict):
+        return None, None
+    raw = response.get("raw_api_response") if isinstance(response.get("raw_api_response"), dict) else response
+    text, finish_reason = None, None
+    candidates = raw.get("candidates")
+    if isinstance(candidates, list) and candidates:
+        candidate = candidates[0] or {}
+        finish_reason = candidate.get("finishReason")
+        parts = (candidate.get("content") or {}).get("parts") or []
+        if parts and isinstance(parts[0], dict):
+            text = parts[0].get("text")
+    choices = raw.get("choices")
+    if isinstance(choices, list) and choices:
+        choice = choices[0] or {}
+        finish_reason = choice.get("finish_reason")
+        text = (choice.get("message") or {}).get("content")
+    if text is None:
+        text = response.get("original_model_text") or response.get("model_text_output")
+    return text, finish_reason
+
+
+def _user_text(request):
+    """请求中的用户消息正文"""
+    if not isinstance(request, dict):
+        return ""
+    for content in request.get("contents") or []:
+        if content.get("role") == "user":
+            return "".join(part.get("text", "") for part in content.get("parts") or [])
+    for message in request.get("messages") or []:
+        if message.get("role") == "user":
+            content = message.get("content")
+            if isinstance(content, list):
+                return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+            return content or ""
+    return ""
+
+
+def _decode_window(b64):
+    """还原发送给模型的日志行 (去掉抽样说明头部与紧凑模式的行序号)"""
+    try:
+        text = base64.b64decode("".join(b64.split()), validate=True).decode('utf-8', 'replace')
+    except (binascii.Error, ValueError):
+        return None
+    lines = [line for line in text.splitlines(keepends=True) if not line.startswith("# ")]
+    if lines and all(_NUMBERED_RE.match(line) for line in lines):
+        lines = [line.split("|", 1)[1] for line in lines]
+    return lines
+
+
+def extract_fixture(entry):
+    """
+    把一条调用记录转换为样本；没有模型输出的记录 (仅请求、网络错误) 返回 None。
+    :return: {"id", "provider", "model", "finish_reason", "model_text", "sections": {分段 ID: 日志行}, "batched"}
+    """
+    text, finish_reason = _model_text(entry.get("response"))
+    if not isinstance(text, str) or not text:
+        return None
+    request = entry.get("request") or {}
+    user_text = _user_text(request)
+    sections = {section_id: _decode_window(b64) for section_id, b64 in _SECTION_RE.findall(user_text)}
+    batched = bool(sections)
+    if not batched:
+        match = _TRAILING_B64_RE.search(user_text)
+        sections = {"replay": _decode_window(match.group(1)) if match else None}
+    return {
+        "id": hashlib.sha1(f"{user_text}\0{text}".encode('utf-8')).hexdigest()[:16],
+        "recorded_at": entry.get("timestamp"),
+        "provider": entry.get("api_provider", "gemini"),
+        "model": request.get("model"),
+        "finish_reason": finish_reason,
+        "model_text": text,
+        "sections": {section_id: lines or [] for section_id, lines in sections.items()},
+        "batched": batched,
+    }
+
+
+# ---------- 后处理路径 ----------
+
+def _normalize(value):
+    """去掉易变字段，用于计算回归摘要"""
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items() if key not in _VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def result_digest(results):
+    return hashlib.sha1(json.dumps(_normalize(results), sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+
+def _parse(fixture):
+    parsed, info = parse_model_output(fixture["model_text"])
+    kind = "single"
+    if isinstance(parsed, dict):
+        if "sections" in parsed:
+            kind = "batch"
+        elif is_compact(parsed):
+            kind = "compact"
+        elif "flag" in parsed and "findings" not in parsed:
+            kind = "triage"
+    return parsed, info, kind
+
+
+def _merge(fixture, parsed, store):
+    """按 main.analyze_pending 与流水线 sink 阶段的顺序处理解析结果，返回 [(分段 ID, 结果)]"""
+    section_ids = list(fixture["sections"])
+    if parsed is not None and "sections" in parsed:
+        split = split_batch_result(parsed, section_ids)
+    else:
+        split = {section_ids[0]: parsed} if section_ids else {}
+    results = []
+    for section_id, result in split.items():
+        if not isinstance(result, dict):
+            results.append((section_id, None))
+            continue
+        result = dict(result)
+        if "flag" in result and "findings" not in result:
+            result["escalate"] = cascade.should_escalate(result, getattr(config, "CASCADE_ESCALATE_SCORE", 40))
+            results.append((section_id, result))
+            continue
+        if is_compact(result):
+            result = expand_compact(result, fixture["sections"].get(section_id) or [])
+        result.setdefault("log_type", section_id)
+        result["findings"] = store.record_findings(section_id, result.get("findings") or [])
+        results.append((section_id, result))
+    return results
+
+
+def _report_renderer():
+    """
+    返回报告渲染函数 main.update_report_html。main 只在渲染阶段需要 (AI 客户端在 main 中延迟导入，因此不会加载 requests)，
+    由调用方在计时开始之前导入，首次导入的耗时不计入渲染阶段。
+    """
+    import main
+    return main.update_report_html
+
+
+def _render(results, report_path, render):
+    if os.path.exists(report_path):
+        os.remove(report_path)
+    render([result for _, result in results if result is not None and "findings" in result])
+
+
+def replay_fixture(fixture, store, report_path, timings, render):
+    """
+    执行一个样本的完整后处理路径，把各阶段耗时追加到 timings，返回 (是否解析成功, 请求类型, 结果摘要, info)。
+    :param render: _report_renderer() 返回的报告渲染函数。
+    """
+    started = time.perf_counter()
+    parsed, info, kind = _parse(fixture)
+    parsed_at = time.perf_counter()
+    results = _merge(fixture, parsed, store)
+    merged_at = time.perf_counter()
+    _render(results, report_path, render)
+    rendered_at = time.perf_counter()
+    timings["parse"].append(parsed_at - started)
+    timings["merge"].append(merged_at - parsed_at)
+    timings["render"].append(rendered_at - merged_at)
+    return parsed is not None, kind, result_digest([result for _, result in results]), info
+
+
+# ---------- 样本集 ----------
+
+def build_corpus(log_path, out_path):
+    """从调用记录生成样本集 (按内容去重)，并记录当前代码的结果摘要作为回归基线"""
+    fixtures = {}
+    skipped = 0
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            fixture = extract_fixture(entry)
+            if fixture is None:
+                skipped += 1
+                continue
+            fixtures.setdefault(fixture["id"], fixture)
+
+    timings = {"parse": [], "merge": [], "render": []}
+    report_path = os.path.join(tempfile.mkdtemp(prefix="replay-"), "report.html")
+    config.REPORT_HTML_PATH = report_path
+    render = _report_renderer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for fixture in fixtures.values():
+            ok, kind, digest, _ = replay_fixture(fixture, FingerprintStore(), report_path, timings, render)
+            fixture["expected"] = {"parsed": ok, "kind": kind, "digest": digest}
+
+    out_dir = os.path.dirname(out_path)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump({"corpus_version": CORPUS_VERSION, "source": log_path, "fixtures": len(fixtures)}, f)
+        f.write('\n')
+        for fixture in fixtures.values():
+            json.dump(fixture, f, ensure_ascii=False, separators=(',', ':'))
+            f.write('\n')
+    print(f"样本集已生成: {out_path} ({len(fixtures)} 个样本，跳过 {skipped} 条没有模型输出的记录)")
+    return len(fixtures)
+
+
+def load_corpus(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get("corpus_version") != CORPUS_VERSION:
+            raise ValueError(f"unsupported corpus version {header.get('corpus_version')!r}")
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _summarize(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    return {
+        "count": len(samples),
+        "total_ms": round(sum(samples) * 1000, 3),
+        "mean_us": round(sum(samples) / len(samples) * 1e6, 1),
+        "p50_us": round(ordered[len(ordered) // 2] * 1e6, 1),
+        "p95_us": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1e6, 1),
+        "max_us": round(ordered[-1] * 1e6, 1),
+    }
+
+
+def run_corpus(fixtures, repeat=1, check=False):
+    """
+    重放样本集。
+    :return: 统计字典 (解析成功率、按类型统计、各阶段耗时、回归比较结果)
+    """
+    timings = {"parse": [], "merge": [], "render": []}
+    by_kind = {}
+    mismatches = []
+    repaired = 0
+    report_path = os.path.join(tempfile.mkdtemp(prefix="replay-"), "report.html")
+    config.REPORT_HTML_PATH = report_path
+    render = _report_renderer()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for iteration in range(repeat):
+            for fixture in fixtures:
+                ok, kind, digest, info = replay_fixture(fixture, FingerprintStore(), report_path, timings, render)
+                if iteration:
+                    continue
+                stats = by_kind.setdefault(kind, {"fixtures": 0, "parsed": 0})
+                stats["fixtures"] += 1
+                stats["parsed"] += ok
+                repaired += bool(info.get("repaired"))
+                expected = fixture.get("expected")
+                if check and expected and (expected["parsed"] != ok or expected["digest"] != digest):
+                    mismatches.append({"id": fixture["id"], "expected": expected,
+                                       "actual": {"parsed": ok, "kind": kind, "digest": digest}})
+    elapsed = time.perf_counter() - started
+    parsed = sum(stats["parsed"] for stats in by_kind.values())
+    return {
+        "fixtures": len(fixtures),
+        "repeat": repeat,
+        "parse_success_rate": round(parsed / len(fixtures), 4) if fixtures else 0.0,
+        "repaired": repaired,
+        "by_kind": by_kind,
+        "stages": {stage: _summarize(samples) for stage, samples in timings.items()},
+        "fixtures_per_second": round(len(fixtures) * repeat / elapsed, 1) if elapsed > 0 else 0.0,
+        "mismatches": mismatches if check else None,
+    }
+
+
+def format_run_stats(stats):
+    lines = [
+        f"样本数: {stats['fixtures']} (重复 {stats['repeat']} 次)，解析成功率 {stats['parse_success_rate']:.2%}，"
+        f"其中 {stats['repaired']} 个经过修复；吞吐量 {stats['fixtures_per_second']} 个/秒",
+    ]
+    for kind, item in sorted(stats["by_kind"].items()):
+        lines.append(f"  {kind}: {item['parsed']}/{item['fixtures']} 解析成功")
+    for stage, item in stats["stages"].items():
+        if item["count"]:
+            lines.append(f"  {stage}: 总计 {item['total_ms']} ms，平均 {item['mean_us']} µs，p50 {item['p50_us']} µs，"
+                         f"p95 {item['p95_us']} µs，最大 {item['max_us']} µs")
+    if stats["mismatches"] is not None:
+        if stats["mismatches"]:
+            lines.append(f"回归检查: {len(stats['mismatches'])} 个样本的结果与基线不一致:")
+            lines.extend(f"  {item['id']}: 期望 {item['expected']}，实际 {item['actual']}" for item in stats["mismatches"][:20])
+        else:
+            lines.append("回归检查: 全部样本与基线一致。")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="AI API 调用记录的离线重放工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="从 AI_API_LOG_PATH 生成样本集")
+    build_parser.add_argument("--log", default=getattr(config, "AI_API_LOG_PATH", None), help="AI API 调用记录 (JSON Lines)")
+    build_parser.add_argument("--out", default=None, help="样本集输出路径 (默认与调用记录同目录)")
+    run_parser = subparsers.add_parser("run", help="重放样本集并输出解析成功率与各阶段耗时")
+    run_parser.add_argument("--corpus", default=None, help="样本集路径")
+    run_parser.add_argument("--repeat", type=int, default=1, help="重复次数 (用于基准测试)")
+    run_parser.add_argument("--check", action="store_true", help="与生成样本集时记录的结果摘要比较")
+    run_parser.add_argument("--json", action="store_true", help="以 JSON 输出统计")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if not args.log or not os.path.exists(args.log):
+            print(f"错误：找不到 AI API 调用记录 {args.log}。")
+            sys.exit(1)
+        build_corpus(args.log, args.out or default_corpus_path())
+        sys.exit(0)
+
+    corpus_path = args.corpus or default_corpus_path()
+    if not os.path.exists(corpus_path):
+        print(f"错误：找不到样本集 {corpus_path}，请先运行 python replay.py build。")
+        sys.exit(1)
+    run_stats = run_corpus(load_corpus(corpus_path), repeat=max(1, args.repeat), check=args.check)
+    print(json.dumps(run_stats, ensure_ascii=False, indent=2) if args.json else format_run_stats(run_stats))
+    sys.exit(1 if run_stats["mismatches"] else 0)
@@ -0,0 +1,222 @@
+# sampling.py
+"""
+访问日志的流量感知抽样。
+
+流量高峰时一个扫描间隔内可能有数万行访问日志，"最后 N 行" 只是一个任意且有偏的样本。
+这里在一次流式遍历中读取整个间隔，在行数预算内构建有代表性的窗口:
+
+- 分层: 按 (状态码类别, 客户端 IP, 路径前缀) 分层，每层内做蓄水池抽样 (内存占用有界)；
+- 必选: 命中攻击特征、非常规方法、5xx 的记录按原因各自进入一个蓄水池，按此优先级选入；
+  攻击特征命中在填满整个预算之前不做抽样，其余原因共享 always_include_max 行；
+- 稀有: 整个间隔内 (状态码类别, 路径前缀) 组合出现次数不超过阈值的记录全部选入；
+- 其余预算按层轮流分配 (请求量大的层优先)，保证热点 IP / 路径和长尾都有代表；
+- 同时统计真实总量、各状态码类别计数、高频 IP / 路径前缀和抽样率，作为窗口头部告诉模型真实流量规模。
+"""
+import random
+from collections import Counter
+
+from log_parser import parse_access_line, SUSPICIOUS_REQUEST_RE, COMMON_METHODS
+
+_OVERFLOW = "*"
+# 必选原因的优先级 (越靠前越先选入)
+ALWAYS_INCLUDE_PRIORITY = ("signature", "method", "5xx", "unparsed")
+
+
+def path_prefix(path, depth=1):
+    """请求路径的前 depth 级目录 (不含查询串)，非 / 开头的路径 (如代理请求) 截取前 32 个字符"""
+    path = path.split('?', 1)[0]
+    return "/" + "/".join(path.lstrip('/').split('/')[:depth]) if path.startswith('/') else (path[:32] or "-")
+
+
+def classify_access_record(record, path_depth=1):
+    """
+    访问日志记录的分层键与必选原因。
+    :return: ((状态码类别, IP, 路径前缀), 必选原因或 None)
+    """
+    line = record.lines[0]
+    parsed = parse_access_line(line)
+    if parsed is None:
+        return ("unparsed", _OVERFLOW, _OVERFLOW), "unparsed"
+    key = (f"{parsed['status'] // 100}xx", parsed["ip"], path_prefix(parsed["path"], path_depth))
+    if SUSPICIOUS_REQUEST_RE.search(parsed["path"]) or SUSPICIOUS_REQUEST_RE.search(parsed["ua"]):
+        return key, "signature"
+    if parsed["status"] >= 500:
+        return key, "5xx"
+    if parsed["method"] and parsed["method"] not in COMMON_METHODS:
+        return key, "method"
+    return key, None
+
+
+class _Reservoir:
+    """容量固定的蓄水池抽样 (Algorithm R)"""
+
+    __slots__ = ("capacity", "seen", "items")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.seen = 0
+        self.items = []
+
+    def add(self, item, rng):
+        self.seen += 1
+        if len(self.items) < self.capacity:
+            self.items.append(item)
+            return
+        slot = rng.randrange(self.seen)
+        if slot < self.capacity:
+            self.items[slot] = item
+
+
+class StratifiedSampler:
+    """分层蓄水池抽样器: 逐条 add() 记录，最后调用 sample() 得到窗口与统计"""
+
+    def __init__(self, budget, classify=classify_access_record, reservoir_size=4, max_strata=2048,
+                 rare_threshold=2, always_include_max=None, seed=None, size_of=None, labels=None):
+        """
+        :param budget: 样本的最大行数。
+        :param classify: classify(record) -> (分层键 (状态码类别, IP, 路径前缀), 必选原因或 None)。
+        :param size_of: size_of(record) -> 记录的行数，默认为 len(record.lines)。记录可以是任何可排序、可哈希的值
+                        (如列式存储中的下标)，排序顺序即文件顺序。
+        :param labels: labels(分层键) -> (状态码类别, IP, 路径前缀)，分层键使用编码值时用于还原统计中的名称。
+        :param max_strata: 分层数上限，超出后新的 IP 并入 (状态码类别, "*", 路径前缀) 层，再超出并入 (状态码类别, "*", "*")。
+        :param rare_threshold: (状态码类别, 路径前缀) 组合在整个间隔内出现不超过该次数时视为稀有，全部选入。
+        :param always_include_max: 攻击特征以外的必选记录 (非常规方法 / 5xx / 无法解析) 最多占用的行数，默认为预算的一半；
+                                   攻击特征命中不受此限制，最多可占满整个预算。
+        """
+        self.budget = budget
+        self.classify = classify
+        self.reservoir_size = max(reservoir_size, rare_threshold)  # 稀有组合的记录必须全部留在蓄水池中
+        self.max_strata = max_strata
+        self.rare_threshold = rare_threshold
+        self.always_include_max = always_include_max if always_include_max is not None else max(1, budget // 2)
+        self.size_of = size_of or (lambda record: len(record.lines))
+        self.labels = labels or (lambda key: key)
+        self._rng = random.Random(seed)
+        self._strata = {}
+        self._always = {reason: _Reservoir(budget if reason == "signature" else self.always_include_max)
+                        for reason in ALWAYS_INCLUDE_PRIORITY}
+        self.total = 0
+        self.status_counts = Counter()
+        self.group_counts = Counter()  # (状态码类别, 路径前缀) -> 次数
+        self.always_counts = Counter()  # 必选原因 -> 次数
+
+    def _stratum(self, key):
+        stratum = self._strata.get(key)
+        if stratum is not None:
+            return stratum
+        if len(self._strata) >= self.max_strata:
+            status_class, _, prefix = key
+            key = (status_class, _OVERFLOW, prefix)
+            if key not in self._strata and len(self._strata) >= self.max_strata * 2:
+                key = (status_class, _OVERFLOW, _OVERFLOW)
+            stratum = self._strata.get(key)
+            if stratum is not None:
+                return stratum
+        stratum = self._strata[key] = _Reservoir(self.reservoir_size)
+        return stratum
+
+    def add(self, record):
+        key, reason = self.classify(record)
+        self.total += 1
+        self.status_counts[key[0]] += 1
+        self.group_counts[(key[0], key[2])] += 1
+        if reason:
+            self.always_counts[reason] += 1
+            self._always.setdefault(reason, _Reservoir(self.always_include_max)).add(record, self._rng)
+            return
+        self._stratum(key).add(record, self._rng)
+
+    def sample(self):
+        """
+        :return: (按文件顺序排列的记录列表, 统计信息字典)
+        """
+        chosen = set()
+        remaining = self.budget
+
+        def take(record):
+            nonlocal remaining
+            size = self.size_of(record)
+            if record in chosen or size > remaining:
+                return False
+            chosen.add(record)
+            remaining -= size
+            return True
+
+        # 必选记录按原因的优先级选入: 攻击特征可占满整个预算，其余原因共享 always_include_max 行
+        always_taken = {}
+        other_lines = 0
+        reasons = ALWAYS_INCLUDE_PRIORITY + tuple(reason for reason in self._always if reason not in ALWAYS_INCLUDE_PRIORITY)
+        for reason in reasons:
+            taken = 0
+            for record in self._always[reason].items:
+                size = self.size_of(record)
+                if reason != "signature" and other_lines + size > self.always_include_max:
+                    break
+                if take(record):
+                    taken += 1
+                    if reason != "signature":
+                        other_lines += size
+            always_taken[reason] = taken
+        always_total = len(chosen)
+
+        rare_groups = {group for group, count in self.group_counts.items() if count <= self.rare_threshold}
+        for key, stratum in self._strata.items():
+            if (key[0], key[2]) in rare_groups:
+                for record in stratum.items:
+                    take(record)
+        rare_taken = len(chosen) - always_total
+
+        # 剩余预算按层轮流分配，请求量大的层优先
+        queues = [list(stratum.items) for _, stratum in sorted(self._strata.items(), key=lambda kv: kv[1].seen, reverse=True)]
+        round_index = 0
+        while remaining > 0 and any(round_index < len(queue) for queue in queues):
+            for queue in queues:
+                if remaining <= 0:
+                    break
+                if round_index < len(queue):
+                    take(queue[round_index])
+            round_index += 1
+
+        records = sorted(chosen)
+        sampled_lines = sum(self.size_of(record) for record in records)
+        ip_counts = Counter()
+        prefix_counts = Counter()
+        for key, stratum in self._strata.items():
+            _, ip, prefix = self.labels(key)
+            if ip != _OVERFLOW:
+                ip_counts[ip] += stratum.seen
+            if prefix != _OVERFLOW:
+                prefix_counts[prefix] += stratum.seen
+        stats = {
+            "total_records": self.total,
+            "sampled_records": len(records),
+            "sampled_lines": sampled_lines,
+            "sampling_rate": round(len(records) / self.total, 4) if self.total else 1.0,
+            "status_counts": dict(sorted(self.status_counts.items())),
+            "top_ips": ip_counts.most_common(5),
+            "top_path_prefixes": prefix_counts.most_common(5),
+            "always_included": always_total,
+            "always_included_by_reason": {reason: count for reason, count in always_taken.items() if count},
+            "always_include_candidates": dict(self.always_counts),
+            "rare_included": rare_taken,
+            "strata": len(self._strata),
+        }
+        return records, stats
+
+
+def format_sampling_header(stats):
+    """生成放在日志窗口前面的抽样说明 (# 开头，不计入行序号)"""
+    status = ", ".join(f"{name}={count}" for name, count in stats["status_counts"].items())
+    top_ips = ", ".join(f"{ip}={count}" for ip, count in stats["top_ips"])
+    top_prefixes = ", ".join(f"{prefix}={count}" for prefix, count in stats["top_path_prefixes"])
+    header = (
+        f"# SAMPLED WINDOW: {stats['sampled_records']} of {stats['total_records']} requests in this interval "
+        f"(rate {stats['sampling_rate']:.2%}, stratified by status class / client IP / path prefix; "
+        f"{stats['always_included']} suspicious and {stats['rare_included']} rare requests always included).\n"
+        f"# True volume by status class: {status}\n"
+        f"# Top client IPs: {top_ips}\n"
+        f"# Top path prefixes: {top_prefixes}\n"
+    )
+    if stats.get("top_user_agents"):
+        header += "# Top user agents: " + ", ".join(f"{ua!r}={count}" for ua, count in stats["top_user_agents"]) + "\n"
+    return header
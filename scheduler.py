@@ -0,0 +1,235 @@
+# scheduler.py
+"""
+固定速率的扫描调度与单次扫描截止时间。
+
+原来的循环在每次扫描结束后再 sleep(SCAN_INTERVAL_SECONDS)，实际周期是 "间隔 + 扫描耗时"，
+提供商重试时会漂移数分钟且没有上限。这里改为:
+
+- 单调时钟上的固定速率节拍: 第 k 次扫描计划在 起点 + 相位 + k * 间隔 开始，扫描耗时不会累积为漂移；
+- 随机相位与每次节拍的抖动 (不累积)，避免同时启动的多台机器同步请求提供商；
+- 超时策略 (扫描结束时已错过下一个或多个节拍):
+    skip     - 放弃错过的节拍，等待网格上的下一个节拍；
+    coalesce - 错过的节拍合并为一次，立即执行；
+    reduce   - 立即执行，但以缩减的预算 (读取行数与截止时间乘以 reduced_budget_factor) 追赶进度；
+- 单次扫描截止时间 (Deadline): 提供商客户端据此收紧请求超时、放弃重试，截止后尚未发出的分析请求直接取消
+  (启用待分析队列时窗口写入队列，稍后重放)；
+- 调度指标: 实际周期 (均值 / 最大 / 抖动)、开始延迟、超时与跳过次数、数据陈旧度 (距上一次扫描完成的时间)。
+"""
+import random
+import threading
+import time
+
+OVERRUN_POLICIES = ("skip", "coalesce", "reduce")
+
+
+class Deadline:
+    """基于单调时钟的截止时间"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def clamp(self, timeout):
+        """把请求超时 (秒或 (连接, 读取) 元组) 收紧到剩余时间以内"""
+        remaining = max(self.remaining(), 0.001)
+        if isinstance(timeout, tuple):
+            return tuple(min(value, remaining) for value in timeout)
+        return min(timeout, remaining)
+
+
+# 当前扫描的截止时间。扫描在流水线的多个工作线程中执行，且同一时刻只有一次扫描，因此使用模块级变量而非线程局部变量
+_scan_deadline = None
+_deadline_lock = threading.Lock()
+
+
+def set_scan_deadline(deadline):
+    global _scan_deadline
+    with _deadline_lock:
+        _scan_deadline = deadline
+
+
+def current_deadline():
+    """返回当前扫描的截止时间，没有扫描在进行或未设置截止时间时返回 None"""
+    return _scan_deadline
+
+
+class DeadlineExceeded(Exception):
+    """调用在扫描截止时间之前没有完成，已被放弃"""
+
+
+def call_with_deadline(deadline, func, *args, **kwargs):
+    """
+    在截止时间之内执行 func(*args, **kwargs) (例如 requests.post) 并返回其结果。
+    请求超时只限制连接与每一次 socket 读取，持续缓慢返回数据的响应仍可以无限拖延；这里在工作线程中执行调用，
+    到截止时间仍未返回时放弃等待并抛出 DeadlineExceeded (被放弃的线程受请求超时约束，会在后台自行结束)。
+    deadline 为 None 时直接调用。
+    """
+    if deadline is None:
+        return func(*args, **kwargs)
+    outcome = {}
+    done = threading.Event()
+
+    def run():
+        try:
+            outcome["result"] = func(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=run, name="deadline-call", daemon=True).start()
+    if not done.wait(deadline.remaining()):
+        raise DeadlineExceeded(f"scan deadline of {deadline.seconds}s exceeded")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+class FixedRateScheduler:
+    """固定速率节拍调度器"""
+
+    def __init__(self, interval_seconds, overrun_policy="coalesce", jitter_seconds=0.0,
+                 reduced_budget_factor=0.5, clock=time.monotonic, sleep=time.sleep):
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(f"overrun_policy must be one of {OVERRUN_POLICIES}, got {overrun_policy!r}")
+        self.interval = float(interval_seconds)
+        self.overrun_policy = overrun_policy
+        self.jitter_seconds = min(max(0.0, jitter_seconds), self.interval / 2)
+        self.reduced_budget_factor = reduced_budget_factor
+        self._clock = clock
+        self._sleep = sleep
+        self._rng = random.Random()
+        self._origin = None
+        self._phase = self._rng.uniform(0, self.jitter_seconds)  # 随机相位，错开同时启动的实例
+        self._next_index = 0
+        self._pending_overrun = False
+        self._last_start = None
+        self._last_finish = None
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.coalesced_ticks = 0
+        self.reduced_runs = 0
+        self._periods = []
+        self._lateness = []
+        self._staleness = []
+        self._durations = []
+
+    def _scheduled_time(self, index):
+        if index == 0:
+            return self._origin  # 首次扫描立即执行
+        return self._origin + self._phase + index * self.interval
+
+    def wait_next(self):
+        """
+        等待下一个节拍并返回其信息:
+        {"index", "scheduled", "started", "lateness", "budget_factor", "overrun"}
+        """
+        now = self._clock()
+        if self._origin is None:
+            self._origin = now
+        overrun = self._pending_overrun
+        self._pending_overrun = False
+        budget_factor = 1.0
+        if overrun and self.overrun_policy == "skip":
+            # 放弃错过的节拍，对齐到网格上的下一个未来节拍
+            due_index = self._due_index(now)
+            self.skipped_ticks += due_index - self._next_index + 1
+            self._next_index = due_index + 1
+            overrun = False
+        scheduled = self._scheduled_time(self._next_index)
+        if overrun:
+            due_index = self._due_index(now)
+            missed = due_index - self._next_index
+            if missed > 0:
+                self.coalesced_ticks += missed
+                self._next_index = due_index
+                scheduled = self._scheduled_time(self._next_index)
+            if self.overrun_policy == "reduce":
+                budget_factor = self.reduced_budget_factor
+                self.reduced_runs += 1
+        else:
+            target = scheduled + (self._rng.uniform(0, self.jitter_seconds) if self._next_index else 0.0)
+            if target > now:
+                self._sleep(target - now)
+        started = self._clock()
+        tick = {
+            "index": self._next_index,
+            "scheduled": scheduled,
+            "started": started,
+            "lateness": round(max(0.0, started - scheduled), 3),
+            "budget_factor": budget_factor,
+            "overrun": overrun,
+        }
+        if self._last_start is not None:
+            self._periods.append(started - self._last_start)
+        if self._last_finish is not None:
+            self._staleness.append(started - self._last_finish)
+        self._lateness.append(tick["lateness"])
+        self._last_start = started
+        self._next_index += 1
+        self.ticks += 1
+        for samples in (self._periods, self._lateness, self._staleness):
+            del samples[:-256]  # 只保留最近的样本
+        return tick
+
+    def _due_index(self, now):
+        """已到期的最大节拍序号"""
+        return max(self._next_index, int((now - self._origin - self._phase) // self.interval))
+
+    def finish(self, tick):
+        """扫描结束: 记录耗时，并判断是否已经错过下一个节拍"""
+        finished = self._clock()
+        self._last_finish = finished
+        self._durations.append(finished - tick["started"])
+        del self._durations[:-256]
+        if finished > self._scheduled_time(self._next_index):
+            self.overruns += 1
+            self._pending_overrun = True
+        return finished - tick["started"]
+
+    def deadline_for(self, tick, deadline_seconds=None):
+        """本次扫描的截止时间: 默认为一个间隔，缩减预算时按比例缩短"""
+        seconds = deadline_seconds if deadline_seconds else self.interval
+        return Deadline(seconds * tick["budget_factor"])
+
+    def stats(self):
+        def summary(samples):
+            if not samples:
+                return None
+            mean = sum(samples) / len(samples)
+            return {"mean": round(mean, 3), "max": round(max(samples), 3),
+                    "stddev": round((sum((value - mean) ** 2 for value in samples) / len(samples)) ** 0.5, 3)}
+
+        return {
+            "interval_seconds": self.interval,
+            "overrun_policy": self.overrun_policy,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped_ticks": self.skipped_ticks,
+            "coalesced_ticks": self.coalesced_ticks,
+            "reduced_runs": self.reduced_runs,
+            "period_seconds": summary(self._periods),
+            "lateness_seconds": summary(self._lateness),
+            "staleness_seconds": summary(self._staleness),
+            "scan_duration_seconds": summary(self._durations),
+        }
+
+
+def format_cadence(stats):
+    """生成调度指标摘要"""
+    parts = [f"节拍 {stats['ticks']} 次 (间隔 {stats['interval_seconds']}s，超时策略 {stats['overrun_policy']})"]
+    for key, label in (("period_seconds", "实际周期"), ("scan_duration_seconds", "扫描耗时"),
+                       ("lateness_seconds", "开始延迟"), ("staleness_seconds", "陈旧度")):
+        if stats.get(key):
+            parts.append(f"{label} 均值 {stats[key]['mean']}s / 最大 {stats[key]['max']}s")
+    if stats["overruns"]:
+        parts.append(f"超时 {stats['overruns']} 次 (跳过 {stats['skipped_ticks']} 个节拍，合并 {stats['coalesced_ticks']} 个，"
+                     f"缩减预算 {stats['reduced_runs']} 次)")
+    return "，".join(parts)
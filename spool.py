@@ -0,0 +1,363 @@
+# spool.py
+"""
+待分析日志窗口的磁盘预写队列 (write-ahead spool)。
+
+提供商不可用时 (超时、网络错误、HTTP 429 / 5xx、扫描截止，见 is_provider_outage)，分析失败的窗口写入只追加的段文件，
+而不是作为错误结果丢弃；提供商恢复后由排空 (drain) 过程按有限并发重放积压窗口。
+缺少 API Key 等配置错误以及模型输出无法解析不会因重放而好转，不写入队列。
+
+段文件格式: 每行一条记录 "<crc32 十六进制>\\t<JSON>\\n"，记录类型:
+- {"op": "put", "id", "log_type", "lines", "ts", "sampling"?}: 新的待分析窗口 (抽样窗口带有抽样统计)
+- {"op": "attempt", "id", "attempts"}: 重放失败次数
+- {"op": "ack", "id"}: 已完成 (分析成功或超过最大重试次数而放弃)
+
+内存中只保存待处理条目的索引 (段文件、偏移、长度、重试次数)，窗口内容在重放时才从磁盘读取，
+因此长时间断连期间内存占用保持有界。段文件只从最旧的一端删除 (该段及更早的段都已确认完成)，
+保证 ack 记录不会早于对应的 put 记录被删除；总大小超过上限时丢弃最旧的段并给出警告。
+启动时校验每条记录的 CRC，最后一个段末尾写到一半的记录会被截断。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+_SEGMENT_PREFIX = "segment-"
+_SEGMENT_SUFFIX = ".log"
+
+
+def is_provider_outage(result):
+    """
+    判断分析结果是否为提供商暂时不可用: 扫描截止、超时 / 网络错误，或 HTTP 429 / 5xx。
+    客户端在这些错误上设置 transport_error (以及 HTTP 状态码 status_code)；None (未配置 API Key 等) 不算。
+    """
+    if not result or not isinstance(result, dict):
+        return False
+    if result.get("deadline_exceeded"):
+        return True
+    if not result.get("transport_error"):
+        return False
+    status = result.get("status_code")
+    return status is None or status == 429 or status >= 500
+
+
+def _encode_record(record):
+    body = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+    return f"{zlib.crc32(body.encode('utf-8')) & 0xffffffff:08x}\t{body}\n".encode('utf-8')
+
+
+def _decode_record(raw):
+    """解码一行记录，CRC 不匹配或格式错误时返回 None"""
+    try:
+        text = raw.decode('utf-8').rstrip('\n')
+        checksum, body = text.split('\t', 1)
+        if int(checksum, 16) != zlib.crc32(body.encode('utf-8')) & 0xffffffff:
+            return None
+        return json.loads(body)
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+class Spool:
+    """只追加的段文件队列，按 fsync 策略落盘"""
+
+    def __init__(self, directory, segment_max_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024,
+                 fsync_policy="interval", fsync_interval_seconds=1.0):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy must be one of {FSYNC_POLICIES}, got {fsync_policy!r}")
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_bytes = max_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval_seconds = fsync_interval_seconds
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # 条目 ID -> [段序号, 偏移, 长度, 重试次数, 日志类型, 写入时间]
+        self._segments = OrderedDict()  # 段序号 -> [文件大小, 未确认条目数]
+        self._active = None             # 当前追加的文件对象
+        self._active_seq = 0
+        self._last_fsync = 0.0
+        self.dropped = 0                # 因超出容量被丢弃的条目数
+
+    # ---------- 启动恢复 ----------
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"{_SEGMENT_PREFIX}{seq:08d}{_SEGMENT_SUFFIX}")
+
+    def open(self):
+        """扫描已有段文件，重建待处理索引"""
+        os.makedirs(self.directory, exist_ok=True)
+        seqs = sorted(
+            int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX)
+        )
+        for index, seq in enumerate(seqs):
+            self._recover_segment(seq, is_last=index == len(seqs) - 1)
+        self._prune_head()
+        self._active_seq = seqs[-1] if seqs else 1
+        self._open_active()
+        if self._pending:
+            print(f"待分析队列: 从 {self.directory} 恢复了 {len(self._pending)} 个未完成的日志窗口。")
+        return self
+
+    def _recover_segment(self, seq, is_last):
+        path = self._segment_path(seq)
+        self._segments[seq] = [0, 0]
+        offset = 0
+        corrupt = 0
+        with open(path, 'rb') as f:
+            for raw in f:
+                record = _decode_record(raw) if raw.endswith(b'\n') else None
+                if record is None:
+                    if is_last:
+                        # 崩溃时写到一半的记录: 截断并从这里继续追加
+                        break
+                    corrupt += 1
+                    offset += len(raw)
+                    continue
+                self._apply(record, seq, offset, len(raw))
+                offset += len(raw)
+        if is_last and offset < os.path.getsize(path):
+            print(f"待分析队列: 段文件 {path} 末尾有不完整的记录，已截断 {os.path.getsize(path) - offset} 字节。")
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        if corrupt:
+            print(f"待分析队列: 段文件 {path} 中有 {corrupt} 条记录校验失败，已跳过。")
+        self._segments[seq][0] = offset
+
+    def _apply(self, record, seq, offset, length):
+        op = record.get("op")
+        entry_id = record.get("id")
+        if op == "put":
+            self._pending[entry_id] = [seq, offset, length, 0, record.get("log_type"), record.get("ts")]
+            self._segments[seq][1] += 1
+        elif op == "attempt" and entry_id in self._pending:
+            self._pending[entry_id][3] = record.get("attempts", 0)
+        elif op == "ack":
+            entry = self._pending.pop(entry_id, None)
+            if entry is not None and entry[0] in self._segments:
+                self._segments[entry[0]][1] -= 1
+
+    # ---------- 写入 ----------
+
+    def _open_active(self):
+        self._active = open(self._segment_path(self._active_seq), 'ab')
+        self._segments.setdefault(self._active_seq, [self._active.tell(), 0])
+
+    def _rotate(self):
+        self._sync(force=True)
+        self._active.close()
+        self._active_seq += 1
+        self._open_active()
+        if self.fsync_policy != "never":
+            # 新段文件的目录项也需要落盘
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _sync(self, force=False):
+        self._active.flush()
+        if self.fsync_policy == "never":
+            return
+        now = time.monotonic()
+        if force or self.fsync_policy == "always" or now - self._last_fsync >= self.fsync_interval_seconds:
+            os.fsync(self._active.fileno())
+            self._last_fsync = now
+
+    def _append(self, record):
+        """追加一条记录，返回 (段序号, 偏移, 长度)"""
+        data = _encode_record(record)
+        if self._segments[self._active_seq][0] + len(data) > self.segment_max_bytes and self._segments[self._active_seq][0] > 0:
+            self._rotate()
+        segment = self._segments[self._active_seq]
+        offset = segment[0]
+        self._active.write(data)
+        segment[0] += len(data)
+        self._sync()
+        return self._active_seq, offset, len(data)
+
+    def put(self, log_type, lines, sampling=None):
+        """
+        写入一个待分析窗口，返回条目 ID。
+        :param sampling: 抽样窗口的抽样统计，重放时据此重建抽样说明 (真实流量与抽样率)。
+        """
+        entry_id = uuid.uuid4().hex
+        ts = time.time()
+        record = {"op": "put", "id": entry_id, "log_type": log_type, "lines": list(lines), "ts": ts}
+        if sampling:
+            record["sampling"] = sampling
+        with self._lock:
+            seq, offset, length = self._append(record)
+            self._pending[entry_id] = [seq, offset, length, 0, log_type, ts]
+            self._segments[seq][1] += 1
+            self._enforce_capacity()
+        return entry_id
+
+    def ack(self, entry_id):
+        """标记条目已完成，返回条目此前是否仍待处理"""
+        with self._lock:
+            entry = self._pending.pop(entry_id, None)
+            if entry is None:
+                return False
+            self._append({"op": "ack", "id": entry_id})
+            if entry[0] in self._segments:
+                self._segments[entry[0]][1] -= 1
+            self._prune_head()
+            return True
+
+    def record_attempt(self, entry_id):
+        """记录一次重放失败，返回累计失败次数"""
+        with self._lock:
+            entry = self._pending.get(entry_id)
+            if entry is None:
+                return 0
+            entry[3] += 1
+            self._append({"op": "attempt", "id": entry_id, "attempts": entry[3]})
+            return entry[3]
+
+    # ---------- 读取 ----------
+
+    def __len__(self):
+        return len(self._pending)
+
+    def pending_ids(self, limit=None):
+        """按写入顺序 (最旧优先) 返回待处理条目 ID"""
+        with self._lock:
+            ids = list(self._pending)
+        return ids if limit is None else ids[:limit]
+
+    def describe(self, entry_id):
+        """返回索引中记录的 (日志类型, 写入时间)，不读取磁盘；条目不存在时返回 (None, None)"""
+        with self._lock:
+            entry = self._pending.get(entry_id)
+            return (entry[4], entry[5]) if entry is not None else (None, None)
+
+    def read(self, entry_id):
+        """从磁盘读取条目内容: {"id", "log_type", "lines", "ts", "attempts"} (抽样窗口另有 "sampling")"""
+        with self._lock:
+            entry = self._pending.get(entry_id)
+            if entry is None:
+                return None
+            seq, offset, length, attempts = entry[:4]
+            if seq == self._active_seq:
+                self._active.flush()
+        with open(self._segment_path(seq), 'rb') as f:
+            f.seek(offset)
+            record = _decode_record(f.read(length))
+        if record is None:
+            return None
+        record.pop("op", None)
+        record["attempts"] = attempts
+        return record
+
+    # ---------- 空间回收 ----------
+
+    def _prune_head(self):
+        """从最旧的一端删除已全部确认、且不是当前追加段的段文件"""
+        while self._segments:
+            seq, (size, live) = next(iter(self._segments.items()))
+            if live > 0 or seq == self._active_seq:
+                break
+            del self._segments[seq]
+            try:
+                os.remove(self._segment_path(seq))
+            except OSError:
+                pass
+
+    def _enforce_capacity(self):
+        """总大小超过上限时丢弃最旧的段 (连同其中未完成的条目)"""
+        while sum(size for size, _ in self._segments.values()) > self.max_bytes and len(self._segments) > 1:
+            seq = next(iter(self._segments))
+            if seq == self._active_seq:
+                break
+            lost = [entry_id for entry_id, entry in self._pending.items() if entry[0] == seq]
+            for entry_id in lost:
+                del self._pending[entry_id]
+            self.dropped += len(lost)
+            del self._segments[seq]
+            try:
+                os.remove(self._segment_path(seq))
+            except OSError:
+                pass
+            print(f"警告: 待分析队列超过 {self.max_bytes} 字节上限，丢弃最旧的段 (含 {len(lost)} 个未分析窗口)。")
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._sync(force=True)
+                self._active.close()
+                self._active = None
+
+
+def drain(spool, analyze, concurrency=2, max_items=20, max_attempts=5):
+    """
+    按有限并发重放积压窗口。
+    先单独重放最旧的一个窗口作为探测，失败说明提供商仍不可用，本轮直接停止；
+    探测成功后以最多 concurrency 个并发重放其余窗口，出现失败后不再提交新的窗口。
+    :param analyze: 回调 analyze(entry) -> (是否成功, 分析结果)，entry 为 Spool.read() 的返回值。
+    无法读取的条目 (CRC 校验失败或无法解码) 直接确认完成并给出警告，否则它会永远留在队列中并阻止段文件回收。
+    :return: [(entry, 分析结果, 状态)]，状态为 "done" / "retry" / "gave_up" / "corrupt"
+             ("corrupt" 的 entry 只有 {"id", "log_type", "lines": [], "ts"})。
+    """
+    outcomes = []
+    ids = spool.pending_ids(limit=max_items)
+    if not ids:
+        return outcomes
+
+    def settle(entry, ok, result):
+        if ok:
+            spool.ack(entry["id"])
+            outcomes.append((entry, result, "done"))
+            return True
+        attempts = spool.record_attempt(entry["id"])
+        if attempts >= max_attempts:
+            spool.ack(entry["id"])
+            outcomes.append((entry, result, "gave_up"))
+        else:
+            outcomes.append((entry, result, "retry"))
+        return False
+
+    def readable(entry_ids):
+        for entry_id in entry_ids:
+            entry = spool.read(entry_id)
+            if entry is not None:
+                yield entry
+                continue
+            log_type, ts = spool.describe(entry_id)
+            if spool.ack(entry_id):
+                print(f"待分析队列: 条目 {entry_id[:8]} ({log_type}) 无法读取 (校验失败或格式错误)，已丢弃。")
+                outcomes.append(({"id": entry_id, "log_type": log_type, "lines": [], "ts": ts}, None, "corrupt"))
+
+    entries = readable(ids)
+    probe = next(entries, None)
+    if probe is None or not settle(probe, *analyze(probe)):
+        return outcomes
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        in_flight = {}
+        healthy = True
+        while True:
+            while healthy and len(in_flight) < concurrency:
+                entry = next(entries, None)
+                if entry is None:
+                    break
+                in_flight[executor.submit(analyze, entry)] = entry
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                entry = in_flight.pop(future)
+                try:
+                    ok, result = future.result()
+                except Exception as e:
+                    ok, result = False, {"error": f"Unexpected error while replaying spooled window: {e}"}
+                if not settle(entry, ok, result):
+                    healthy = False
+    return outcomes
@@ -0,0 +1,50 @@
+# state_snapshot.py
+"""
+单次运行模式 (--once) 的进程状态快照。
+
+systemd timer / cron 每次启动都是新进程，快照把需要跨运行保留的状态压缩保存到一个文件中:
+日志读取偏移、异常评分基线、滑动窗口检测器计数、提示缓存名称以及冷启动耗时等指标。
+(发现/日志行指纹由 FINGERPRINT_STORE_PATH 单独持久化，待分析窗口由 SPOOL_DIR 持久化。)
+
+文件为 gzip 压缩的紧凑 JSON，原子写入 (临时文件 + os.replace)。
+"""
+import gzip
+import json
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+def load_snapshot(path):
+    """读取快照，文件不存在、版本不符或损坏时返回空快照"""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception as e:
+        print(f"读取状态快照 {path} 失败，将以空状态启动: {e}")
+        return {}
+    if data.get("version") != SNAPSHOT_VERSION:
+        print(f"状态快照 {path} 的版本 ({data.get('version')}) 与当前版本不一致，已忽略。")
+        return {}
+    return data
+
+
+def save_snapshot(path, state):
+    """原子地写入快照"""
+    if not path:
+        return
+    data = dict(state, version=SNAPSHOT_VERSION, saved_at=time.time())
+    try:
+        snapshot_dir = os.path.dirname(path)
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        # 压缩级别 1: 快照以大量零值的 sketch 表为主，低级别已足够紧凑且写入更快
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"写入状态快照 {path} 失败: {e}")
@@ -0,0 +1,165 @@
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from alerts import AlertDispatcher, CommandSink, SmtpSink, SyslogSink, WebhookSink
+
+
+def _flood(count=500, kinds=5):
+    return [{"severity": "critical" if i % kinds == 0 else "high", "description": f"test finding #{i % kinds}",
+             "recommendation": "ignore"} for i in range(count)]
+
+
+@pytest.fixture
+def webhook():
+    """本机 HTTP 替身接收端；failures 为开头返回 500 的请求数"""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        failures = 0
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if Handler.failures > 0:
+                Handler.failures -= 1
+                self.send_response(500)
+                self.end_headers()
+                return
+            received.append(json.loads(body))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/hook", received, Handler
+    server.shutdown()
+
+
+@pytest.fixture
+def syslog_receiver():
+    received = []
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.2)
+
+    def run():
+        while sock.fileno() != -1:
+            try:
+                data, _ = sock.recvfrom(4096)
+            except OSError:
+                continue
+            received.append(data.decode('utf-8'))
+
+    threading.Thread(target=run, daemon=True).start()
+    yield ("127.0.0.1", sock.getsockname()[1]), received
+    sock.close()
+
+
+@pytest.fixture
+def smtp_receiver():
+    """只实现 smtplib 用到的最小 SMTP 会话"""
+    received = []
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+
+    def run():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            stream = connection.makefile('rb')
+            connection.sendall(b"220 localhost stand-in\r\n")
+            for line in stream:
+                command = line[:4].upper()
+                if command == b"DATA":
+                    connection.sendall(b"354 end with .\r\n")
+                    message = []
+                    for data_line in stream:
+                        if data_line in (b".\r\n", b".\n"):
+                            break
+                        message.append(data_line)
+                    received.append(b"".join(message).decode('utf-8', 'replace'))
+                    connection.sendall(b"250 queued\r\n")
+                elif command == b"QUIT":
+                    connection.sendall(b"221 bye\r\n")
+                    break
+                else:
+                    connection.sendall(b"250 ok\r\n")
+            connection.close()
+
+    threading.Thread(target=run, daemon=True).start()
+    yield server.getsockname()[1], received
+    server.close()
+
+
+def _run(dispatcher, *batches, pause=0.0):
+    dispatcher.start()
+    accepted = 0
+    try:
+        for batch in batches:
+            accepted += dispatcher.submit(*batch)
+            time.sleep(pause)
+        assert dispatcher.flush(timeout=15)
+    finally:
+        dispatcher.stop(flush_timeout=1)
+    return accepted
+
+
+def test_webhook_flood_is_coalesced_and_retried(webhook):
+    url, received, handler = webhook
+    handler.failures = 1
+    dispatcher = AlertDispatcher([WebhookSink(url)], min_severity="high", coalesce_seconds=0.5, retry_base_seconds=0.2)
+    started = time.perf_counter()
+    accepted = dispatcher.submit("nginx_access", _flood())
+    submit_ms = (time.perf_counter() - started) * 1000
+    accepted += _run(dispatcher, ("nginx_access", [{"severity": "low", "description": "should be filtered"}]),
+                     ("nginx_error", _flood()), pause=0.8)
+    assert submit_ms < 100  # submit() 不做网络 I/O
+    assert accepted == 1000
+    assert 0 < len(received) <= 3
+    assert sum(alert["total"] for alert in received) == 1000
+    assert "should be filtered" not in json.dumps(received)
+    assert dispatcher.stats()["sinks"]["webhook"]["retries"] >= 1
+
+
+def test_syslog_priority(syslog_receiver):
+    address, received = syslog_receiver
+    _run(AlertDispatcher([SyslogSink(address=address)], coalesce_seconds=0.1), ("nginx_access", _flood(10)))
+    time.sleep(0.2)
+    assert any(message.startswith("<26>") for message in received)
+
+
+def test_smtp_sink_min_severity(smtp_receiver):
+    port, received = smtp_receiver
+    sink = SmtpSink(["root@localhost"], host="127.0.0.1", port=port, min_severity="critical")
+    _run(AlertDispatcher([sink], coalesce_seconds=0.1), ("nginx_access", _flood(10)))
+    assert received
+    assert all("[HIGH]" not in message for message in received)
+
+
+def test_command_hook_receives_json(tmp_path):
+    output = tmp_path / "hook.jsonl"
+    hook = [sys.executable, "-c", f"import sys; open({str(output)!r}, 'a').write(sys.stdin.read() + '\\n')"]
+    _run(AlertDispatcher([CommandSink(hook)], coalesce_seconds=0.1), ("nginx_access", _flood(20)))
+    alerts = [json.loads(line) for line in output.read_text(encoding='utf-8').splitlines() if line.strip()]
+    assert sum(alert["total"] for alert in alerts) == 20
+
+
+def test_dedup_key_suppresses_repeats(webhook):
+    url, received, _ = webhook
+    finding = {"severity": "critical", "description": "nginx down", "dedup_key": "health:nginx_down"}
+    dispatcher = AlertDispatcher([WebhookSink(url)], coalesce_seconds=0.1, dedup_seconds=3600)
+    accepted = _run(dispatcher, ("system_health", [dict(finding)]), ("system_health", [dict(finding)]), pause=0.3)
+    assert accepted == 1
+    assert dispatcher.stats()["suppressed"] == 1
+    assert sum(alert["total"] for alert in received) == 1
@@ -0,0 +1,27 @@
+from anomaly import AnomalyDetector, window_rate
+
+
+def _window(start_second, span_seconds, size=100):
+    """固定行数的访问日志窗口，均匀分布在 span_seconds 秒内"""
+    lines = []
+    for index in range(size):
+        second = start_second + index * span_seconds // size
+        lines.append(f'10.0.0.{index % 10} - - [01/May/2024:12:{second // 60 % 60:02d}:{second % 60:02d} +0000] '
+                     f'"GET /page/{index % 5} HTTP/1.1" 200 100 "-" "Mozilla/5.0"\n')
+    return lines
+
+
+def test_window_rate_uses_first_and_last_timestamps():
+    assert window_rate(_window(0, 50), "nginx_access") == 100 / 50
+    assert window_rate(["no timestamp\n"], "nginx_access") is None
+
+
+def test_rate_spike_fires_with_a_fixed_window_size():
+    detector = AnomalyDetector("nginx_access")
+    for round_index in range(10):
+        detector.score_window(_window(round_index * 100, 100))  # 约 1 行/秒
+    baseline = detector.score_window(_window(1000, 100), update=False)
+    burst = detector.score_window(_window(1100, 5), update=False)  # 同样 100 行，只跨 5 秒
+    assert baseline["components"]["rate"] < 1
+    assert burst["components"]["rate"] > 3
+    assert "count" not in burst["components"]
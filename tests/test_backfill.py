@@ -0,0 +1,46 @@
+import log_parser
+from backfill import scan_file
+
+LINES = [
+    "#9 /previous/file.php(1): tail()\n",
+    "[01-May-2024 12:00:00] WARNING: [pool www] child 1 exited with code 1\n",
+    "[01-May-2024 13:00:00] ERROR: [pool www] child 2 said into stderr: \"PHP Fatal error: boom\"\n",
+    "#0 /a.php(1): f()\n",
+    "#1 {main}\n",
+]
+
+
+def _scan(tmp_path, lines, since=None, until=None, log_type="php_fpm", max_lines=100):
+    path = tmp_path / "backfill.log"
+    path.write_text("".join(lines), encoding='utf-8')
+    return scan_file((str(path), log_type, since, until, 3600, max_lines))
+
+
+def _ts(line):
+    return log_parser.parse_line_timestamp(line, "php_fpm")
+
+
+def test_untimed_lines_inherit_timestamp_for_filter(tmp_path):
+    first, second = _ts(LINES[1]), _ts(LINES[2])
+    result = _scan(tmp_path, LINES, since=second)
+    assert result["total_lines"] == 5
+    assert list(result["partitions"]) == [second]
+    assert result["partitions"][second]["total"] == 3  # 续行随上一条记录一起保留
+
+    result = _scan(tmp_path, LINES, until=second)
+    assert list(result["partitions"]) == [first]
+    assert result["partitions"][first]["total"] == 2  # 文件开头的续行沿用第一个时间戳
+
+
+def test_file_without_timestamps(tmp_path):
+    lines = ["#0 /a.php(1): f()\n", "#1 {main}\n"]
+    assert _scan(tmp_path, lines, since=0)["partitions"] == {}
+    assert _scan(tmp_path, lines)["partitions"][-1]["total"] == 2
+
+
+def test_leading_lines_are_bounded(tmp_path):
+    lines = ['GET /x.php?id=1 UNION SELECT 1\n'] * 50
+    result = _scan(tmp_path, lines, log_type="nginx_access", max_lines=5)
+    bucket = result["partitions"][-1]
+    assert bucket["total"] == 50
+    assert bucket["suspicious"] == 50 and len(bucket["lines"]) == 5
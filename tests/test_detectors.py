@@ -0,0 +1,28 @@
+from detectors import DetectorSet, LoginBruteForceDetector, DirectoryEnumerationDetector
+
+
+def _line(ip, second, method="GET", path="/", status=200):
+    return f'{ip} - - [01/May/2024:12:00:{second:02d} +0000] "{method} {path} HTTP/1.1" {status} 1 "-" "x"\n'
+
+
+def test_brute_force_counts_across_batches_and_cools_down():
+    detectors = DetectorSet([LoginBruteForceDetector(window_seconds=60, threshold=5, cooldown_seconds=300)])
+    first = detectors.process_lines("nginx_access", [_line("6.6.6.6", i, "POST", "/wp-login.php") for i in range(3)])
+    assert first == []
+    findings = detectors.process_lines("nginx_access", [_line("6.6.6.6", i, "POST", "/wp-login.php") for i in range(3, 8)])
+    assert len(findings) == 1
+    assert findings[0]["dedup_key"] == "login_brute_force:6.6.6.6"
+
+
+def test_directory_enumeration_ignores_other_log_types():
+    detectors = DetectorSet([DirectoryEnumerationDetector(window_seconds=60, threshold=3)])
+    assert detectors.process_lines("nginx_error", ["2024/05/01 12:00:00 [error] 1#0: x\n"] * 5) == []
+    findings = detectors.process_lines("nginx_access", [_line("7.7.7.7", i, status=404) for i in range(3)])
+    assert [finding["detector"] for finding in findings] == ["directory_enumeration"]
+
+
+def test_state_round_trip():
+    detectors = DetectorSet([LoginBruteForceDetector(window_seconds=60, threshold=4)])
+    detectors.process_lines("nginx_access", [_line("6.6.6.6", i, "POST", "/xmlrpc.php") for i in range(3)])
+    restored = DetectorSet([LoginBruteForceDetector(window_seconds=60, threshold=4)]).load_dict(detectors.to_dict())
+    assert len(restored.process_lines("nginx_access", [_line("6.6.6.6", 4, "POST", "/xmlrpc.php")])) == 1
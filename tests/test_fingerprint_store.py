@@ -0,0 +1,69 @@
+import fingerprint_store
+from fingerprint_store import FingerprintStore, finding_fingerprint, normalize_line
+
+
+class FakeTime:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_marked_lines_are_filtered_until_they_expire(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(fingerprint_store.time, "time", clock)
+    store = FingerprintStore(ttl_seconds=60)
+    store.mark_lines("nginx_error", ["a\n", "b\n"])
+    assert store.filter_new_lines("nginx_error", [" a", "b\n", "c\n"]) == ["c\n"]  # 只忽略首尾空白
+    assert store.filter_new_lines("php_fpm", ["a\n"]) == ["a\n"]  # 指纹按日志类型区分
+    clock.now += 61
+    assert store.filter_new_lines("nginx_error", ["a\n", "b\n"]) == ["a\n", "b\n"]
+    store.prune()
+    assert len(store) == 0
+
+
+def test_lru_cap_evicts_least_recently_used():
+    store = FingerprintStore(max_entries=2)
+    now = 1_700_000_000.0
+    store.touch("one", now)
+    store.touch("two", now + 1)
+    store.touch("one", now + 2)  # "one" 变为最近使用
+    store.touch("three", now + 3)
+    assert store.get("two", now + 3) is None
+    assert store.get("one", now + 3) is not None
+    assert store.get("three", now + 3) is not None
+    assert len(store) == 2
+
+
+def test_record_findings_counts_repeats(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(fingerprint_store.time, "time", clock)
+    store = FingerprintStore()
+    finding = {"severity": "high", "description": "SQLi",
+               "log_lines": ['1.2.3.4 - - [01/May/2024:12:00:00 +0000] "GET /?id=1 UNION SELECT" 200 1']}
+    first = store.record_findings("nginx_access", [dict(finding), dict(finding)])
+    assert len(first) == 1 and first[0]["seen_count"] == 1  # 同一响应中的重复只计一次
+    clock.now += 30
+    # 时间戳不同的同一事件得到相同的指纹
+    later = dict(finding, log_lines=['1.2.3.4 - - [01/May/2024:13:00:00 +0000] "GET /?id=1 UNION SELECT" 200 1'])
+    second = store.record_findings("nginx_access", [later])
+    assert second[0]["seen_count"] == 2
+    assert second[0]["first_seen"] == first[0]["first_seen"]
+    assert second[0]["fingerprint"] == first[0]["fingerprint"]
+
+
+def test_dedup_key_takes_precedence_over_log_lines():
+    a = {"severity": "high", "dedup_key": "login_brute_force:1.2.3.4", "log_lines": ["x"]}
+    b = {"severity": "high", "dedup_key": "login_brute_force:1.2.3.4", "log_lines": ["y"]}
+    assert finding_fingerprint("nginx_access", a) == finding_fingerprint("nginx_access", b)
+    assert normalize_line("2024/05/01 12:00:00 [error] 12#34: *56 boom") == "[error] boom"
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "fingerprints.json")
+    store = FingerprintStore(path)
+    store.mark_lines("nginx_access", ["a\n"])
+    store.save()
+    loaded = FingerprintStore(path).load()
+    assert loaded.filter_new_lines("nginx_access", ["a\n", "b\n"]) == ["b\n"]
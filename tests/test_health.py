@@ -0,0 +1,60 @@
+import health
+from health import HealthMonitor, parse_stub_status
+
+
+def _no_nginx(expected_ports):
+    return {"running": False, "workers": 0, "master_pid": None, "rss_kb": 0}
+
+
+def test_nginx_down_only_alerts_when_enabled(monkeypatch):
+    monkeypatch.setattr(health, "probe_nginx", _no_nginx)
+    quiet = HealthMonitor()
+    quiet.sample()
+    assert quiet.report()["findings"] == []
+
+    monitor = HealthMonitor(alert_nginx_down=True)
+    monitor.sample()
+    monitor.sample()  # 冷却时间内不重复告警
+    findings = monitor.report()["findings"]
+    assert [finding["dedup_key"] for finding in findings] == ["health:nginx_down"]
+    assert findings[0]["severity"] == "critical"
+
+
+def test_parse_stub_status():
+    text = ("Active connections: 3 \nserver accepts handled requests\n 10 9 40 \n"
+            "Reading: 0 Writing: 1 Waiting: 2 \n")
+    counters = parse_stub_status(text)
+    assert counters["active"] == 3
+    assert (counters["accepts"], counters["handled"], counters["requests"]) == (10, 9, 40)
+
+
+def test_probe_nginx_skips_exited_processes(monkeypatch):
+    # 两个独立的 nginx 实例 (ppid 均不是 nginx)，其中 101 在探测期间退出
+    monkeypatch.setattr(health, "find_processes", lambda name: {101: 1, 102: 1})
+    monkeypatch.setattr(health, "process_rss_kb", lambda pid: 0)
+    monkeypatch.setattr(health, "listening_sockets", lambda: {"555": 80, "666": 8080})
+
+    def inodes(pid):
+        if pid == 101:
+            raise FileNotFoundError(f"/proc/{pid}/fd")
+        return {"555"}
+
+    monkeypatch.setattr(health, "process_socket_inodes", inodes)
+    status = health.probe_nginx()
+    assert status["port_check"] == "fd"
+    assert status["ports"] == [80]
+    assert status["running"] is True
+
+
+def test_probe_nginx_falls_back_to_ports_without_permission(monkeypatch):
+    monkeypatch.setattr(health, "find_processes", lambda name: {100: 1})
+    monkeypatch.setattr(health, "process_rss_kb", lambda pid: 0)
+    monkeypatch.setattr(health, "listening_sockets", lambda: {"555": 443, "666": 8080})
+
+    def denied(pid):
+        raise PermissionError(pid)
+
+    monkeypatch.setattr(health, "process_socket_inodes", denied)
+    status = health.probe_nginx()
+    assert status["port_check"] == "port"
+    assert status["ports"] == [443]
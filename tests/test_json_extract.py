@@ -0,0 +1,59 @@
+from json_extract import extract_json, parse_model_output
+
+
+def test_skips_braces_in_leading_prose():
+    obj, info = parse_model_output('Here is {the} json: {"findings":[],"summary":"x"}')
+    assert obj == {"findings": [], "summary": "x"}
+    assert not info["truncated"]
+    assert info["stripped_wrapper"]
+
+
+def test_truncated_last_finding_is_dropped():
+    text = ('{"findings":[{"severity":"high","description":"a","recommendation":"r"},'
+            '{"severity":"low","description":"b","recommendation":"do')
+    obj, info = parse_model_output(text)
+    assert [finding["description"] for finding in obj["findings"]] == ["a"]
+    assert info["truncated"]
+    assert info["recovered_findings"] == 1
+
+
+def test_truncated_log_lines_drop_whole_finding():
+    text = ('{"summary":"s","findings":[{"severity":"high","description":"a","recommendation":"r","log_lines":["x"]},'
+            '{"severity":"low","description":"b","log_lines":["l1","l2')
+    obj, info = parse_model_output(text)
+    assert obj["summary"] == "s"
+    assert len(obj["findings"]) == 1
+    assert obj["findings"][0]["log_lines"] == ["x"]
+
+
+def test_truncated_batch_keeps_complete_sections():
+    text = '{"sections":{"a":{"findings":[{"description":"d"}],"summary":"ok"},"b":{"findings":[{"description":"e"'
+    obj, info = parse_model_output(text)
+    assert list(obj["sections"]) == ["a"]
+    assert obj["sections"]["a"]["summary"] == "ok"
+
+
+def test_trailing_commas_and_code_fence():
+    obj, info = extract_json('```json\n{"findings": [1, 2,], "summary": "x",}\n```')
+    assert obj == {"findings": [1, 2], "summary": "x"}
+    assert info["trailing_commas_removed"] == 2
+    assert info["stripped_wrapper"]
+
+
+def test_no_object():
+    obj, info = extract_json("no json here")
+    assert obj is None
+    assert "error" in info
+
+
+def test_truncated_inside_first_finding_is_an_error():
+    for text in ('{"log_type":"nginx_access","findings":[{"severity":"high","descrip',
+                 '{"f":[{"s":"h","c":"SQLI","l":[1,'):
+        obj, info = parse_model_output(text)
+        assert obj is None
+        assert info["partial_element"]
+        assert "first finding" in info["error"]
+    # 截断在发现之后 (或根本没有开始发现) 时仍按修复结果返回
+    obj, info = parse_model_output('{"findings":[],"summary":"no iss')
+    assert obj == {"findings": [], "summary": ""}
+    assert not info["partial_element"]
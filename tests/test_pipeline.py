@@ -0,0 +1,68 @@
+import threading
+import time
+
+from pipeline import Pipeline, Stage, format_stats
+
+
+def test_items_flow_through_all_stages():
+    results = []
+    pipeline = Pipeline([
+        Stage("double", lambda item, emit: emit(item * 2), workers=3),
+        Stage("sink", lambda item, emit: results.append(item)),
+    ])
+    stats = pipeline.run(range(100))
+    assert sorted(results) == [value * 2 for value in range(100)]
+    assert stats["double"]["processed"] == stats["double"]["emitted"] == 100
+    assert stats["sink"]["received"] == 100
+    assert "double: 100 项/3 线程" in format_stats(stats)
+
+
+def test_emit_to_named_stage_skips_intermediate():
+    routed = []
+    pipeline = Pipeline([
+        Stage("split", lambda item, emit: emit(item, to="sink" if item % 2 else None)),
+        Stage("square", lambda item, emit: emit(item * item)),
+        Stage("sink", lambda item, emit: routed.append(item)),
+    ])
+    pipeline.run(range(6))
+    assert sorted(routed) == [0, 1, 3, 4, 5, 16]
+
+
+def test_batches_collect_within_linger():
+    batches = []
+    pipeline = Pipeline([Stage("batch", lambda batch, emit: batches.append(list(batch)),
+                               batch_size=4, linger_seconds=0.5, queue_size=16)])
+    pipeline.run(range(10))
+    assert sorted(item for batch in batches for item in batch) == list(range(10))
+    assert all(len(batch) <= 4 for batch in batches)
+    assert len(batches) == 3
+
+
+def test_full_queue_applies_backpressure():
+    release = threading.Event()
+
+    def slow(item, emit):
+        release.wait()
+
+    stage = Stage("slow", slow, queue_size=1)
+    pipeline = Pipeline([stage])
+    threading.Timer(0.3, release.set).start()
+    started = time.perf_counter()
+    stats = pipeline.run(range(4))
+    assert time.perf_counter() - started >= 0.25
+    assert stats["slow"]["blocked_seconds"] > 0
+    assert stats["slow"]["max_queue_depth"] == 1
+
+
+def test_errors_are_counted_and_do_not_stop_the_stage():
+    def flaky(item, emit):
+        if item == 3:
+            raise ValueError("boom")
+        emit(item)
+
+    received = []
+    stats = Pipeline([Stage("flaky", flaky), Stage("sink", lambda item, emit: received.append(item))]).run(range(5))
+    assert stats["flaky"]["errors"] == 1
+    assert stats["flaky"]["processed"] == 5
+    assert sorted(received) == [0, 1, 2, 4]
+    assert "错误 1" in format_stats(stats)
@@ -0,0 +1,60 @@
+import io
+
+from record_store import AccessRecordStore, FLAG_SIGNATURE, FLAG_UNCOMMON_METHOD, FLAG_UNPARSED
+
+LINES = [
+    '1.2.3.4 - - [01/May/2024:12:00:00 +0000] "GET /index.php HTTP/1.1" 200 512 "-" "curl/8.0"\n',
+    '1.2.3.4 - - [01/May/2024:12:00:01 +0000] "GET /wp-admin/../../etc/passwd HTTP/1.1" 404 0 "-" "curl/8.0"\n',
+    '5.6.7.8 - - [01/May/2024:12:00:02 +0000] "POST /api/save HTTP/1.1" 502 0 "-" "Mozilla/5.0"\n',
+    '5.6.7.8 - - [01/May/2024:12:00:03 +0000] "PROPFIND /dav HTTP/1.1" 405 0 "-" "Mozilla/5.0"\n',
+    'garbage line\n',
+]
+
+
+def _store(lines=LINES, **kwargs):
+    store = AccessRecordStore(**kwargs)
+    data = "".join(lines).encode('utf-8')
+    offset = 0
+    for line in lines:
+        size = len(line.encode('utf-8'))
+        store.append(line, offset, size)
+        offset += size
+    return store, data
+
+
+def test_classify_matches_sampling_reasons():
+    store, _ = _store()
+    reasons = [store.classify(index)[1] for index in range(len(store))]
+    assert reasons == [None, "signature", "5xx", "method", "unparsed"]
+    assert store.flags[1] & FLAG_SIGNATURE
+    assert store.flags[3] & FLAG_UNCOMMON_METHOD
+    assert store.flags[4] & FLAG_UNPARSED
+    assert store.labels(store.classify(2)[0]) == ("5xx", "5.6.7.8", "/api")
+
+
+def test_aggregate_counts_on_columns():
+    store, _ = _store()
+    aggregate = store.aggregate()
+    assert aggregate["total_records"] == 5
+    assert aggregate["status_counts"] == {"2xx": 1, "4xx": 2, "5xx": 1, "unparsed": 1}
+    assert aggregate["top_ips"] == [("1.2.3.4", 2), ("5.6.7.8", 2)]
+    assert aggregate["signature_hits"] == 1
+    assert aggregate["unparsed"] == 1
+    assert aggregate["last_ts"] - aggregate["first_ts"] == 3
+
+
+def test_materialize_reads_back_selected_records():
+    store, data = _store()
+    records = store.materialize(io.BytesIO(data), [3, 0])
+    assert [record.lines[0] for record in records] == [LINES[0], LINES[3]]
+    assert records[1].start == len("".join(LINES[:3]).encode('utf-8'))
+    # 文件被截断时跳过读不完整的记录
+    assert len(store.materialize(io.BytesIO(data[:-5]), range(len(store)))) == 4
+
+
+def test_dictionary_overflow_collapses_to_star():
+    lines = [f'10.0.0.{i} - - [01/May/2024:12:00:00 +0000] "GET /p{i} HTTP/1.1" 200 1 "-" "ua"\n' for i in range(5)]
+    store, _ = _store(lines, max_distinct_values=2)
+    assert store.ips.overflow == 3
+    assert store.labels(store.classify(4)[0])[1] == "*"
+    assert store.nbytes() > 0
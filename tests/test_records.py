@@ -0,0 +1,74 @@
+from records import (LogRecord, RecordAssembler, assemble, chunk_records, record_lines, select_top_records, take_first,
+                     take_last)
+
+FPM = (b"#1 /tail.php(3): orphan()\n"
+       b"[01-May-2024 12:00:00] WARNING: [pool www] child 1 said\n"
+       b"[01-May-2024 12:00:01 UTC] PHP Fatal error: boom\n"
+       b"#0 /a.php(1): f()\n"
+       b"#1 {main}\n")
+
+
+def _records(*sizes):
+    offset = 0
+    records = []
+    for index, size in enumerate(sizes):
+        records.append(LogRecord(offset, offset + size, tuple(f"r{index} l{line}\n" for line in range(size))))
+        offset += size
+    return records
+
+
+def test_assemble_groups_continuation_lines():
+    records, last, dropped = assemble(FPM, 100, "php_fpm")
+    assert [len(record.lines) for record in records] == [1, 1]
+    assert records[0].start == 100  # 文件开头的续行单独成为一条记录
+    assert last.lines[0].startswith("[01-May-2024 12:00:01 UTC]") and len(last.lines) == 3
+    assert last.end == 100 + len(FPM)
+    assert dropped == 0
+    assert record_lines(records + [last]) == FPM.decode().splitlines(keepends=True)
+
+
+def test_assemble_drops_leading_fragment_and_caps_lines():
+    records, last, dropped = assemble(FPM, 0, "php_fpm", drop_leading=True, max_record_lines=2)
+    assert dropped == 1
+    assert len(records) == 1
+    assert len(last.lines) == 2
+    assert last.end == len(FPM)  # 超出上限的续行不保留内容，字节范围仍然连续
+
+
+def test_assembly_disabled_and_access_log_are_one_line_per_record():
+    for kwargs in ({"log_type": "php_fpm", "enabled": False}, {"log_type": "nginx_access"}):
+        records, last, _ = assemble(FPM, 0, **kwargs)
+        assert len(records) + 1 == 5
+        assert all(len(record.lines) == 1 for record in records + [last])
+
+
+def test_assembler_pending_start():
+    assembler = RecordAssembler("nginx_error")
+    assert assembler.feed("2024/05/01 12:00:00 [error] 1#0: first\n", 0, 40) is None
+    assert assembler.pending_start == 0
+    record = assembler.feed("2024/05/01 12:00:01 [error] 1#0: second\n", 40, 81)
+    assert record == LogRecord(0, 40, ("2024/05/01 12:00:00 [error] 1#0: first\n",))
+    assert assembler.pending_start == 40
+
+
+def test_take_first_and_last_keep_whole_records():
+    records = _records(2, 3, 1, 4)
+    assert take_first(records, 5) == records[:2]
+    assert take_last(records, 5) == records[2:]
+    assert take_first(records, 1) == records[:1]  # 至少一条
+    assert take_last(records, 0) == records[-1:]
+
+
+def test_chunk_records_splits_between_records():
+    records = _records(2, 3, 6, 1)
+    assert chunk_records(records, 5) == [records[:2], records[2:3], records[3:]]
+    assert chunk_records(records, 0) == [records]
+    assert chunk_records([], 5) == []
+
+
+def test_select_top_records_scores_by_best_line_and_keeps_order():
+    records = _records(2, 1, 3, 1)
+    line_scores = [0, 1, 0, 0, 9, 0, 5]
+    assert select_top_records(records, line_scores, 4) == [records[2], records[3]]
+    assert select_top_records(records, line_scores, 6) == [records[0], records[2], records[3]]
+    assert select_top_records(records, line_scores, 100) == records
@@ -0,0 +1,71 @@
+import base64
+import json
+
+import config
+from replay import build_corpus, extract_fixture, load_corpus, run_corpus
+
+LINES = ['2024/05/01 12:00:00 [error] 12#12: *1 FastCGI sent in stderr: "PHP Fatal error: boom"\n']
+MODEL_TEXT = json.dumps({"log_type": "nginx_error", "findings": [
+    {"severity": "high", "type": "php_fatal", "description": "PHP fatal error", "log_lines": [LINES[0].strip()]}]})
+
+
+def _prompt(lines):
+    return "分析以下日志:\n" + base64.b64encode("".join(lines).encode('utf-8')).decode('ascii')
+
+
+def _gemini_entry():
+    return {
+        "timestamp": "2024-05-01T12:00:05",
+        "request": {"model": "gemini-test", "contents": [{"role": "user", "parts": [{"text": _prompt(LINES)}]}]},
+        "response": {"raw_api_response": {"candidates": [
+            {"finishReason": "STOP", "content": {"parts": [{"text": MODEL_TEXT}]}}]}},
+    }
+
+
+def _openrouter_entry():
+    return {
+        "timestamp": "2024-05-01T12:00:06",
+        "api_provider": "openrouter",
+        "request": {"model": "router-test", "messages": [
+            {"role": "system", "content": "system"},
+            {"role": "user", "content": [{"type": "text", "text": _prompt(LINES)}]}]},
+        "response": {"raw_api_response": {"choices": [
+            {"finish_reason": "length", "message": {"content": MODEL_TEXT[:-1]}}]}},
+    }
+
+
+def test_extract_fixture_from_gemini_entry():
+    fixture = extract_fixture(_gemini_entry())
+    assert fixture["provider"] == "gemini"
+    assert fixture["model"] == "gemini-test"
+    assert fixture["finish_reason"] == "STOP"
+    assert fixture["model_text"] == MODEL_TEXT
+    assert fixture["sections"] == {"replay": LINES}
+    assert fixture["batched"] is False
+
+
+def test_extract_fixture_from_openrouter_entry():
+    fixture = extract_fixture(_openrouter_entry())
+    assert fixture["provider"] == "openrouter"
+    assert fixture["model"] == "router-test"
+    assert fixture["finish_reason"] == "length"
+    assert fixture["sections"] == {"replay": LINES}
+    # 只有请求、没有模型输出的记录不生成样本
+    assert extract_fixture({"request": _openrouter_entry()["request"], "response": None}) is None
+
+
+def test_run_corpus_check_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "REPORT_HTML_PATH", str(tmp_path / "report.html"))
+    log_path = tmp_path / "ai_api_log.json"
+    log_path.write_text("\n".join(json.dumps(entry) for entry in (_gemini_entry(), _openrouter_entry(), _gemini_entry()))
+                        + "\nnot json\n", encoding='utf-8')
+    corpus_path = str(tmp_path / "corpus.jsonl")
+    assert build_corpus(str(log_path), corpus_path) == 2  # 重复的记录按内容去重
+
+    fixtures = load_corpus(corpus_path)
+    stats = run_corpus(fixtures, check=True)
+    assert stats["mismatches"] == []
+    assert stats["parse_success_rate"] == 1.0
+
+    fixtures[0]["model_text"] = "not json at all"
+    assert [item["id"] for item in run_corpus(fixtures, check=True)["mismatches"]] == [fixtures[0]["id"]]
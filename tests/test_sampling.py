@@ -0,0 +1,50 @@
+from records import LogRecord
+from sampling import StratifiedSampler, format_sampling_header, path_prefix
+
+
+def _record(index, ip="10.0.0.1", path="/", status=200, method="GET"):
+    line = f'{ip} - - [01/May/2024:12:00:00 +0000] "{method} {path} HTTP/1.1" {status} 1 "-" "x"\n'
+    return LogRecord(index * 100, index * 100 + len(line), (line,))
+
+
+def _sample(records, budget, **kwargs):
+    sampler = StratifiedSampler(budget, seed=1, **kwargs)
+    for record in records:
+        sampler.add(record)
+    return sampler.sample()
+
+
+def test_signature_hits_fill_budget_before_other_reasons():
+    records = []
+    for index in range(5000):
+        if index % 50 == 0:
+            records.append(_record(index, path="/../../etc/passwd", status=404))
+        elif index % 10 == 0:
+            records.append(_record(index, status=502))
+        else:
+            records.append(_record(index, ip=f"10.0.{index % 7}.1", path=f"/a/{index % 5}"))
+    sampled, stats = _sample(records, 150)
+    assert sum("passwd" in record.lines[0] for record in sampled) == 100
+    assert stats["always_included_by_reason"] == {"signature": 100, "5xx": 50}
+    assert len(sampled) == 150
+
+
+def test_method_before_5xx_within_shared_limit():
+    records = [_record(i, status=500) for i in range(20)] + [_record(20 + i, method="PROPFIND") for i in range(20)]
+    sampled, stats = _sample(records, 20, always_include_max=10)
+    assert stats["always_included_by_reason"] == {"method": 10}
+
+
+def test_small_interval_keeps_file_order_and_reports_volume():
+    records = [_record(i, ip=f"10.0.0.{i % 3}") for i in range(30)]
+    sampled, stats = _sample(records, 10)
+    assert [record.start for record in sampled] == sorted(record.start for record in sampled)
+    assert stats["total_records"] == 30
+    assert stats["sampled_lines"] <= 10
+    assert "30 requests" in format_sampling_header(stats)
+
+
+def test_path_prefix():
+    assert path_prefix("/api/v1/x?q=1") == "/api"
+    assert path_prefix("/api/v1/x", depth=2) == "/api/v1"
+    assert path_prefix("http://example.com/") == "http://example.com/"
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import Deadline, DeadlineExceeded, FixedRateScheduler, call_with_deadline, format_cadence
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _run(policy, durations, interval=10):
+    clock = FakeClock()
+    scheduler = FixedRateScheduler(interval, overrun_policy=policy, clock=clock, sleep=clock.sleep)
+    ticks = []
+    for duration in durations:
+        tick = scheduler.wait_next()
+        clock.now += duration
+        scheduler.finish(tick)
+        ticks.append(tick)
+    return scheduler, ticks
+
+
+def test_fixed_rate_does_not_drift():
+    scheduler, ticks = _run("coalesce", [3, 4, 2, 5])
+    assert [tick["started"] for tick in ticks] == [0, 10, 20, 30]
+    assert scheduler.stats()["period_seconds"]["mean"] == 10
+    assert scheduler.overruns == 0
+
+
+def test_skip_waits_for_next_grid_tick():
+    scheduler, ticks = _run("skip", [2, 25, 3])
+    assert [tick["started"] for tick in ticks] == [0, 10, 40]
+    assert scheduler.skipped_ticks == 2
+    assert not ticks[2]["overrun"]
+
+
+def test_coalesce_runs_missed_ticks_once_immediately():
+    scheduler, ticks = _run("coalesce", [2, 25, 3, 3])
+    assert [tick["started"] for tick in ticks] == [0, 10, 35, 40]
+    assert ticks[2]["overrun"] and ticks[2]["index"] == 3
+    assert scheduler.coalesced_ticks == 1
+    assert "合并 1 个" in format_cadence(scheduler.stats())
+
+
+def test_reduce_shrinks_budget_and_deadline():
+    scheduler, ticks = _run("reduce", [2, 25, 3])
+    assert ticks[2]["budget_factor"] == 0.5
+    assert scheduler.reduced_runs == 1
+    assert scheduler.deadline_for(ticks[2]).seconds == 5
+    assert scheduler.deadline_for(ticks[1], deadline_seconds=8).seconds == 8
+
+
+def test_unknown_overrun_policy_is_rejected():
+    with pytest.raises(ValueError):
+        FixedRateScheduler(10, overrun_policy="later")
+
+
+def test_deadline_clamps_timeouts():
+    deadline = Deadline(2)
+    assert deadline.clamp((30, 120)) == pytest.approx((2, 2), abs=0.1)
+    assert deadline.clamp(1) == 1
+    assert not deadline.expired()
+
+
+def test_call_with_deadline_abandons_slow_call():
+    release = threading.Event()
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline(Deadline(0.2), release.wait, 5)
+    assert time.monotonic() - started < 1
+    release.set()
+
+
+def test_call_with_deadline_returns_result_and_reraises():
+    assert call_with_deadline(Deadline(5), sum, [1, 2, 3]) == 6
+    assert call_with_deadline(None, max, 1, 2) == 2
+    with pytest.raises(ZeroDivisionError):
+        call_with_deadline(Deadline(5), lambda: 1 / 0)
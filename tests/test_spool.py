@@ -0,0 +1,74 @@
+import os
+
+from spool import Spool, drain, is_provider_outage
+
+
+def _open(tmp_path, **kwargs):
+    return Spool(str(tmp_path), fsync_policy="never", **kwargs).open()
+
+
+def test_pending_entries_survive_reopen(tmp_path):
+    spool = _open(tmp_path)
+    first = spool.put("nginx_access", ["a\n"])
+    spool.put("php_fpm", ["b\n"])
+    spool.ack(first)
+    spool.close()
+    reopened = _open(tmp_path)
+    assert len(reopened) == 1
+    entry = reopened.read(reopened.pending_ids()[0])
+    assert entry["log_type"] == "php_fpm" and entry["lines"] == ["b\n"]
+
+
+def test_drain_stops_after_failed_probe(tmp_path):
+    spool = _open(tmp_path)
+    for index in range(3):
+        spool.put("nginx_access", [f"{index}\n"])
+    calls = []
+
+    def analyze(entry):
+        calls.append(entry["id"])
+        return False, {"error": "down"}
+
+    outcomes = drain(spool, analyze, max_attempts=2)
+    assert len(calls) == 1
+    assert [status for _, _, status in outcomes] == ["retry"]
+    outcomes = drain(spool, analyze, max_attempts=2)
+    assert [status for _, _, status in outcomes] == ["gave_up"]
+    assert len(spool) == 2
+
+
+def test_unreadable_entry_is_acked_and_segment_pruned(tmp_path):
+    spool = _open(tmp_path, segment_max_bytes=200)
+    ids = [spool.put("nginx_access", [f"line {index}\n"]) for index in range(3)]
+    spool._active.flush()
+    seq, offset = spool._pending[ids[0]][:2]
+    path = spool._segment_path(seq)
+    with open(path, 'r+b') as f:
+        f.seek(offset + 12)
+        f.write(b'X')  # 破坏第一条记录的内容，使 CRC 校验失败
+    outcomes = drain(spool, lambda entry: (True, {"findings": []}), concurrency=2)
+    statuses = sorted(status for _, _, status in outcomes)
+    assert statuses == ["corrupt", "done", "done"]
+    assert len(spool) == 0
+    assert not os.path.exists(path)
+
+
+def test_sampling_stats_are_stored_with_the_entry(tmp_path):
+    spool = _open(tmp_path)
+    sampling = {"total_records": 5000, "sampled_records": 50, "sampling_rate": 0.01}
+    sampled = spool.put("nginx_access", ["a\n"], sampling=sampling)
+    plain = spool.put("php_fpm", ["b\n"])
+    spool.close()
+    reopened = _open(tmp_path)
+    assert reopened.read(sampled)["sampling"] == sampling
+    assert "sampling" not in reopened.read(plain)
+
+
+def test_only_provider_outages_are_spooled():
+    assert is_provider_outage({"error": "timeout", "transport_error": True})
+    assert is_provider_outage({"error": "503", "transport_error": True, "status_code": 503})
+    assert is_provider_outage({"error": "429", "transport_error": True, "status_code": 429})
+    assert is_provider_outage({"error": "late", "deadline_exceeded": True})
+    assert not is_provider_outage(None)  # 未配置 API Key
+    assert not is_provider_outage({"error": "401", "transport_error": True, "status_code": 401})
+    assert not is_provider_outage({"error": "Invalid JSON response from model"})